@@ -2,28 +2,19 @@
 from flask import Flask, g, request
 from .routes import web_bp
 from .api import api_bp  # .以降の部分はpythonのファイル名が入る
+from .log_setup import setup_logging
+from .services import warmup
 from config import Config  # ← ルート直下の config.py を参照
-import logging, json ,sys , uuid ,time
-
-class JsonFormatter(logging.Formatter):
-    def format(self, record):
-        base = {"level": record.levelname, "msg": record.getMessage()}
-        # extra={"trace": {...}} をそのまま展開
-        if hasattr(record, "trace"):
-            base.update(record.trace)
-        return json.dumps(base, ensure_ascii=False)
-    
+import uuid ,time
+
 # Flaskアプリを作る
 def create_app():
     # Flask本体を生成し、config.pyを読み込む
     app = Flask(__name__, template_folder="templates", static_folder="static")
     app.config.from_object(Config)
 
-    # 構造化ログ
-    h = logging.StreamHandler(sys.stdout)
-    h.setFormatter(JsonFormatter())
-    app.logger.handlers[:] = [h]
-    app.logger.setLevel(logging.INFO)
+    # 構造化ログ（キュー経由で別スレッドが出力。サンプリング・切り詰めは log_setup）
+    setup_logging(app)
 
     # リクエスト共通のtrace_id と 計測開始
     @app.before_request
@@ -54,4 +45,7 @@ def create_app():
     #BluePrint登録
     app.register_blueprint(web_bp)
     app.register_blueprint(api_bp, url_prefix="/api")
+
+    # 重い依存・インデックスの前倒し読み込み（WARMUP。gunicorn ではワーカー起動時に gunicorn.conf.py から）
+    warmup.start(app)
     return app
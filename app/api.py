@@ -2,14 +2,31 @@
 from flask import Blueprint, request, jsonify, current_app, g
 from werkzeug.utils import secure_filename as wz_secure_filename  # 既存のままでもOK
 from .services.rag import answer
-from .services.doc_utils import ingest_local_dir, is_allowed_ext
+from .services.doc_utils import ingest_local_dir, is_allowed_ext, dir_hashes, remember_sha256
+from .services.vectorstore import index_version, list_indexed_files
+from .services.coalesce import coalesce_key, run_coalesced
+from .services.jobs import start_ingest_job, request_ingest, get_job, cancel_job, JobConflict
+from .services.admission import Overloaded
+from .services import conversation, deadline
+from typing import Tuple
 import os
 import unicodedata
 import re
 import secrets
+import hashlib
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 
+def _overloaded(e: Overloaded):
+    """外部依存の待ち行列が満杯 / 待ち時間切れ → 503 を即返す（クライアントは Retry-After 後に再試行）"""
+    current_app.logger.warning("overloaded", extra={"trace": {
+        "schema_version": 1, "trace_id": getattr(g, "trace_id", ""), "dependency": e.dependency,
+        "reason": e.reason, "waited_ms": e.waited_ms, "path": request.path}})
+    resp = jsonify({"ok": False, "error": str(e), "dependency": e.dependency, "reason": e.reason,
+                    "trace_id": getattr(g, "trace_id", "")})
+    resp.headers["Retry-After"] = str(int(current_app.config.get("LIMIT_RETRY_AFTER_SEC", 2)))
+    return resp, 503
+
 def safe_filename_keep_unicode(filename: str) -> str:
     """
     日本語などのUnicodeを残しつつ、安全なファイル名に整える。
@@ -54,16 +71,68 @@ def uniquify_path(dirpath: str, filename: str) -> str:
         i += 1
     return os.path.join(dirpath, candidate)
 
+def _claim_path(tmp_path: str, dirpath: str, filename: str) -> str:
+    """
+    一時ファイルを衝突しない名前へ移す。os.link は既存名だと失敗するので
+    「存在確認→保存」の間に他リクエストが同名で保存しても上書きしない。
+    """
+    base, ext = os.path.splitext(filename)
+    candidate, i = filename, 1
+    while True:
+        path = os.path.join(dirpath, candidate)
+        try:
+            os.link(tmp_path, path)
+            os.unlink(tmp_path)
+            return path
+        except FileExistsError:
+            candidate = f"{base}_{i}{ext}"
+            i += 1
+        except OSError:
+            # ハードリンク不可のファイルシステム向け
+            path = uniquify_path(dirpath, filename)
+            os.replace(tmp_path, path)
+            return path
+
+class UploadTooLarge(Exception):
+    pass
+
+def _stream_to_tmp(stream, dirpath: str, max_bytes: int, chunk_size: int = 1 << 20) -> Tuple[str, str, int]:
+    """アップロードを分割して一時ファイルへ書きつつ sha256 を計算。戻り値: (一時パス, sha256, バイト数)"""
+    h = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(dirpath, f".upload-{secrets.token_hex(8)}.part")
+    try:
+        with open(tmp_path, "wb") as out:
+            for block in iter(lambda: stream.read(chunk_size), b""):
+                size += len(block)
+                if max_bytes and size > max_bytes:
+                    raise UploadTooLarge()
+                h.update(block)
+                out.write(block)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return tmp_path, h.hexdigest(), size
+
 @api_bp.post("/upload")
 def api_upload():
+    """
+    files を PDF_DIR へ保存。内容(sha256)が既存ファイルと同じなら UPLOAD_DUPLICATE に従い
+    reject（保存しない）/ alias（既存ファイルを指す）する。index=true なら保存後に取り込みを依頼。
+    """
     if "files" not in request.files:
         return jsonify({"ok": False, "error": "files フィールドが見つかりません", "trace_id": getattr(g, "trace_id", "")}), 400
 
     upload_dir = current_app.config.get("PDF_DIR", "data/pdf")
     os.makedirs(upload_dir, exist_ok=True)
+    max_bytes = int(current_app.config.get("UPLOAD_MAX_BYTES") or 0)
+    dup_policy = (current_app.config.get("UPLOAD_DUPLICATE") or "reject").lower()
+    want_index = str(request.form.get("index") or current_app.config.get("UPLOAD_AUTO_INDEX", False)).lower() in ("1", "true", "yes")
 
+    known = dir_hashes(upload_dir)  # {sha256: 既存ファイル名}
     files = request.files.getlist("files")
-    saved, skipped = [], []
+    saved, skipped, aliased = [], [], []
     for f in files:
         if not f.filename:
             continue
@@ -77,23 +146,62 @@ def api_upload():
             skipped.append({"name": filename_raw, "reason": "拡張子が許可されていません"})
             continue
 
-        # 同名衝突を回避
-        path = uniquify_path(upload_dir, filename)
+        # 分割保存＋ハッシュ計算
+        try:
+            tmp_path, sha, size = _stream_to_tmp(f.stream, upload_dir, max_bytes)
+        except UploadTooLarge:
+            skipped.append({"name": filename_raw, "reason": f"サイズ上限（{max_bytes} bytes）を超えています"})
+            continue
 
-        # 保存
-        f.save(path)
+        # 同じ内容のファイルが既にある
+        if sha in known:
+            os.unlink(tmp_path)
+            if dup_policy == "alias":
+                aliased.append({"name": filename_raw, "alias_of": known[sha]})
+            else:
+                skipped.append({"name": filename_raw, "reason": f"同じ内容のファイルが既にあります: {known[sha]}"})
+            continue
+
+        # 同名衝突を回避して確定
+        path = _claim_path(tmp_path, upload_dir, filename)
+        remember_sha256(path, sha)
+        known[sha] = os.path.basename(path)
         saved.append(os.path.basename(path))
 
-    return jsonify({"ok": True, "saved": saved, "skipped": skipped, "upload_dir": upload_dir, "trace_id": getattr(g, "trace_id", "")})
+    res = {"ok": True, "saved": saved, "skipped": skipped, "aliased": aliased, "upload_dir": upload_dir}
+    if want_index and saved:
+        # 変わったファイルだけ埋め込む（内容が同じファイルは前回のベクトルを再利用）
+        res["ingest"] = request_ingest()
+    return jsonify({**res, "trace_id": getattr(g, "trace_id", "")})
 
 
 
 @api_bp.post("/ingest")
 def api_ingest():
-    """data/pdf を走査してベクトルインデックスを再構築"""
+    """
+    data/pdf を走査してベクトルインデックスを再構築。
+    既定はバックグラウンドジョブ（202 + job）。sync=true なら従来どおりこのリクエスト内で実行。
+    shards=[k,...]（または "0,2"）で指定シャードだけベクトルから作り直す（他は変更が無ければ引き継ぐ）。
+    """
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.values
+    sync = str(data.get("sync") or "").lower() in ("1", "true", "yes")
+    shards = data.get("shards")
+    try:
+        if isinstance(shards, str):
+            shards = [int(x) for x in shards.split(",") if x.strip()]
+        rebuild = [int(x) for x in shards] if shards else None
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "shards はシャード番号のリストで指定してください", "trace_id": getattr(g, "trace_id", "")}), 400
     try:
-        n = ingest_local_dir()
-        return jsonify({"ok": True, "indexed_docs": n, "trace_id": getattr(g, "trace_id", "")})
+        if sync:
+            n = ingest_local_dir(rebuild_shards=rebuild)
+            return jsonify({"ok": True, "indexed_docs": n, "trace_id": getattr(g, "trace_id", "")})
+        job = start_ingest_job(rebuild_shards=rebuild)
+        return jsonify({"ok": True, "job": job.to_dict(), "trace_id": getattr(g, "trace_id", "")}), 202
+    except JobConflict as e:
+        return jsonify({"ok": False, "error": str(e), "job_id": e.running_id, "trace_id": getattr(g, "trace_id", "")}), 409
+    except Overloaded as e:
+        return _overloaded(e)
     except Exception as e:
         current_app.logger.exception("ingest failed", extra={"trace": {
             "schema_version": 1, "trace_id": getattr(g, "trace_id", ""), "error": str(e), "where": "api_ingest"
@@ -101,25 +209,104 @@ def api_ingest():
         return jsonify({"ok": False, "error": str(e), "trace_id": getattr(g, "trace_id", "")}), 500
 
 
+@api_bp.get("/ingest/<job_id>")
+def api_ingest_status(job_id: str):
+    """取り込みジョブの状態・進捗"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "ジョブが見つかりません", "trace_id": getattr(g, "trace_id", "")}), 404
+    return jsonify({"ok": True, "job": job, "trace_id": getattr(g, "trace_id", "")})
+
+
+@api_bp.post("/ingest/<job_id>/cancel")
+def api_ingest_cancel(job_id: str):
+    """取り込みジョブのキャンセル要求（現在のステップが終わった所で止まる）"""
+    job = cancel_job(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "ジョブが見つかりません", "trace_id": getattr(g, "trace_id", "")}), 404
+    return jsonify({"ok": True, "job": job, "trace_id": getattr(g, "trace_id", "")})
+
+
+@api_bp.get("/files")
+def api_files():
+    """取り込み済みファイル一覧（?offset=0&limit=50 でページング）"""
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = min(500, max(1, int(request.args.get("limit", 50))))
+    except ValueError:
+        return jsonify({"ok": False, "error": "offset/limit は整数で指定してください", "trace_id": getattr(g, "trace_id", "")}), 400
+
+    files = list_indexed_files()
+    return jsonify({
+        "ok": True,
+        "files": files[offset:offset + limit],
+        "total": len(files),
+        "offset": offset,
+        "limit": limit,
+        "index_version": index_version(),
+        "trace_id": getattr(g, "trace_id", ""),
+    })
+
+
 @api_bp.post("/ask")
 def api_ask():
     """
     mode=doc|web|hybrid, query=..., debug=bool を受け取りRAGで回答
     debug=true かつ DEBUG_RAG=True の時のみ trace を返す
+    conversation_id を渡すと同じ会話の続きとして扱う（無ければ採番して返す。CONV_ENABLED=False なら使わない）
+    deadline_ms でこのリクエストの締め切りを指定できる（無ければ REQUEST_DEADLINE_MS。REQUEST_DEADLINE_MAX_MS まで）
     """
     data = request.get_json(force=True) if request.is_json else request.form
     query = (data.get("query") or "").strip()
     mode = (data.get("mode") or "doc").lower()
     debug = str(data.get("debug") or "").lower() in ("1", "true", "yes")
-
     if not query:
         return jsonify({"ok": False, "error": "queryが空です", "trace_id": getattr(g, "trace_id", "")}), 400
     if mode not in ("doc", "web", "hybrid"):
         return jsonify({"ok": False, "error": "modeは doc|web|hybrid のいずれかです", "trace_id": getattr(g, "trace_id", "")}), 400
+    try:
+        budget = deadline.start(int(data["deadline_ms"]) if data.get("deadline_ms") not in (None, "") else None)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "deadline_msは整数(ms)で指定してください", "trace_id": getattr(g, "trace_id", "")}), 400
+
+    # 会話状態の読み込みは入力を検査してから（不正なリクエストでストレージを読まない）
+    conv_id, fresh = None, False
+    if current_app.config.get("CONV_ENABLED", True):
+        conv_id = data.get("conversation_id")
+        if not conversation.valid_id(conv_id):
+            conv_id = conversation.new_id()
+        # 状態の無い最初の質問は答えが会話に依らないので、同時の同じ質問とまとめて実行できる
+        fresh = conversation.load(conv_id) is None
 
     try:
-        res = answer(query=query, mode=mode, debug=debug)
-        return jsonify({"ok": True, **res, "mode": mode, "trace_id": getattr(g, "trace_id", "")})
+        if current_app.config.get("COALESCE_ENABLED", True):
+            # 同じ質問（正規化後）・モード・インデックス版の同時リクエストは1回の実行にまとめる
+            # 会話の続きは会話ごとに答えが変わるので、まとめるのは同じ会話内の重複送信だけ
+            # （最初の質問は会話に依らないので id をキーに入れない。状態は下で各自の id に保存する）
+            # 締め切りが違えば省略される段も変わるので別扱い。相乗りで待つのも締め切りまで
+            key = coalesce_key(query, mode, debug, index_version(), None if fresh else conv_id, budget)
+            wait = float(current_app.config.get("COALESCE_WAIT_SEC", 60.0))
+            if deadline.remaining() is not None:
+                wait = max(0.0, min(wait, deadline.remaining()))
+            res, shared = run_coalesced(
+                key, lambda: answer(query=query, mode=mode, debug=debug,
+                                    conversation_id=None if fresh else conv_id, new_conversation=fresh),
+                lock_dir=current_app.config.get("COALESCE_DIR"),
+                wait_timeout=wait,
+            )
+            if shared:
+                res = {**res, "meta": {**(res.get("meta") or {}), "coalesced": True}}
+        else:
+            res = answer(query=query, mode=mode, debug=debug,
+                         conversation_id=None if fresh else conv_id, new_conversation=fresh)
+        state = res.get("_conversation_state")
+        if state is not None:
+            conversation.save(conv_id, state)
+            res = {k: v for k, v in res.items() if k != "_conversation_state"}
+        return jsonify({"ok": True, **res, "mode": mode, "conversation_id": conv_id,
+                        "trace_id": getattr(g, "trace_id", "")})
+    except Overloaded as e:
+        return _overloaded(e)
     except Exception as e:
         current_app.logger.exception("ask failed", extra={"trace": {
             "schema_version": 1, "trace_id": getattr(g, "trace_id", ""), "error": str(e), "where": "api_ask"
@@ -129,12 +316,12 @@ def api_ask():
 @api_bp.post("/reset")
 def api_reset():
     """
-    （任意）サーバ側に会話スコープがある場合のみ。
-    セッションやDB上の会話履歴・一時状態を初期化。
+    conversation_id の会話状態（履歴・前回の検索候補）を消し、新しい conversation_id を返す。
     """
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.values
     try:
-        # 例: session["conv"] = {"id": new_id, "messages": [], ...}
-        # 今の実装に会話スコープが無いならダミーでOK
-        return jsonify({"ok": True, "message": "reset done", "trace_id": getattr(g, "trace_id", "")})
+        cleared = conversation.clear(data.get("conversation_id"))
+        return jsonify({"ok": True, "message": "reset done", "cleared": cleared,
+                        "conversation_id": conversation.new_id(), "trace_id": getattr(g, "trace_id", "")})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e), "trace_id": getattr(g, "trace_id", "")}), 500
\ No newline at end of file
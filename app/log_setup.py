@@ -0,0 +1,209 @@
+# app/log_setup.py
+"""
+構造化ログ（JSON 1行）をキュー経由でバックグラウンド出力する。
+
+- リクエスト側は LogRecord をキューに入れるだけ（json.dumps・書き込みは QueueListener のスレッド）
+- キューは LOG_QUEUE_MAX 件まで。満杯なら捨てて数え、次に出力できた時に "log.dropped" を1行出す
+- サンプリング（trace_id ごとに決定的）
+    LOG_DECISION_SAMPLE      … rag.decision の途中段階（scope_checked / generated）を残す割合（終端段階は常に残す）
+    LOG_TRACE_DETAIL_SAMPLE  … rag.trace の doc_hits / web_hits などの大きい項目を丸ごと残す割合（他は件数だけ）
+- 切り詰め: 文字列は LOG_MAX_STR 文字、リストは LOG_MAX_LIST 件まで
+WARNING 以上はサンプリングしない。LOG_ASYNC=0 なら従来どおり同期出力。
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import zlib
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+
+_TERMINAL_STAGES = {"early_reject", "validated", "done"}
+_HEAVY_STEPS = ("doc_hits", "web_hits", "web_fetch", "context_preview", "rerank", "scope_raw")
+
+
+def _sampled(trace_id: str, rate: float) -> bool:
+    """trace_id から決定的に間引く（同じリクエストのログは揃って残る / 消える）"""
+    if rate >= 1.0:
+        return True
+    if rate <= 0.0:
+        return False
+    return (zlib.crc32((trace_id or "").encode()) % 10000) < rate * 10000
+
+
+def _snapshot(obj: Any, depth: int = 0) -> Any:
+    """dict・list の入れ物だけをたどったコピー（キューに入れた後にリクエスト側が書き換えても影響しない）"""
+    if depth > 8:
+        return "…"
+    if isinstance(obj, dict):
+        return {k: _snapshot(v, depth + 1) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_snapshot(v, depth + 1) for v in obj]
+    return obj
+
+
+def _light(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """steps の大きい項目を件数（または "[sampled_out]"）に置き換えた trace"""
+    if not isinstance(trace.get("steps"), dict):
+        return trace
+    steps = dict(trace["steps"])
+    for k in _HEAVY_STEPS:
+        v = steps.get(k)
+        if isinstance(v, (list, tuple)):
+            steps[k] = {"count": len(v)}
+        elif v is not None:
+            steps[k] = "[sampled_out]"
+    return {**trace, "steps": steps}
+
+
+def _shape(obj: Any, max_str: int, max_list: int, depth: int = 0) -> Any:
+    """長い文字列・リストを切り詰めたコピー"""
+    if depth > 8:
+        return "…"
+    if isinstance(obj, str):
+        return obj if len(obj) <= max_str else obj[:max_str] + f"…(+{len(obj) - max_str})"
+    if isinstance(obj, dict):
+        return {k: _shape(v, max_str, max_list, depth + 1) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        out = [_shape(v, max_str, max_list, depth + 1) for v in obj[:max_list]]
+        if len(obj) > max_list:
+            out.append(f"…(+{len(obj) - max_list})")
+        return out
+    return obj
+
+
+class JsonFormatter(logging.Formatter):
+    """extra={"trace": {...}} を展開した JSON 1行。大きい項目は切り詰める"""
+
+    def __init__(self, max_str: int = 1000, max_list: int = 10):
+        super().__init__()
+        self.max_str = max_str
+        self.max_list = max_list
+
+    def format(self, record):
+        # ts（UNIX秒）は scripts/replay.py が到着間隔を再現するのに使う
+        base = {"ts": round(record.created, 3), "level": record.levelname, "msg": record.getMessage()}
+        trace = getattr(record, "trace", None)
+        if isinstance(trace, dict):
+            base.update(_shape(trace, self.max_str, self.max_list))
+        if record.exc_info:
+            base["exc"] = self.formatException(record.exc_info)[-self.max_str * 4:]
+        return json.dumps(base, ensure_ascii=False, default=str)
+
+
+class SamplingQueueHandler(QueueHandler):
+    """リクエスト側で動く部分。サンプリング判定とキュー投入だけ行う（満杯なら捨てて数える）"""
+
+    def __init__(self, q: queue.Queue, decision_sample: float, detail_sample: float):
+        super().__init__(q)
+        self.decision_sample = decision_sample
+        self.detail_sample = detail_sample
+        self.dropped = 0
+        self.sampled_out = 0
+        self._count_lock = threading.Lock()
+
+    def prepare(self, record):
+        # 整形はリスナー側で行う（既定の prepare は format を呼んでしまう）
+        # trace はリクエスト側で使い続ける dict（timing・steps）なので、ここで写しに差し替える
+        trace = getattr(record, "trace", None)
+        if isinstance(trace, dict):
+            if record.levelno < logging.WARNING and not _sampled(trace.get("trace_id", ""), self.detail_sample):
+                trace = _light(trace)
+            record.trace = _snapshot(trace)
+        return record
+
+    def emit(self, record):
+        if record.levelno < logging.WARNING and record.msg == "rag.decision":
+            trace = getattr(record, "trace", None) or {}
+            if trace.get("stage") not in _TERMINAL_STAGES and \
+                    not _sampled(trace.get("trace_id", ""), self.decision_sample):
+                with self._count_lock:
+                    self.sampled_out += 1
+                return
+        try:
+            self.enqueue(self.prepare(record))
+        except queue.Full:
+            with self._count_lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def enqueue(self, record):
+        self.queue.put_nowait(record)
+
+
+class _Listener(QueueListener):
+    """出力スレッド。捨てた件数が増えていたら先に "log.dropped" を出す"""
+
+    def __init__(self, q, handler: logging.Handler, source: SamplingQueueHandler):
+        super().__init__(q, handler, respect_handler_level=False)
+        self.source = source
+        self.reported = 0
+
+    def report_dropped(self):
+        dropped = self.source.dropped
+        if dropped > self.reported:
+            note = logging.LogRecord("app", logging.WARNING, __file__, 0, "log.dropped", None, None)
+            note.trace = {"schema_version": 1, "dropped": dropped - self.reported, "dropped_total": dropped,
+                          "sampled_out_total": self.source.sampled_out}
+            self.reported = dropped
+            super().handle(note)
+
+    def handle(self, record):
+        self.report_dropped()
+        super().handle(record)
+
+
+_state: Dict[str, Any] = {}
+
+
+def _start_listener():
+    qh: SamplingQueueHandler = _state["queue_handler"]
+    qh.queue = queue.Queue(maxsize=_state["maxsize"])
+    listener = _Listener(qh.queue, _state["stream_handler"], qh)
+    listener.start()
+    _state["listener"] = listener
+
+
+def _stop_listener():
+    listener: Optional[_Listener] = _state.get("listener")
+    if listener is not None:
+        try:
+            listener.stop()  # 残っているレコードを出し切る
+            listener.report_dropped()
+        except Exception:
+            pass
+        _state["listener"] = None
+
+
+def setup_logging(app):
+    """create_app から呼ぶ。app.logger をキュー経由（LOG_ASYNC=0 なら同期）の JSON 出力にする"""
+    cfg = app.config
+    h = logging.StreamHandler(sys.stdout)
+    h.setFormatter(JsonFormatter(int(cfg.get("LOG_MAX_STR", 1000)), int(cfg.get("LOG_MAX_LIST", 10))))
+    app.logger.setLevel(logging.INFO)
+    if not cfg.get("LOG_ASYNC", True):
+        app.logger.handlers[:] = [h]
+        return
+
+    if _state.get("queue_handler") is None:
+        _state.update(maxsize=int(cfg.get("LOG_QUEUE_MAX", 10000)), stream_handler=h,
+                      queue_handler=SamplingQueueHandler(queue.Queue(), float(cfg.get("LOG_DECISION_SAMPLE", 1.0)),
+                                                         float(cfg.get("LOG_TRACE_DETAIL_SAMPLE", 1.0))))
+        _start_listener()
+        atexit.register(_stop_listener)
+        # gunicorn の preload では fork 後の子に出力スレッドが無いので、子で作り直す
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_start_listener)
+    app.logger.handlers[:] = [_state["queue_handler"]]
+
+
+def log_stats() -> Dict[str, int]:
+    """捨てた件数・間引いた件数・キュー滞留数"""
+    qh: Optional[SamplingQueueHandler] = _state.get("queue_handler")
+    if qh is None:
+        return {"async": False}
+    return {"async": True, "queued": qh.queue.qsize(), "dropped": qh.dropped, "sampled_out": qh.sampled_out}
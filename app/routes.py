@@ -1,5 +1,6 @@
 # app/routes.py
-from flask import Blueprint, render_template, current_app
+from flask import Blueprint, render_template, current_app, jsonify
+from .services import warmup
 from .services.vectorstore import list_indexed_files, faiss_exists
 
 web_bp = Blueprint("web", __name__)
@@ -14,3 +15,16 @@ def index():
     except Exception:
         current_app.logger.exception("failed to list indexed files")
     return render_template("index.html", files=files, has_index=has_index)
+
+
+@web_bp.get("/healthz")
+def healthz():
+    # プロセスが応答できるか（warm-up 中でも 200）
+    return jsonify({"ok": True})
+
+@web_bp.get("/readyz")
+def readyz():
+    # warm-up が終わって初回リクエストが遅くならない状態か（ロードバランサへの投入判定用）
+    st = warmup.status()
+    body = {"ok": st["ready"], "warmup": st["mode"], "result": st["result"], "error": st["error"]}
+    return jsonify(body), (200 if st["ready"] else 503)
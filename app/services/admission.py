@@ -0,0 +1,179 @@
+# app/services/admission.py
+"""
+外部依存（chat / embed / search / fetch）ごとの同時実行数の上限と、有限の待ち行列。
+
+- 同時実行が LIMIT_<依存> に達していたら待ち行列に並ぶ（LIMIT_QUEUE_MAX 人まで、LIMIT_QUEUE_TIMEOUT_SEC 秒まで）
+- 行列が満杯 / 待ち時間切れなら Overloaded を投げる（API は 503 + trace_id で即返す）
+- 待った時間はリクエストごとに g に積み、rag が timing["queue_ms"] として trace に出す
+- リクエストに締め切り（deadline.py）があれば、待つのは締め切りまで（超えたら reason="deadline" の Overloaded）
+上限はプロセス単位（gunicorn では ワーカー数 × 上限 が全体の上限）。0 なら無制限。
+"""
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from typing import Dict
+
+from flask import current_app, g, has_app_context, has_request_context
+
+from .deadline import remaining
+
+class Overloaded(Exception):
+    """依存先の待ち行列が満杯、または待ち時間切れ"""
+    def __init__(self, dependency: str, reason: str, waited_ms: int = 0):
+        super().__init__(f"混雑しています（{dependency}: {reason}）。しばらくしてから再度お試しください。")
+        self.dependency = dependency
+        self.reason = reason  # queue_full / timeout
+        self.waited_ms = waited_ms
+
+
+class Limiter:
+    """同時実行数 limit のセマフォ＋長さ queue_max の待ち行列"""
+
+    def __init__(self, name: str, limit: int, queue_max: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_max = queue_max
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.extra = 0         # try_acquire で取れた追加の枠（ヘッジなど）
+        self.extra_denied = 0  # 空きが無くて追加を諦めた回数
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float = None, reason: str = "timeout") -> int:
+        """枠を取る（timeout で待ち時間の上限を上書き）。戻り値は待った ms。取れなければ Overloaded"""
+        if self.limit <= 0:
+            return 0
+        timeout = self.timeout if timeout is None else timeout
+        t0 = time.perf_counter()
+        with self._cond:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return 0
+            if self.waiting >= self.queue_max:
+                self.rejected += 1
+                raise Overloaded(self.name, "queue_full")
+            self.waiting += 1
+            try:
+                until = t0 + timeout
+                while self.active >= self.limit:
+                    left = until - time.perf_counter()
+                    if left <= 0 or not self._cond.wait(left):
+                        if self.active < self.limit:
+                            break
+                        self.rejected += 1
+                        raise Overloaded(self.name, reason, int((time.perf_counter() - t0) * 1000))
+                self.active += 1
+            finally:
+                self.waiting -= 1
+        return int((time.perf_counter() - t0) * 1000)
+
+    def try_acquire(self) -> bool:
+        """空きがあるときだけ枠を取る（待たない・待ち行列の人を追い越さない）。ヘッジなど任意の追加呼び出し用"""
+        if self.limit <= 0:
+            return True
+        with self._cond:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.extra += 1
+                return True
+            self.extra_denied += 1
+            return False
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting, "rejected": self.rejected,
+                "extra": self.extra, "extra_denied": self.extra_denied}
+
+
+def _cfg(name: str, default):
+    """Flaskのconfigがあれば優先し、無ければ環境変数→既定値"""
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return os.getenv(name, default)
+
+
+_limiters: Dict[str, Limiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(dependency: str) -> Limiter:
+    lim = _limiters.get(dependency)
+    if lim is None:
+        with _limiters_lock:
+            lim = _limiters.get(dependency)
+            if lim is None:
+                lim = _limiters[dependency] = Limiter(
+                    dependency,
+                    limit=int(_cfg(f"LIMIT_{dependency.upper()}", 0)),
+                    queue_max=int(_cfg("LIMIT_QUEUE_MAX", 32)),
+                    timeout=float(_cfg("LIMIT_QUEUE_TIMEOUT_SEC", 5.0)),
+                )
+    return lim
+
+
+def _record_wait(dependency: str, ms: int):
+    """リクエスト内の待ち時間を依存ごとに積む（rag が timing["queue_ms"] に出す）"""
+    if has_request_context():
+        waits = g.setdefault("queue_ms", {})
+        waits[dependency] = waits.get(dependency, 0) + ms
+
+
+def queue_waits() -> Dict[str, int]:
+    """このリクエストで待った時間 {依存: ms}"""
+    return dict(g.get("queue_ms") or {}) if has_request_context() else {}
+
+
+def _wait_budget(lim: Limiter) -> Dict:
+    """待ち行列で待てる時間（リクエストの締め切りが先に来るならそこまで）"""
+    left = remaining()
+    if left is not None and left < lim.timeout:
+        return {"timeout": max(0.0, left), "reason": "deadline"}
+    return {}
+
+
+def acquire(dependency: str) -> Limiter:
+    """枠を1つ取って Limiter を返す（返すのは呼び出し側の lim.release()。別スレッドで返す場合用）"""
+    lim = get_limiter(dependency)
+    _record_wait(dependency, lim.acquire(**_wait_budget(lim)))
+    return lim
+
+
+@contextmanager
+def limit(dependency: str):
+    """with limit("chat"): ... の間だけ枠を占有する"""
+    lim = acquire(dependency)
+    try:
+        yield
+    finally:
+        lim.release()
+
+
+async def aacquire(dependency: str) -> Limiter:
+    """acquire の asyncio 版（待つのはワーカースレッドなのでイベントループは止めない）"""
+    lim = get_limiter(dependency)
+    _record_wait(dependency, await asyncio.to_thread(lim.acquire, **_wait_budget(lim)))
+    return lim
+
+
+@asynccontextmanager
+async def alimit(dependency: str):
+    """limit の asyncio 版"""
+    lim = await aacquire(dependency)
+    try:
+        yield
+    finally:
+        lim.release()
+
+
+def limiter_stats() -> Dict[str, Dict[str, int]]:
+    return {name: lim.stats() for name, lim in _limiters.items()}
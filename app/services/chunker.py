@@ -0,0 +1,220 @@
+# app/services/chunker.py
+"""
+チャンク分割。
+
+- sentence: 日本語の文末（。！？ など＋閉じ括弧）と段落（空行）を境界にし、
+  トークン数の目安 CHUNK_TOKENS まで文を詰める。前のチャンク末尾の文を CHUNK_OVERLAP_TOKENS まで重ねる。
+  表の行（タブ・| 区切り・空白で列が並ぶ行）と箇条書きは1行を1単位にして文分割しない。
+  Markdown は見出し（# …）で必ず区切り、各チャンクの先頭に見出しの階層を付ける。
+- fixed（既定）: 従来の固定長（800文字・120文字重ね）。CHUNKER=sentence で上に切り替える
+
+どちらも本文を1回なめるだけ（正規表現の finditer と貪欲な詰め込み）なので文書長に対して線形。
+トークン数は近似（非ASCII 1文字≒1、ASCII 4文字≒1）。外部トークナイザに依存しないので結果が環境で変わらない。
+"""
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import current_app
+
+# 分割ロジックを変えたら上げる（取り込みシグネチャに入り、古いベクトルを使い回さなくなる）
+CHUNKER_VERSION = 2
+
+_ASCII = re.compile(r"[\x00-\x7f]+")
+# 文: 文末記号（英文の . は直後が空白のときだけ）＋閉じ括弧まで。最後の文は文末記号なしでも可
+_SENT = re.compile(r"(?:[^。．！？!?.]|\.(?!\s))+(?:(?:[。．！？!?]+|\.(?=\s))[」』）)\]】]*|$)|[。．！？!?]+")
+_HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*$")
+_BULLET = re.compile(r"^(?:[・●○■□◆◇▪]\s*|[\-*+]\s|\d{1,3}[.)．）]\s|[（(]\d{1,3}[)）]|[①-⑳])")
+_GAP = re.compile(r"[ 　]{2,}|\t")
+_ENDS = re.compile(r"(?:[。．！？!?.」』）)\]】|])\s*$")
+
+
+def estimate_tokens(s: str) -> int:
+    """トークン数の近似（非ASCII 1文字≒1、ASCII 4文字≒1）"""
+    n_ascii = sum(len(m) for m in _ASCII.findall(s))
+    return (len(s) - n_ascii) + (n_ascii + 3) // 4
+
+
+def chunker_config() -> Dict[str, Any]:
+    """現在の分割設定（ingest_signature にも入れる）"""
+    name = current_app.config.get("CHUNKER", "fixed")
+    if name != "sentence":
+        return {"name": "fixed", "size": 800, "overlap": 120}
+    return {"name": "sentence", "version": CHUNKER_VERSION,
+            "tokens": int(current_app.config.get("CHUNK_TOKENS", 500)),
+            "overlap": int(current_app.config.get("CHUNK_OVERLAP_TOKENS", 60))}
+
+
+def split_text(text: str, markdown: bool = False, cfg: Optional[Dict[str, Any]] = None) -> List[str]:
+    """設定に応じて分割（cfg を省略すると chunker_config()）"""
+    cfg = cfg or chunker_config()
+    if cfg["name"] == "fixed":
+        return split_fixed(text, cfg["size"], cfg["overlap"])
+    return split_sentences(text, cfg["tokens"], cfg["overlap"], markdown=markdown)
+
+
+# ===== 固定長 =====
+def split_fixed(text: str, size: int = 800, overlap: int = 120) -> List[str]:
+    """シンプルな固定長スライス"""
+    out, i = [], 0
+    n = len(text)
+    while i < n:
+        chunk = text[i:i + size].strip()
+        if chunk:
+            out.append(chunk)
+        i += size - overlap
+    return out
+
+
+# ===== 文・段落単位 =====
+def _glue(a: str, b: str) -> str:
+    """行・文をつなぐ区切り（日本語どうしは詰め、英数字どうしは空白）"""
+    return " " if a and b and a[-1].isascii() and b[0].isascii() else ""
+
+
+def _is_row(line: str) -> bool:
+    """表の行・箇条書き（1行を1単位として扱う）"""
+    return (line.count("|") >= 2 or len(_GAP.findall(line)) >= 2 or "\t" in line
+            or _BULLET.match(line) is not None)
+
+
+class _Packer:
+    """(区切り, 本文, トークン数) を目安トークン数まで貪欲に詰める"""
+
+    def __init__(self, target: int, overlap: int):
+        self.target = max(16, target)
+        self.overlap = max(0, min(overlap, self.target // 2))
+        self.out: List[str] = []
+        self.prefix = ""
+        self.prefix_tok = 0
+        self.cur: List[Tuple[str, str, int]] = []
+        self.cur_tok = 0
+        self.fresh = 0  # 重ね分以外の単位数（0なら出力しない）
+
+    def set_heading(self, prefix: str):
+        self.flush(carry=False)
+        self.prefix = f"{prefix}\n" if prefix else ""
+        self.prefix_tok = estimate_tokens(self.prefix)
+
+    def add(self, sep: str, piece: str):
+        tok = estimate_tokens(piece)
+        room = max(16, self.target - self.prefix_tok)
+        if tok > room:
+            for part in _hard_split(piece, room):
+                self.add(sep, part)
+                sep = ""
+            return
+        if self.fresh and self.cur_tok + tok > room:
+            self.flush(carry=True)
+            # 重ねた分と合わせて入りきらなければ、古い方から重ねるのをやめる
+            while self.cur and self.cur_tok + tok > room:
+                self.cur_tok -= self.cur.pop(0)[2]
+        self.cur.append((sep, piece, tok))
+        self.cur_tok += tok
+        self.fresh += 1
+
+    def flush(self, carry: bool):
+        if self.fresh:
+            body = self.cur[0][1] + "".join(sep + p for sep, p, _ in self.cur[1:])
+            self.out.append(self.prefix + body.strip())
+        keep: List[Tuple[str, str, int]] = []
+        kept = 0
+        if carry and self.fresh:
+            # 先頭の単位は持ち越さない（全部を持ち越すと前のチャンクが次のチャンクに丸ごと入る）
+            for unit in reversed(self.cur[1:]):
+                if kept + unit[2] > self.overlap:
+                    break
+                keep.append(unit)
+                kept += unit[2]
+            keep.reverse()
+        self.cur, self.cur_tok, self.fresh = keep, kept, 0
+
+
+def _hard_split(piece: str, room: int) -> List[str]:
+    """文末の無い長い塊を目安トークン数ごとに切る（空白があればそこで）"""
+    out: List[str] = []
+    start, cost, last_space = 0, 0.0, -1
+    for i, ch in enumerate(piece):
+        cost += 0.25 if ch.isascii() else 1.0
+        if ch.isspace():
+            last_space = i
+        if cost > room:
+            cut = last_space + 1 if last_space > start + (i - start) // 2 else i
+            out.append(piece[start:cut])
+            start, last_space = cut, -1
+            cost = sum(0.25 if c.isascii() else 1.0 for c in piece[start:i + 1])
+    if start < len(piece):
+        out.append(piece[start:])
+    return [p for p in (s.strip() for s in out) if p]
+
+
+def split_sentences(text: str, tokens: int = 500, overlap: int = 60, markdown: bool = False) -> List[str]:
+    """
+    文・段落・（Markdownなら）見出しを境界に、約 tokens トークンのチャンクへ分割する。
+    """
+    pk = _Packer(tokens, overlap)
+    headings: List[Tuple[int, str]] = []
+    para: List[str] = []
+    in_code = False
+
+    def end_para():
+        if not para:
+            return
+        joined = para[0]
+        for line in para[1:]:
+            joined += _glue(joined, line) + line
+        para.clear()
+        first = True
+        for m in _SENT.finditer(joined):
+            s = m.group().strip()
+            if s:
+                pk.add("\n" if first else _glue(pk.cur[-1][1] if pk.cur else "", s), s)
+                first = False
+
+    for raw in text.splitlines():
+        line = raw.strip()
+        if markdown and line.startswith("```"):
+            end_para()
+            in_code = not in_code
+            pk.add("\n", line)
+            continue
+        if in_code:
+            if line:
+                pk.add("\n", raw.rstrip())
+            continue
+        if not line:
+            end_para()
+            continue
+        if markdown:
+            h = _HEADING.match(line)
+            if h:
+                end_para()
+                level = len(h.group(1))
+                while headings and headings[-1][0] >= level:
+                    headings.pop()
+                headings.append((level, h.group(2)))
+                pk.set_heading(" > ".join(t for _, t in headings))
+                continue
+        if _is_row(line):
+            end_para()
+            pk.add("\n", line)
+        else:
+            para.append(line)
+    end_para()
+    pk.flush(carry=False)
+    return pk.out
+
+
+# ===== 統計 =====
+def chunk_stats(chunks: List[str]) -> Dict[str, Any]:
+    """チャンク数とサイズ分布（近似トークン数）。文の途中で終わるチャンクの割合も出す"""
+    n = len(chunks)
+    if not n:
+        return {"chunks": 0}
+    toks = sorted(estimate_tokens(c) for c in chunks)
+    pct = lambda p: toks[min(n - 1, int(p * n / 100))]  # noqa: E731
+    mid = sum(1 for c in chunks if not _ENDS.search(c))
+    return {
+        "chunks": n, "tokens_total": sum(toks), "tokens_mean": round(sum(toks) / n, 1),
+        "tokens_min": toks[0], "tokens_p50": pct(50), "tokens_p90": pct(90), "tokens_max": toks[-1],
+        "mid_sentence_end_ratio": round(mid / n, 3),
+    }
@@ -0,0 +1,152 @@
+# app/services/coalesce.py
+"""
+同一質問の同時実行をまとめる（single-flight）。
+- プロセス内: 先着のスレッドだけが計算し、後続は Event で結果を待つ
+- 同一ホストの別ワーカー間: ロックファイル(flock)で先着を決め、結果をJSONで受け渡す
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import fcntl  # POSIXのみ。Windowsではプロセス内の集約だけ行う
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+_POLL_SEC = 0.05
+_RESULT_KEEP_SEC = 600
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+_inflight: Dict[str, _Flight] = {}
+_lock = threading.Lock()
+
+def normalize_query(query: str) -> str:
+    """NFKC正規化＋空白の畳み込み＋小文字化（表記揺れで別キーにならないように）"""
+    q = unicodedata.normalize("NFKC", query or "")
+    return re.sub(r"\s+", " ", q).strip().lower()
+
+def coalesce_key(query: str, *parts: Any) -> str:
+    raw = json.dumps([normalize_query(query), *parts], ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def run_coalesced(key: str, fn: Callable[[], Any], *, lock_dir: Optional[str] = None,
+                  wait_timeout: float = 60.0) -> Tuple[Any, bool]:
+    """
+    key が同じ呼び出しを1回の fn() にまとめる。戻り値: (結果, 他の呼び出しの結果を共有したか)
+    先着が失敗したら後続にも同じ例外を投げる（一斉に fn() をやり直さない）。
+    先着が wait_timeout を過ぎても終わらなければ、後続のうち1つが新しい先着になり残りはそれを待つ。
+    """
+    while True:
+        with _lock:
+            flight = _inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _inflight[key] = _Flight()
+        if leader:
+            break
+        if flight.event.wait(wait_timeout):
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        with _lock:
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+
+    try:
+        res, shared = _run_cross_process(key, fn, lock_dir, wait_timeout)
+        flight.result = res
+        return res, shared
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            # 待ちきれなかった後続が新しい先着になっていれば、そちらは消さない
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+        flight.event.set()
+
+# ===== ワーカー間（ロックファイル） =====
+def _run_cross_process(key: str, fn: Callable[[], Any], lock_dir: Optional[str],
+                       wait_timeout: float) -> Tuple[Any, bool]:
+    if fcntl is None or not lock_dir:
+        return fn(), False
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_path = os.path.join(lock_dir, f"{key}.lock")
+    res_path = os.path.join(lock_dir, f"{key}.json")
+
+    started = time.time()
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    os.utime(lock_path)  # _prune の対象にならないよう使用中は更新
+    try:
+        if not _try_flock(fd):
+            # 他ワーカーが計算中 → ロック解放（=結果書き込み完了）を待つ
+            deadline = started + wait_timeout
+            while not _try_flock(fd):
+                if time.time() > deadline:
+                    return fn(), False
+                time.sleep(_POLL_SEC)
+            cached = _read_result(res_path, since=started)
+            if cached is not None:
+                return cached["result"], True
+            # 先着が失敗していた場合はここで自分が計算する
+
+        res = fn()
+        _write_result(res_path, res)
+        return res, False
+    finally:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+def _try_flock(fd: int) -> bool:
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+def _read_result(path: str, since: float) -> Optional[Dict[str, Any]]:
+    """since 以降に書かれた結果だけを返す（古い結果の使い回しはしない）"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            obj = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if float(obj.get("ts", 0)) < since:
+        return None
+    return obj
+
+def _write_result(path: str, res: Any):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"ts": time.time(), "result": res}, f, ensure_ascii=False, default=str)
+    os.replace(tmp, path)
+    _prune(os.path.dirname(path))
+
+def _prune(lock_dir: str):
+    """古い結果ファイルを掃除（ロックファイルは1日以上触られていないものだけ）"""
+    now = time.time()
+    try:
+        entries = list(os.scandir(lock_dir))
+    except OSError:
+        return
+    for e in entries:
+        try:
+            age = now - e.stat().st_mtime
+            if (e.name.endswith(".json") and age > _RESULT_KEEP_SEC) or \
+               (e.name.endswith(".lock") and age > 86400):
+                os.unlink(e.path)
+        except OSError:
+            pass
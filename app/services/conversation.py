@@ -0,0 +1,215 @@
+# app/services/conversation.py
+"""
+会話ごとのサーバ側状態（/api/ask の conversation_id 単位）。
+
+- CONV_DIR/<id>.json に保存する（gunicorn の別ワーカーに来た続きの質問でも読める）
+- 最終更新から CONV_TTL_SEC 過ぎたものは期限切れ。件数は CONV_MAX まで（古い順に削除）
+- 1会話に持つのは 直近 CONV_MAX_TURNS 往復の要約済み履歴（回答は CONV_ANSWER_CHARS 文字まで）と、
+  直前に検索した候補チャンク・Webページ（本文は CONV_CANDIDATE_CHARS 文字まで）
+続きの質問（「その上限額は？」など）は、検索をやり直さずに前回の候補を並べ替えて使う（スコープ判定は毎回行う）。
+同じ候補を使い回すのは CONV_MAX_FOLLOWUPS 回まで。質問と候補の文字bigramの重なりが CONV_REUSE_MIN_OVERLAP 未満なら検索し直す。
+"""
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from typing import Any, Dict, List, Optional
+
+from flask import current_app
+
+from .chunker import estimate_tokens
+
+_ID_RE = re.compile(r"^[0-9a-f]{8,32}$")
+
+# 指示語・接続で始まる短い質問は前の質問の続きとみなす
+_FOLLOW_UP_RE = re.compile(
+    r"^(では|じゃあ|それなら|それでは|あと|また|ちなみに|さらに|他に|ほかに)|"
+    r"(その|それ|それら|この|これ|あの|上記|前述|同じ|同様|該当の|先ほど|さっき)")
+_BIGRAM_SKIP = re.compile(r"[\s、。？！?!「」（）()・]")
+
+_lock = threading.Lock()
+_saves = 0
+
+
+def _dir() -> str:
+    path = current_app.config.get("CONV_DIR") or "data/conversations"
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def valid_id(conv_id: Optional[str]) -> bool:
+    return bool(conv_id) and bool(_ID_RE.match(conv_id))
+
+
+def _path(conv_id: str) -> str:
+    return os.path.join(_dir(), f"{conv_id}.json")
+
+
+def load(conv_id: str) -> Optional[Dict[str, Any]]:
+    """会話状態を読む。無い・期限切れ・壊れている場合は None"""
+    if not valid_id(conv_id):
+        return None
+    path = _path(conv_id)
+    try:
+        if time.time() - os.path.getmtime(path) > float(current_app.config.get("CONV_TTL_SEC", 1800)):
+            clear(conv_id)
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(conv_id: str, state: Dict[str, Any]):
+    global _saves
+    path = _path(conv_id)
+    tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+    with _lock:
+        _saves += 1
+        due = _saves % 50 == 1
+    if due:
+        prune()
+
+
+def clear(conv_id: str) -> bool:
+    if not valid_id(conv_id):
+        return False
+    try:
+        os.remove(_path(conv_id))
+        return True
+    except OSError:
+        return False
+
+
+def prune():
+    """期限切れと、CONV_MAX を超えた古い会話を消す"""
+    cfg = current_app.config
+    ttl = float(cfg.get("CONV_TTL_SEC", 1800))
+    cap = int(cfg.get("CONV_MAX", 2000))
+    now = time.time()
+    entries = []
+    with os.scandir(_dir()) as it:
+        for e in it:
+            if not e.name.endswith(".json"):
+                continue
+            try:
+                entries.append((e.stat().st_mtime, e.path))
+            except OSError:
+                pass
+    entries.sort()
+    excess = max(0, len(entries) - cap)
+    for i, (mtime, path) in enumerate(entries):
+        if i < excess or now - mtime > ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# ===== 続きの質問の判定と、前回候補の並べ替え =====
+def is_follow_up(query: str, state: Optional[Dict[str, Any]], mode: str) -> bool:
+    """
+    前回の検索結果を使い回してよい続きの質問か（同じモードで、短く、指示語・接続で始まる）。
+    使い回しが CONV_MAX_FOLLOWUPS 回に達した・候補との重なりが小さい場合は検索し直す（False）
+    """
+    if not state or not state.get("retrieval") or state["retrieval"].get("mode") != mode:
+        return False
+    q = query.strip()
+    cfg = current_app.config
+    if len(q) > int(cfg.get("CONV_FOLLOWUP_MAX_CHARS", 40)) or not _FOLLOW_UP_RE.search(q):
+        return False
+    retrieval = state["retrieval"]
+    if int(retrieval.get("follow_ups") or 0) >= int(cfg.get("CONV_MAX_FOLLOWUPS", 3)):
+        return False
+    return candidate_overlap(q, retrieval) >= float(cfg.get("CONV_REUSE_MIN_OVERLAP", 0.2))
+
+
+def _bigrams(s: str) -> set:
+    s = _BIGRAM_SKIP.sub("", s)
+    return {s[i:i + 2] for i in range(len(s) - 1)}
+
+
+def candidate_overlap(query: str, retrieval: Dict[str, Any]) -> float:
+    """質問の文字bigramのうち、保存した候補のどれか1件に含まれる割合の最大値"""
+    qb = _bigrams(_FOLLOW_UP_RE.sub("", query))  # 指示語そのものは重なりに数えない
+    if not qb:
+        return 1.0  # 「それは？」のように指示語だけなら前回の候補の続きとみなす
+    best = 0.0
+    for c in (retrieval.get("doc") or []) + (retrieval.get("web") or []):
+        best = max(best, len(qb & _bigrams(c.get("text") or c.get("snippet") or "")) / len(qb))
+    return best
+
+
+def refine(query: str, candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    前回の候補を続きの質問との文字bigram一致で並べ替える（同点は前回の順位を優先）。
+    各候補には "text"（本文）がある前提
+    """
+    qb = _bigrams(query)
+    scored = []
+    for rank, c in enumerate(candidates):
+        overlap = len(qb & _bigrams(c.get("text") or c.get("snippet") or "")) / (len(qb) or 1)
+        scored.append((overlap - rank * 1e-3, rank, c))
+    scored.sort(key=lambda x: -x[0])
+    return [dict(c, refine_score=round(s, 4)) for s, _, c in scored]
+
+
+def candidates_for_store(hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """保存する候補（本文は CONV_CANDIDATE_CHARS 文字まで）"""
+    cap = int(current_app.config.get("CONV_CANDIDATE_CHARS", 1500))
+    out = []
+    for h in hits:
+        c = {k: v for k, v in h.items() if k not in ("refine_score",)}
+        if isinstance(c.get("text"), str):
+            c["text"] = c["text"][:cap]
+        out.append(c)
+    return out
+
+
+# ===== 履歴 =====
+def history_text(state: Optional[Dict[str, Any]], budget_tokens: Optional[int] = None) -> str:
+    """直近の往復を新しい方から予算（近似トークン数）に収まるだけ並べる。収まらない回答は途中で切る"""
+    if not state or not state.get("turns"):
+        return ""
+    budget = int(budget_tokens if budget_tokens is not None else current_app.config.get("CONV_HISTORY_TOKENS", 600))
+    lines: List[str] = []
+    used = 0
+    for t in reversed(state["turns"]):
+        q, a = f"ユーザー: {t['q']}", f"アシスタント: {t['a']}"
+        cost = estimate_tokens(q) + estimate_tokens(a)
+        if used + cost > budget:
+            room = budget - used - estimate_tokens(q)
+            if room >= 32:
+                lines.append(f"{q}\n{a[:room]}…")
+            break
+        lines.append(f"{q}\n{a}")
+        used += cost
+    return "\n".join(reversed(lines))
+
+
+def record_turn(state: Optional[Dict[str, Any]], query: str, answer: str, mode: str,
+                retrieval: Optional[Dict[str, Any]], scope: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """1往復を追記した新しい状態（retrieval=None なら前回の候補を残し、使い回した回数を数える）"""
+    cfg = current_app.config
+    state = dict(state or {"created": int(time.time()), "turns": []})
+    turns = list(state.get("turns") or [])
+    turns.append({"q": query[:500], "a": (answer or "")[:int(cfg.get("CONV_ANSWER_CHARS", 400))], "mode": mode})
+    state["turns"] = turns[-int(cfg.get("CONV_MAX_TURNS", 8)):]
+    if retrieval is not None:
+        state["retrieval"] = retrieval
+    elif state.get("retrieval"):
+        prev = state["retrieval"]
+        state["retrieval"] = dict(prev, follow_ups=int(prev.get("follow_ups") or 0) + 1)
+    if scope is not None:
+        state["scope"] = scope
+    state["updated"] = int(time.time())
+    return state
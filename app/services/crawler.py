@@ -0,0 +1,420 @@
+# app/services/crawler.py
+"""
+信頼できる補助金サイト（CRAWL_SITES）を巡回して、Webモード用の別コレクション（WEB_INDEX_DIR）に取り込む。
+
+Webモードの回答はほとんどが決まった数サイト（厚労省・経産省・総務省・IT導入補助金など）から来るのに、
+質問のたびに SerpAPI とページ取得を払っている。巡回済みのページを先に引き、足りなければ従来どおりライブ検索する。
+
+  WEB_INDEX_DIR/
+    CURRENT, versions/, staging/ … INDEX_DIR と同じ配置（vectorstore の関数に base を渡して使う）
+    crawl_state.json              … URLごとの ETag / Last-Modified / 本文sha256 / タイトル / リンク
+    pages/<sha256>.txt            … 抽出済みの本文（304 のページはここから作り直す）
+
+- CRAWL_SITES は URL の前方一致（カンマ区切り）。起点もこの URL で、リンクはどれかに一致するものだけたどる
+- 前回の ETag / Last-Modified で条件付きGETし、304 なら取り直さない。本文が同じページは前回のベクトルを使い回す
+- 同じホストへは CRAWL_DELAY_SEC 空けて順番に取る。robots.txt の Disallow は守る（CRAWL_ROBOTS=0 で無視）
+- 何も変わっていなければインデックスは作り直さない。巡回は1度に1本だけ（crawl.lock）
+定期実行は scripts/crawl.py（--interval）か cron から。
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from flask import current_app
+
+from .admission import Overloaded
+from .chunker import chunker_config, split_text
+from .dedup import collapse, dedup_config
+from .lazy import lazy_import
+from .llm_utils import embed_texts
+from .vectorstore import (active_index_dir, catalog_save, embed_queries, embed_request_dim, faiss_exists,
+                          faiss_save, index_version, ingest_signature, new_staging_dir, promote_index,
+                          reusable_vectors, search_vectors_multi)
+from .web_extract import fetch_text
+
+try:
+    import fcntl  # POSIXのみ。Windowsではロックなし
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+np = lazy_import("numpy")
+requests = lazy_import("requests")
+
+# 本文を取り出せない形式はたどらない
+_SKIP_EXT = (".zip", ".lzh", ".xls", ".xlsx", ".doc", ".docx", ".ppt", ".pptx", ".csv",
+             ".jpg", ".jpeg", ".png", ".gif", ".svg", ".mp4", ".mp3", ".exe")
+
+
+class CrawlConflict(Exception):
+    """別の巡回が実行中"""
+
+
+def _base() -> str:
+    return current_app.config.get("WEB_INDEX_DIR") or "data/web_index"
+
+
+def sites() -> List[str]:
+    raw = current_app.config.get("CRAWL_SITES") or ""
+    return [s.strip() for s in raw.split(",") if s.strip()]
+
+
+def in_scope(url: str, prefixes: List[str]) -> bool:
+    """巡回対象か（どれかの前方一致に当たり、本文を取り出せる形式）"""
+    if url.lower().split("?")[0].endswith(_SKIP_EXT):
+        return False
+    return any(url.startswith(p) for p in prefixes)
+
+
+# ===== 巡回の状態 =====
+def _state_path() -> str:
+    return os.path.join(_base(), "crawl_state.json")
+
+
+def _page_path(sha: str) -> str:
+    return os.path.join(_base(), "pages", f"{sha}.txt")
+
+
+def load_state() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(_state_path(), "r", encoding="utf-8") as f:
+            return json.load(f).get("pages") or {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(pages: Dict[str, Dict[str, Any]]):
+    path = _state_path()
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"schema_version": 1, "pages": pages}, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _read_page(sha: str) -> Optional[str]:
+    try:
+        with open(_page_path(sha), "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_page(sha: str, text: str):
+    path = _page_path(sha)
+    if not os.path.exists(path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+def _acquire_lock() -> Optional[int]:
+    if fcntl is None:
+        return -1
+    fd = os.open(os.path.join(_base(), "crawl.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _release_lock(fd: int):
+    if fd is None or fd < 0:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+# ===== robots.txt・間隔 =====
+class _Robots:
+    """
+    ホストごとの robots.txt（User-agent: * と自分宛ての Disallow だけを見る簡易版）。
+    robots.txt の取得もページと同じ User-Agent・同じホスト間隔（last / delay）で行う
+    """
+    def __init__(self, agent: str, timeout: float, delay: float, last: Dict[str, float]):
+        self.header = agent
+        self.agent = agent.split("/")[0].lower()
+        self.timeout = timeout
+        self.delay = delay
+        self.last = last
+        self.rules: Dict[str, List[str]] = {}
+
+    def _load(self, origin: str) -> List[str]:
+        url = origin + "/robots.txt"
+        _polite_wait(self.last, url, self.delay)
+        try:
+            r = requests.get(url, timeout=self.timeout, headers={"User-Agent": self.header})
+            text = r.text if r.status_code == 200 else ""
+        except requests.RequestException:
+            text = ""
+        return self.parse(text)
+
+    def parse(self, text: str) -> List[str]:
+        """
+        自分に当てはまるグループの Disallow。グループは続けて並んだ User-agent 行とその後の規則行で、
+        User-agent のどれか（* か自分）に当たれば当てはまる
+        """
+        rules: List[str] = []
+        applies = False
+        in_agents = False
+        for line in text.splitlines():
+            key, _, value = line.split("#", 1)[0].partition(":")
+            key, value = key.strip().lower(), value.strip()
+            if not key:
+                continue
+            if key == "user-agent":
+                if not in_agents:  # 規則行の後の User-agent は新しいグループ
+                    applies, in_agents = False, True
+                applies = applies or value == "*" or value.lower() == self.agent
+                continue
+            in_agents = False
+            if key == "disallow" and applies and value:
+                rules.append(value)
+        return rules
+
+    def allowed(self, url: str) -> bool:
+        p = urlparse(url)
+        origin = f"{p.scheme}://{p.netloc}"
+        if origin not in self.rules:
+            self.rules[origin] = self._load(origin)
+        path = p.path or "/"
+        return not any(path.startswith(rule) for rule in self.rules[origin])
+
+
+def _polite_wait(last: Dict[str, float], url: str, delay: float):
+    host = urlparse(url).netloc
+    wait = last.get(host, 0.0) + delay - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    last[host] = time.monotonic()
+
+
+# ===== 巡回 =====
+def _fetch(url: str, headers: Dict[str, str], timeout: float) -> Tuple[str, Dict[str, Any]]:
+    while True:
+        try:
+            return fetch_text(url, timeout=timeout, headers=headers, links=True)
+        except Overloaded:
+            time.sleep(1.0)  # 検索側でページ取得が混んでいる間は待つ（巡回は急がない）
+
+
+def crawl(progress: Optional[Callable[[str, int, int], None]] = None) -> Dict[str, Any]:
+    """
+    CRAWL_SITES を巡回し、変わったページがあれば WEB_INDEX_DIR のインデックスを作り直す。
+    戻り値（ログ・scripts/crawl.py の出力用）:
+      {"pages","fetched","not_modified","new","changed","removed","errors","rebuilt","ms", ...}
+    """
+    t0 = time.perf_counter()
+    prefixes = sites()
+    if not prefixes:
+        raise RuntimeError("CRAWL_SITES が未設定です（巡回するURLの前方一致をカンマ区切りで指定）。")
+    os.makedirs(os.path.join(_base(), "pages"), exist_ok=True)
+    fd = _acquire_lock()
+    if fd is None:
+        raise CrawlConflict("別の巡回が実行中です")
+    try:
+        report = _crawl(prefixes, progress)
+    finally:
+        _release_lock(fd)
+    report["ms"] = int((time.perf_counter() - t0) * 1000)
+    current_app.logger.info("crawl.done", extra={"trace": {"schema_version": 1, **report}})
+    return report
+
+
+def _crawl(prefixes: List[str], progress: Optional[Callable[[str, int, int], None]]) -> Dict[str, Any]:
+    cfg = current_app.config
+    max_pages = int(cfg.get("CRAWL_MAX_PAGES", 300))
+    max_depth = int(cfg.get("CRAWL_MAX_DEPTH", 2))
+    delay = float(cfg.get("CRAWL_DELAY_SEC", 1.0))
+    timeout = float(cfg.get("CRAWL_TIMEOUT", 15))
+    agent = cfg.get("CRAWL_USER_AGENT") or "subsidy-rag-crawler/1.0"
+    last: Dict[str, float] = {}
+    robots = _Robots(agent, timeout, delay, last) if cfg.get("CRAWL_ROBOTS", True) else None
+
+    old = load_state()
+    pages: Dict[str, Dict[str, Any]] = {}
+    counts = {"fetched": 0, "not_modified": 0, "new": 0, "changed": 0, "errors": 0, "robots_skipped": 0}
+    queue = deque((p, 0) for p in prefixes)
+    seen = set(prefixes)
+    while queue and len(pages) < max_pages:
+        url, depth = queue.popleft()
+        if progress:
+            progress("crawl", len(pages), min(max_pages, len(pages) + len(queue) + 1))
+        if robots is not None and not robots.allowed(url):
+            counts["robots_skipped"] += 1
+            continue
+        prev = old.get(url)
+        headers = {"User-Agent": agent}
+        if prev and os.path.exists(_page_path(prev["sha256"])):
+            if prev.get("etag"):
+                headers["If-None-Match"] = prev["etag"]
+            if prev.get("last_modified"):
+                headers["If-Modified-Since"] = prev["last_modified"]
+        _polite_wait(last, url, delay)
+        text, info = _fetch(url, headers, timeout)
+        now = int(time.time())
+
+        if info.get("not_modified"):
+            entry = dict(prev, checked_at=now)
+            counts["not_modified"] += 1
+        elif text:
+            sha = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            _write_page(sha, text)
+            entry = {"sha256": sha, "title": info.get("title") or (prev or {}).get("title") or "",
+                     "etag": info.get("etag"), "last_modified": info.get("last_modified"),
+                     "links": info.get("links") or [], "kind": info.get("kind"),
+                     "fetched_at": now, "checked_at": now}
+            counts["fetched"] += 1
+            if prev is None:
+                counts["new"] += 1
+            elif prev["sha256"] != sha:
+                counts["changed"] += 1
+        elif prev and info.get("status") not in (404, 410):
+            entry = prev  # 一時的な失敗は前回の本文のまま残す
+            counts["errors"] += 1
+        else:
+            if info.get("status") not in (404, 410):
+                counts["errors"] += 1
+            continue
+        pages[url] = entry
+
+        if depth < max_depth:
+            for link in entry.get("links") or []:
+                if link not in seen and in_scope(link, prefixes):
+                    seen.add(link)
+                    queue.append((link, depth + 1))
+
+    removed = sorted(set(old) - set(pages))
+    report: Dict[str, Any] = {"pages": len(pages), **counts, "removed": len(removed), "rebuilt": False}
+    unchanged = {u: e["sha256"] for u, e in pages.items()} == {u: e["sha256"] for u, e in old.items()}
+    if pages and not (unchanged and web_index_exists()):
+        report.update(_rebuild(pages, progress))
+        report["rebuilt"] = True
+    _save_state(pages)
+    _prune_pages(pages)
+    return report
+
+
+def _rebuild(pages: Dict[str, Dict[str, Any]], progress: Optional[Callable[[str, int, int], None]]) -> Dict[str, Any]:
+    """巡回済みページから WEB_INDEX_DIR のインデックスを作り直す（本文が同じページは前回のベクトルを使う）"""
+    ccfg, dcfg = chunker_config(), dedup_config()
+    texts: List[str] = []
+    metas: List[Dict] = []
+    catalog: List[Dict] = []
+    for url in sorted(pages):
+        entry = pages[url]
+        body = _read_page(entry["sha256"]) or ""
+        chunks = split_text(body, cfg=ccfg)
+        name = entry.get("title") or url
+        cmetas = [{"doc": name, "path": url, "chunk_id": i, "total_pages": None} for i in range(len(chunks))]
+        chunks, cmetas, removed = collapse(chunks, cmetas, dcfg)
+        if not chunks:
+            continue
+        texts.extend(chunks)
+        metas.extend(cmetas)
+        catalog.append({"name": name, "path": url, "chunks": len(chunks), "dup_chunks": removed["removed"],
+                        "dup_tokens": removed["tokens"], "pages": None, "size": len(body.encode("utf-8")),
+                        "sha256": entry["sha256"], "ingested_at": entry.get("fetched_at")})
+    if not texts:
+        return {"chunks": 0, "embedded_chunks": 0, "reused_chunks": 0}
+
+    base = _base()
+    reuse = reusable_vectors(ingest_signature(), root=active_index_dir(base))
+    vecs: List = [None] * len(texts)
+    todo: List[int] = []
+    start = 0
+    for entry in catalog:
+        n = entry["chunks"]
+        hit = reuse.get(entry["sha256"])
+        if hit is not None and len(hit[1]) == n:
+            full, rows = hit
+            vecs[start:start + n] = list(np.asarray(full[rows], dtype="float32"))
+        else:
+            todo.extend(range(start, start + n))
+        start += n
+
+    model = current_app.config["EMBED_MODEL"]
+    batch = int(current_app.config.get("EMBED_BATCH", 256))
+    for b in range(0, len(todo), batch):
+        if progress:
+            progress("embed", b, len(todo))
+        ids = todo[b:b + batch]
+        while True:
+            try:
+                embs = embed_texts([texts[i] for i in ids], model=model, dimensions=embed_request_dim())
+                break
+            except Overloaded:
+                time.sleep(1.0)
+        for i, e in zip(ids, embs):
+            vecs[i] = e
+
+    staging = new_staging_dir(f"crawl-{os.getpid()}-{int(time.time())}", base=base)
+    try:
+        catalog_save(catalog, root=staging)
+        faiss_save(np.asarray(vecs, dtype="float32"), metas, root=staging, texts=texts)
+        version = promote_index(staging, base=base)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return {"chunks": len(texts), "embedded_chunks": len(todo), "reused_chunks": len(texts) - len(todo),
+            "version": version}
+
+
+def _prune_pages(pages: Dict[str, Dict[str, Any]]):
+    keep = {f"{e['sha256']}.txt" for e in pages.values()}
+    pdir = os.path.join(_base(), "pages")
+    for name in os.listdir(pdir):
+        if name.endswith(".txt") and name not in keep:
+            try:
+                os.remove(os.path.join(pdir, name))
+            except OSError:
+                pass
+
+
+# ===== 検索（Webモードの一次情報源） =====
+def web_index_exists() -> bool:
+    return faiss_exists(active_index_dir(_base()))
+
+
+def lookup(query: str, top_k: int) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    巡回済みページを検索し、URLごとにまとめた上位 top_k 件を返す（"text" はそのURLのヒットしたチャンクを連結）。
+    info["hit"] は最上位のスコアが WEB_LOCAL_MIN_SCORE 以上か（False ならライブ検索に回す）
+    戻り値: ([{"title","url","score","snippet","text"}], {"hit","top_score","min_score","ms","version"?,"error"?})
+    """
+    t = time.perf_counter()
+    min_score = float(current_app.config.get("WEB_LOCAL_MIN_SCORE", 0.45))
+    info: Dict[str, Any] = {"hit": False, "top_score": None, "min_score": min_score}
+    root = active_index_dir(_base())
+    if not faiss_exists(root):
+        info.update({"error": "no_index", "ms": 0})
+        return [], info
+    try:
+        hits = search_vectors_multi(root, embed_queries([query]), top_k * 3, with_text=True)[0]
+    except RuntimeError as e:  # 埋め込み設定の変更など。巡回し直すまではライブ検索で答える
+        info.update({"error": str(e), "ms": int((time.perf_counter() - t) * 1000)})
+        return [], info
+
+    by_url: Dict[str, Dict[str, Any]] = {}
+    for h in hits:
+        r = by_url.get(h["path"])
+        if r is None:
+            r = by_url[h["path"]] = {"title": h.get("doc"), "url": h["path"], "score": round(h["score"], 4),
+                                     "snippet": (h.get("text") or "")[:240], "_texts": []}
+        r["_texts"].append(h.get("text") or "")
+    results = []
+    for r in list(by_url.values())[:top_k]:
+        r["text"] = "\n".join(r.pop("_texts"))
+        results.append(r)
+    top = results[0]["score"] if results else None
+    info.update({"hit": top is not None and top >= min_score, "top_score": top,
+                 "version": index_version(root), "ms": int((time.perf_counter() - t) * 1000)})
+    return results, info
@@ -0,0 +1,112 @@
+# app/services/deadline.py
+"""
+リクエストごとの締め切り（deadline）。
+
+- /api/ask の deadline_ms（無ければ REQUEST_DEADLINE_MS。0 なら無制限）から締め切り時刻を決めて g に置く
+- 外部呼び出し（LLM・SerpAPI・ページ取得・依存の待ち行列）は timeout() で残り時間に収まるタイムアウトを使う。
+  打ち切りは各呼び出しのタイムアウトで行うので、締め切りを過ぎた呼び出しが裏で走り続けることはない
+- 任意の段（LLM検証・hybrid の再要約・遅いWebソース）は allow() で残り時間を確かめ、足りなければ飛ばして skipped() に残す
+- 必須の段で締め切りを過ぎたら DeadlineExceeded（rag.answer が締め切り超過の回答にする）
+締め切りは g に持つので、リクエスト（アプリコンテキスト）の外では常に「無制限」。
+"""
+import time
+from typing import Any, Dict, List, Optional
+
+from flask import current_app, g, has_app_context
+
+
+class DeadlineExceeded(Exception):
+    """締め切りまでに必須の段が終わらない"""
+    def __init__(self, stage: str, budget_ms: int):
+        super().__init__(f"時間内に回答を作成できませんでした（{stage}、上限 {budget_ms}ms）。")
+        self.stage = stage
+        self.budget_ms = budget_ms
+
+
+def _state() -> Optional[Dict[str, Any]]:
+    return g.get("deadline") if has_app_context() else None
+
+
+def start(budget_ms: Optional[int] = None) -> Optional[int]:
+    """
+    締め切りを設定する（budget_ms を省略すると REQUEST_DEADLINE_MS。0 以下なら無制限）。
+    REQUEST_DEADLINE_MAX_MS より長い指定は切り詰める。REQUEST_DEADLINE_MS を設定しているときは
+    budget_ms=0 でも無制限にはせず上限（無ければ既定値）にする。戻り値は採用した ms（無制限なら None）
+    """
+    cfg = current_app.config
+    default = int(cfg.get("REQUEST_DEADLINE_MS", 0) or 0)
+    ms = int(budget_ms) if budget_ms is not None else default
+    cap = int(cfg.get("REQUEST_DEADLINE_MAX_MS", 0) or 0)
+    if ms <= 0 and default > 0:
+        ms = cap or default
+    if cap > 0 and ms > cap:
+        ms = cap
+    if ms <= 0:
+        g.deadline = None
+        return None
+    g.deadline = {"at": time.monotonic() + ms / 1000.0, "budget_ms": ms, "skipped": []}
+    return ms
+
+
+def ensure() -> Optional[int]:
+    """まだ締め切りが無ければ既定値で始める（API 以外から rag.answer を呼ぶ場合）"""
+    if has_app_context() and "deadline" not in g:
+        return start()
+    return budget_ms()
+
+
+def budget_ms() -> Optional[int]:
+    st = _state()
+    return st["budget_ms"] if st else None
+
+
+def remaining() -> Optional[float]:
+    """残り秒（締め切りが無ければ None）"""
+    st = _state()
+    return None if st is None else st["at"] - time.monotonic()
+
+
+def check(stage: str):
+    """締め切りを過ぎていれば DeadlineExceeded"""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(stage, budget_ms())
+
+
+def timeout(stage: str, default: float, reserve: float = 0.0) -> float:
+    """
+    この段で使うタイムアウト秒（default と「残り − reserve」の小さい方）。
+    reserve は後ろの必須の段のために残しておく秒。使える時間が無ければ DeadlineExceeded
+    """
+    left = remaining()
+    if left is None:
+        return default
+    left -= reserve
+    if left <= 0:
+        raise DeadlineExceeded(stage, budget_ms())
+    return min(default, left) if default else left
+
+
+def allow(step: str, need_ms: int, **detail: Any) -> bool:
+    """任意の段を実行してよいか（残りが need_ms 未満なら飛ばしたことを detail と一緒に記録して False）"""
+    left = remaining()
+    if left is None or left * 1000 >= need_ms:
+        return True
+    skip(step, int(max(0.0, left) * 1000), **detail)
+    return False
+
+
+def skip(step: str, remaining_ms: Optional[int] = None, **detail: Any):
+    """飛ばした段を記録する（回答の meta.skipped と trace に出る）"""
+    st = _state()
+    if st is None:
+        return
+    if remaining_ms is None:
+        left = remaining()
+        remaining_ms = int(max(0.0, left) * 1000) if left is not None else None
+    st["skipped"].append({"step": step, "remaining_ms": remaining_ms, **detail})
+
+
+def skipped() -> List[Dict[str, Any]]:
+    st = _state()
+    return list(st["skipped"]) if st else []
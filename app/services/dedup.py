@@ -0,0 +1,114 @@
+# app/services/dedup.py
+"""
+取り込み時の近似重複チャンクの除去（MinHash + LSH）。
+
+官公庁のPDFはヘッダ・フッタ・目次・注意書きが毎ページ同じ文面で入るので、
+そのまま埋め込むと同じ内容のベクトルが何十本も入り、上位k件が同じ文面で埋まる。
+文書ごとに、文字5-gram の MinHash の推定 Jaccard 係数が DEDUP_THRESHOLD 以上のチャンクを
+先に出てきた代表チャンク1つにまとめる。代表のメタには重複元（ページ・チャンク番号）を "dups" として持たせる。
+DEDUP_ENABLED=1 のときだけ行う（既定は無効）。
+
+  LSH: 署名を DEDUP_NUM_PERM/8 本の帯（8行ずつ）に分け、どれかの帯が一致した代表とだけ比べる
+  連鎖（A≒B, B≒C で A と C が離れていく）を避けるため、比べる相手は代表チャンクだけ
+"""
+import re
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import current_app
+
+from .chunker import estimate_tokens
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+
+_SHINGLE = 5
+_ROWS_PER_BAND = 8
+_PRIME = (1 << 61) - 1
+_SPACE_RE = re.compile(r"\s+")
+_params: Dict[int, Tuple[Any, Any]] = {}
+
+
+def dedup_config() -> Optional[Dict[str, Any]]:
+    """現在の重複除去設定（無効なら None。ingest_signature にも入れる）"""
+    if not current_app.config.get("DEDUP_ENABLED", False):
+        return None
+    return {"method": "minhash", "shingle": _SHINGLE,
+            "threshold": float(current_app.config.get("DEDUP_THRESHOLD", 0.9)),
+            "num_perm": int(current_app.config.get("DEDUP_NUM_PERM", 64))}
+
+
+def _perm(num_perm: int):
+    # 取り込みのたびに同じ署名になるよう乱数の種は固定
+    if num_perm not in _params:
+        rng = np.random.default_rng(20240601)
+        _params[num_perm] = (rng.integers(1, 1 << 32, num_perm, dtype=np.uint64),
+                             rng.integers(0, 1 << 32, num_perm, dtype=np.uint64))
+    return _params[num_perm]
+
+
+def _shingles(text: str) -> "np.ndarray":
+    s = _SPACE_RE.sub(" ", text).strip()
+    grams = {s[i:i + _SHINGLE] for i in range(max(1, len(s) - _SHINGLE + 1))}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def signature(text: str, num_perm: int = 64) -> "np.ndarray":
+    """MinHash 署名（num_perm 個の uint64）"""
+    a, b = _perm(num_perm)
+    h = _shingles(text)
+    # crc32 < 2^32、a < 2^32 なので積は uint64 に収まる
+    return ((np.outer(h, a) + b) % _PRIME).min(axis=0)
+
+
+def near_duplicates(texts: List[str], threshold: float = 0.9, num_perm: int = 64) -> List[int]:
+    """各チャンクの代表の添字（自分が代表なら自分）。代表は先に出てきたチャンク"""
+    bands = max(1, num_perm // _ROWS_PER_BAND)
+    rows = num_perm // bands
+    buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+    sigs: List[Any] = []
+    rep: List[int] = []
+    for i, text in enumerate(texts):
+        sig = signature(text, num_perm)
+        sigs.append(sig)
+        keys = [sig[j * rows:(j + 1) * rows].tobytes() for j in range(bands)]
+        cands = {c for j, key in enumerate(keys) for c in buckets[j].get(key, ())}
+        best, best_sim = i, threshold
+        for c in sorted(cands):
+            sim = float(np.mean(sigs[c] == sig))
+            if sim >= best_sim and (best == i or sim > best_sim):
+                best, best_sim = c, sim
+        rep.append(best)
+        if best == i:
+            for j, key in enumerate(keys):
+                buckets[j].setdefault(key, []).append(i)
+    return rep
+
+
+def collapse(texts: List[str], metas: List[Dict], cfg: Optional[Dict[str, Any]] = None
+             ) -> Tuple[List[str], List[Dict], Dict[str, int]]:
+    """
+    1文書分のチャンクから近似重複を除き、代表のメタに "dups"（[[ページ or None, チャンク番号], ...]）を付ける。
+    戻り値: (残したチャンク本文, メタ, {"removed": 除いた数, "tokens": 除いた分の近似トークン数})
+    """
+    cfg = cfg if cfg is not None else dedup_config()
+    if not cfg or len(texts) < 2:
+        return texts, metas, {"removed": 0, "tokens": 0}
+    rep = near_duplicates(texts, cfg["threshold"], cfg["num_perm"])
+    keep_texts: List[str] = []
+    keep_metas: List[Dict] = []
+    pos: Dict[int, int] = {}
+    removed = tokens = 0
+    for i, r in enumerate(rep):
+        if r == i:
+            pos[i] = len(keep_metas)
+            keep_texts.append(texts[i])
+            keep_metas.append(dict(metas[i]))
+            continue
+        m = metas[i]
+        cid = m.get("chunk_id")
+        chunk = int(str(cid).rsplit("-", 1)[-1]) if cid is not None else -1
+        keep_metas[pos[r]].setdefault("dups", []).append([m.get("page"), chunk])
+        removed += 1
+        tokens += estimate_tokens(texts[i])
+    return keep_texts, keep_metas, {"removed": removed, "tokens": tokens}
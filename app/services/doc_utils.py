@@ -1,9 +1,20 @@
 # app/services/pdf_utils.py
 import os
-from typing import List, Dict
+import json
+import time
+import shutil
+import hashlib
+import threading
+from typing import List, Dict, Tuple, Optional, Callable
 from flask import current_app
-from pypdf import PdfReader
+from .lazy import lazy_import
 from .llm_utils import embed_texts
+from .admission import Overloaded
+from .chunker import chunker_config, chunk_stats, split_text
+from .dedup import collapse, dedup_config
+from .pdf_cache import pdf_pages, pdf_page_count, prune as prune_pdf_cache
+
+np = lazy_import("numpy")
 
 
 # 許可するファイル形式を設定
@@ -16,9 +27,18 @@ def is_allowed_ext(filename: str) -> bool:
     return any(name.endswith(ext) for ext in ALLOWED_EXTS)
 
 # ===== 読み取り系 =====
-def _read_pdf(path: str) -> str:
-    reader = PdfReader(path)
-    return "\n".join((page.extract_text() or "") for page in reader.pages)
+def _read_pdf(path: str, limit: Optional[int] = None) -> str:
+    """PDF本文（抽出キャッシュ経由）。limit を渡すと足りるだけの先頭ページしか読まない"""
+    sha = cached_sha256(path)
+    if limit is None:
+        return "\n".join(pdf_pages(path, sha))
+    n = 2
+    while True:
+        pages = pdf_pages(path, sha, max_pages=n)
+        text = "\n".join(pages)
+        if len(text) >= limit or len(pages) < n:
+            return text
+        n *= 4
 
 def _read_txt(path: str) -> str:
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
@@ -38,7 +58,7 @@ def read_preview(path: str, limit: int = 3000) -> str:
     """
     low = path.lower()
     if low.endswith(".pdf"):
-        text = _read_pdf(path)
+        text = _read_pdf(path, limit)
     elif low.endswith((".md", ".markdown")):
         text = _read_md(path)
     else:
@@ -46,45 +66,41 @@ def read_preview(path: str, limit: int = 3000) -> str:
     return text[:limit]
 
 # ===== 分割・インデックス =====
-def _split(text: str, size: int = 800, overlap: int = 120) -> List[str]:
-    """
-    シンプルな固定長スライス（日本語の形態素分割は後で拡張でOK）
-    """
-    out, i = [], 0
-    n = len(text)
-    while i < n:
-        chunk = text[i:i + size].strip()
-        if chunk:
-            out.append(chunk)
-        i += size - overlap
-    return out
-
-def ingest_local_dir() -> int:
+def collect_chunks(pdf_dir: str, progress: Optional[Callable[[str, int, int], None]] = None,
+                   chunker: Optional[Dict] = None, dedup: Optional[Dict] = None
+                   ) -> Tuple[List[str], List[Dict], List[Dict]]:
     """
-    PDF_DIR を走査→ {pdf,txt,md,markdown} のみ取り込み →
-    （PDFはページ単位で）チャンク化→埋め込み→FAISS保存
+    pdf_dir を走査→ {pdf,txt,md,markdown} のみ読み込み →（PDFはページ単位で）チャンク化。
+    progress(phase, done, total) を渡すとファイルごとに呼ぶ（キャンセル時はそこで例外を投げてよい）。
+    chunker で分割設定を上書きできる（省略時は chunker_config()）。
+    文書内の近似重複チャンクは dedup.collapse で1つにまとめる（dedup で上書き。省略時は dedup_config()、{} で無効）。
+    戻り値: (チャンク本文, チャンクメタ, 文書カタログ)
     """
-    pdf_dir = current_app.config["PDF_DIR"]
-    os.makedirs(pdf_dir, exist_ok=True)
-
+    cfg = chunker or chunker_config()
+    dcfg = dedup_config() if dedup is None else dedup
     texts: List[str] = []
     metas: List[Dict] = []
+    catalog: List[Dict] = []
 
-    for name in sorted(os.listdir(pdf_dir)):
+    seen_sha = set()
+    names = [n for n in sorted(os.listdir(pdf_dir))
+             if os.path.isfile(os.path.join(pdf_dir, n)) and is_allowed_ext(n)]
+    for i_file, name in enumerate(names):
+        if progress:
+            progress("read", i_file, len(names))
         path = os.path.join(pdf_dir, name)
-        if not os.path.isfile(path):
-            continue
-        if not is_allowed_ext(name):
-            continue
 
+        n_before = len(texts)
+        total_pages = None
+        sha = cached_sha256(path, persist=False)
+        seen_sha.add(sha)
         low = name.lower()
         if low.endswith(".pdf"):
             # --- PDFはページごとに処理して page / total_pages をメタへ入れる ---
-            reader = PdfReader(path)
-            total_pages = len(reader.pages)
-            for page_no, page in enumerate(reader.pages, start=1):  # 1始まり（UIに優しい）
-                page_text = page.extract_text() or ""
-                for j, chunk in enumerate(_split(page_text)):
+            pages = pdf_pages(path, sha)
+            total_pages = len(pages)
+            for page_no, page_text in enumerate(pages, start=1):  # 1始まり（UIに優しい）
+                for j, chunk in enumerate(split_text(page_text, cfg=cfg)):
                     texts.append(chunk)
                     metas.append({
                         "doc": name,
@@ -95,7 +111,7 @@ def ingest_local_dir() -> int:
                     })
         elif low.endswith((".md", ".markdown")):
             raw = _read_md(path)
-            for i, chunk in enumerate(_split(raw)):
+            for i, chunk in enumerate(split_text(raw, markdown=True, cfg=cfg)):
                 texts.append(chunk)
                 metas.append({
                     "doc": name, "path": path, "chunk_id": i,
@@ -104,28 +120,202 @@ def ingest_local_dir() -> int:
                 })
         else:
             raw = _read_txt(path)
-            for i, chunk in enumerate(_split(raw)):
+            for i, chunk in enumerate(split_text(raw, cfg=cfg)):
                 texts.append(chunk)
                 metas.append({
                     "doc": name, "path": path, "chunk_id": i,
                     "total_pages": None,
                 })
 
+        # ヘッダ・フッタなど同じ文面の繰り返しは代表チャンク1つにまとめる（埋め込む前に減らす）
+        texts[n_before:], metas[n_before:], removed = collapse(texts[n_before:], metas[n_before:], dcfg)
+
+        # 一覧表示用のカタログ（画面表示時に meta や PDF を読み直さないため）
+        if len(texts) > n_before:
+            catalog.append({
+                "name": name,
+                "path": path,
+                "chunks": len(texts) - n_before,
+                "dup_chunks": removed["removed"],
+                "dup_tokens": removed["tokens"],
+                "pages": total_pages,
+                "size": os.path.getsize(path),
+                "sha256": sha,
+                "ingested_at": int(time.time()),
+            })
+
+    with _hash_lock:
+        _save_hash_cache()
+    prune_pdf_cache(seen_sha)
+    return texts, metas, catalog
+
+def ingest_local_dir(progress: Optional[Callable[[str, int, int], None]] = None,
+                     name: Optional[str] = None, stats: Optional[Dict] = None,
+                     rebuild_shards: Optional[List[int]] = None) -> int:
+    """
+    PDF_DIR を走査→ {pdf,txt,md,markdown} のみ取り込み →
+    （PDFはページ単位で）チャンク化→埋め込み→FAISS保存。
+    内容(sha256)が前回と同じファイルは稼働中インデックスのベクトルを再利用し、変わった分だけ埋め込む。
+    INDEX_SHARDS > 1 ならシャードごとに保存し、文書一覧が前回と同じシャードは作り直さずに引き継ぐ。
+    rebuild_shards に指定したシャードはベクトルも再利用せずに作り直す（非シャード版は [0] で全体）。
+    新しいインデックスは staging に作り、完成後に稼働版と差し替える（作成中も旧版で検索できる）。
+    stats を渡すと embedded_chunks / reused_chunks とチャンク分布（chunking）、
+    近似重複の除去で減らしたベクトル数・埋め込みトークン数（dedup）を書き込む。
+    """
+    from .vectorstore import (faiss_save, catalog_save, embed_request_dim, new_staging_dir,
+                              promote_index, ingest_signature, reusable_vectors)
+    from .shards import check_shard_config, reusable_shards, save_shards, shard_of
+
+    n_shards = max(1, int(current_app.config.get("INDEX_SHARDS", 1)))
+    check_shard_config(n_shards)
+
+    pdf_dir = current_app.config["PDF_DIR"]
+    os.makedirs(pdf_dir, exist_ok=True)
+
+    texts, metas, catalog = collect_chunks(pdf_dir, progress=progress)
     if not texts:
         return 0
 
-    vecs = embed_texts(texts, model=current_app.config["EMBED_MODEL"])
-    from .vectorstore import faiss_save
-    faiss_save(vecs, metas)
+    rebuild = set(rebuild_shards or ())
+    keep = reusable_shards(catalog, n_shards, rebuild) if n_shards > 1 else set()
+
+    # 前回と同じ内容のファイルはベクトルを流用（引き継ぐシャードの分はベクトル自体が要らない）
+    reuse = reusable_vectors(ingest_signature())
+    vecs: List = [None] * len(texts)
+    todo: List[int] = []
+    start = 0
+    for entry in catalog:
+        n = entry["chunks"]
+        shard = shard_of(entry["sha256"], n_shards)
+        hit = None if shard in rebuild else reuse.get(entry["sha256"])
+        if shard in keep:
+            pass
+        elif hit is not None and len(hit[1]) == n:
+            full, rows = hit
+            vecs[start:start + n] = list(np.asarray(full[rows], dtype="float32"))
+        else:
+            todo.extend(range(start, start + n))
+        start += n
+
+    # 埋め込みはバッチ単位（進捗・キャンセルの区切りにもなる）
+    model = current_app.config["EMBED_MODEL"]
+    batch = int(current_app.config.get("EMBED_BATCH", 256))
+    for b in range(0, len(todo), batch):
+        if progress:
+            progress("embed", b, len(todo))
+        ids = todo[b:b + batch]
+        while True:
+            try:
+                embs = embed_texts([texts[i] for i in ids], model=model, dimensions=embed_request_dim())
+                break
+            except Overloaded:
+                # 検索側で埋め込みが混んでいる間は待って同じバッチをやり直す（取り込みは失敗させない）
+                if progress:
+                    progress("embed", b, len(todo))
+                time.sleep(1.0)
+        for i, e in zip(ids, embs):
+            vecs[i] = e
+    if stats is not None:
+        stats.update({"embedded_chunks": len(todo), "reused_chunks": len(texts) - len(todo),
+                      "chunking": {"chunker": chunker_config(), **chunk_stats(texts)},
+                      "dedup": {"config": dedup_config(),
+                                "vectors_saved": sum(e.get("dup_chunks", 0) for e in catalog),
+                                "tokens_saved": sum(e.get("dup_tokens", 0) for e in catalog)}})
+        if n_shards > 1:
+            stats["shards"] = {"count": n_shards, "kept": sorted(keep),
+                               "rebuilt": sorted(set(range(n_shards)) - keep)}
+
+    if progress:
+        progress("save", 0, 1)
+    staging = new_staging_dir(name or f"sync-{os.getpid()}-{int(time.time())}")
+    try:
+        catalog_save(catalog, root=staging)
+        if n_shards > 1:
+            save_shards(staging, n_shards, vecs, metas, texts, catalog, keep)
+        else:
+            faiss_save(np.asarray(vecs, dtype="float32"), metas, root=staging, texts=texts)
+        promote_index(staging)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if progress:
+        progress("done", 1, 1)
     # 取り込んだファイル数（doc単位のユニーク数）
     return len(set(m["doc"] for m in metas))
 
 
+def file_sha256(path: str, bufsize: int = 1 << 20) -> str:
+    """ファイル内容の SHA-256（大きいファイルも分割読み）"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(bufsize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# ===== ハッシュのキャッシュ（サイズと更新時刻が同じなら読み直さない） =====
+_hash_cache: Dict[str, Tuple[int, int, str]] = {}
+_hash_lock = threading.Lock()
+
+def _hash_cache_path() -> str:
+    return os.path.join(current_app.config["INDEX_DIR"], "file_hashes.json")
+
+def _load_hash_cache():
+    if _hash_cache:
+        return
+    try:
+        with open(_hash_cache_path(), "r", encoding="utf-8") as f:
+            for path, (size, mtime_ns, sha) in json.load(f).items():
+                _hash_cache[path] = (size, mtime_ns, sha)
+    except (OSError, ValueError):
+        pass
+
+def _save_hash_cache():
+    path = _hash_cache_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_hash_cache, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def cached_sha256(path: str, persist: bool = True) -> str:
+    """file_sha256 のキャッシュ版（キー: パス、検証: サイズ＋mtime_ns）"""
+    st = os.stat(path)
+    with _hash_lock:
+        _load_hash_cache()
+        hit = _hash_cache.get(path)
+        if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+            return hit[2]
+    sha = file_sha256(path)
+    with _hash_lock:
+        _hash_cache[path] = (st.st_size, st.st_mtime_ns, sha)
+        if persist:
+            _save_hash_cache()
+    return sha
+
+def remember_sha256(path: str, sha: str):
+    """保存時に計算済みのハッシュを登録（アップロード直後に読み直さないため）"""
+    st = os.stat(path)
+    with _hash_lock:
+        _load_hash_cache()
+        _hash_cache[path] = (st.st_size, st.st_mtime_ns, sha)
+        _save_hash_cache()
+
+def dir_hashes(dir_path: str) -> Dict[str, str]:
+    """ディレクトリ内の取り込み対象ファイルの {sha256: ファイル名}"""
+    out: Dict[str, str] = {}
+    for name in sorted(os.listdir(dir_path)):
+        path = os.path.join(dir_path, name)
+        if os.path.isfile(path) and is_allowed_ext(name):
+            out.setdefault(cached_sha256(path, persist=False), name)
+    with _hash_lock:
+        _save_hash_cache()
+    return out
+
+
 def page_count_pdf(path: str) -> int:
-    """PDFのページ数を返す。失敗時は0"""
+    """PDFのページ数を返す（抽出キャッシュがあれば解析しない）。失敗時は0"""
     try:
-        reader = PdfReader(path)
-        return len(reader.pages)
+        return pdf_page_count(path, cached_sha256(path))
     except Exception as e:
         print(f"Error reading {path}: {e}")
         return 0
\ No newline at end of file
@@ -0,0 +1,228 @@
+# app/services/jobs.py
+"""
+再インデックスのバックグラウンドジョブ。
+- 状態は INDEX_DIR/jobs/<id>.json に書くので、どの gunicorn ワーカーからでも参照できる
+- キャンセルは <id>.cancel ファイル（実行中ワーカーが各ステップで確認）
+- 同時に走る取り込みは1本だけ（ingest.lock を flock）
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from typing import Any, Dict, List, Optional
+
+from flask import current_app
+
+try:
+    import fcntl  # POSIXのみ。Windowsではプロセス内ロックのみ
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobConflict(Exception):
+    """別の取り込みジョブが実行中"""
+    def __init__(self, running_id: str):
+        super().__init__(f"取り込みジョブ {running_id} が実行中です")
+        self.running_id = running_id
+
+
+class Job:
+    def __init__(self, jobs_dir: str, kind: str = "ingest"):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.status = "queued"  # queued / running / succeeded / failed / cancelled
+        self.progress: Dict[str, Any] = {"phase": "queued", "done": 0, "total": 0}
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._dir = jobs_dir
+        self._cancel = threading.Event()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id, "kind": self.kind, "status": self.status, "progress": dict(self.progress),
+            "result": self.result, "error": self.error, "created_at": self.created_at,
+            "started_at": self.started_at, "finished_at": self.finished_at,
+        }
+
+    def save(self):
+        path = os.path.join(self._dir, f"{self.id}.json")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set() or os.path.exists(os.path.join(self._dir, f"{self.id}.cancel"))
+
+    def step(self, phase: str, done: int, total: int):
+        """進捗を記録し、キャンセル要求があれば JobCancelled を投げる（取り込み処理から呼ぶ）"""
+        self.progress = {"phase": phase, "done": done, "total": total}
+        self.save()
+        if self.cancel_requested():
+            raise JobCancelled()
+
+
+_jobs: Dict[str, Job] = {}
+_lock = threading.Lock()
+_running: Optional[str] = None
+
+
+def _jobs_dir() -> str:
+    path = os.path.join(current_app.config["INDEX_DIR"], "jobs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _acquire_ingest_lock(jobs_dir: str) -> Optional[int]:
+    """取り込みロックを取る。取れなければ None（fcntl が無い環境ではダミーの -1）"""
+    if fcntl is None:
+        return -1
+    fd = os.open(os.path.join(jobs_dir, "ingest.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _release_ingest_lock(fd: int):
+    if fd is None or fd < 0:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _running_id(jobs_dir: str) -> str:
+    try:
+        with open(os.path.join(jobs_dir, "ingest.running"), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def request_ingest() -> Dict[str, Any]:
+    """
+    取り込みを依頼する（アップロード直後など）。実行中なら終了後にもう一度走らせる予約だけ残す。
+    戻り値: {"job_id": str, "queued": "started"|"pending"}
+    """
+    try:
+        return {"job_id": start_ingest_job().id, "queued": "started"}
+    except JobConflict as e:
+        running_id = e.running_id
+    pending = os.path.join(_jobs_dir(), "ingest.pending")
+    open(pending, "w").close()
+    # 予約を書く間に実行中ジョブが終わっていた場合に備えてもう一度だけ試す
+    try:
+        job = start_ingest_job()
+    except JobConflict:
+        return {"job_id": running_id, "queued": "pending"}
+    try:
+        os.unlink(pending)
+    except OSError:
+        pass
+    return {"job_id": job.id, "queued": "started"}
+
+
+def start_ingest_job(rebuild_shards: Optional[List[int]] = None) -> Job:
+    """取り込みをバックグラウンドで開始してジョブを返す。実行中なら JobConflict（rebuild_shards は ingest_local_dir へ）"""
+    global _running
+    from .doc_utils import ingest_local_dir
+
+    app = current_app._get_current_object()
+    jobs_dir = _jobs_dir()
+    with _lock:
+        if _running:
+            raise JobConflict(_running)
+        fd = _acquire_ingest_lock(jobs_dir)
+        if fd is None:
+            raise JobConflict(_running_id(jobs_dir))
+        job = Job(jobs_dir)
+        _jobs[job.id] = job
+        _running = job.id
+    with open(os.path.join(jobs_dir, "ingest.running"), "w", encoding="utf-8") as f:
+        f.write(job.id)
+    job.save()
+
+    def run():
+        global _running
+        with app.app_context():
+            job.status, job.started_at = "running", time.time()
+            job.save()
+            try:
+                stats: Dict[str, Any] = {}
+                n = ingest_local_dir(progress=job.step, name=job.id, stats=stats, rebuild_shards=rebuild_shards)
+                job.result = {"indexed_docs": n, **stats}
+                job.status = "succeeded"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.status, job.error = "failed", str(e)
+                app.logger.exception("ingest job failed", extra={"trace": {
+                    "schema_version": 1, "job_id": job.id, "error": str(e), "where": "ingest_job"}})
+            finally:
+                job.finished_at = time.time()
+                job.save()
+                with _lock:
+                    _running = None
+                    _prune_jobs(jobs_dir)
+                _release_ingest_lock(fd)
+                # 実行中に来た取り込み依頼があれば続けて実行
+                pending = os.path.join(jobs_dir, "ingest.pending")
+                if os.path.exists(pending):
+                    try:
+                        os.unlink(pending)
+                        start_ingest_job()
+                    except (OSError, JobConflict):
+                        pass
+
+    threading.Thread(target=run, name=f"ingest-{job.id}", daemon=True).start()
+    return job
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """ジョブ状態（別ワーカーで動いているジョブはファイルから読む）"""
+    job = _jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    try:
+        with open(os.path.join(_jobs_dir(), f"{os.path.basename(job_id)}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cancel_job(job_id: str) -> Optional[Dict[str, Any]]:
+    state = get_job(job_id)
+    if state is None:
+        return None
+    if state["status"] in ("queued", "running"):
+        job = _jobs.get(job_id)
+        if job is not None:
+            job._cancel.set()
+        # 別ワーカーで実行中の場合に備えてファイルでも通知
+        open(os.path.join(_jobs_dir(), f"{os.path.basename(job_id)}.cancel"), "w").close()
+    return state
+
+
+def _prune_jobs(jobs_dir: str, keep: int = 20):
+    """終了済みジョブの記録を新しい順に keep 件だけ残す"""
+    for job_id in [k for k, j in _jobs.items() if j.status not in ("queued", "running")][:-keep]:
+        _jobs.pop(job_id, None)
+    files = sorted((e for e in os.scandir(jobs_dir) if e.name.endswith((".json", ".cancel"))),
+                   key=lambda e: e.stat().st_mtime)
+    for e in files[:-keep * 2]:
+        try:
+            os.unlink(e.path)
+        except OSError:
+            pass
@@ -0,0 +1,58 @@
+# app/services/lazy.py
+"""
+重い依存（faiss / numpy / openai / requests / bs4 / pypdf / serpapi）の遅延 import。
+
+  np = lazy_import("numpy")   # ここでは読み込まない。np.xxx に最初に触れた時点で本当に import される
+
+起動（create_app）ではモジュールの枠だけ作り、実際の読み込みは最初に使うリクエストか warm-up（warmup.py）で行う。
+型注釈で触れると import 時に読み込まれてしまうので、使う側は from __future__ import annotations にする。
+"""
+import sys
+import types
+import importlib
+import importlib.util
+from typing import Dict
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """最初の属性アクセスで読み込むモジュール（importlib.util.LazyLoader）。既に読み込み済みならそれを返す"""
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return mod
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    loader.exec_module(mod)
+    return mod
+
+
+def is_loaded(name: str) -> bool:
+    """本当に読み込まれているか（遅延モジュールのままなら False）"""
+    mod = sys.modules.get(name)
+    return mod is not None and type(mod) is types.ModuleType
+
+
+def load(name: str) -> types.ModuleType:
+    """遅延モジュールをその場で読み込む（warm-up 用）"""
+    mod = importlib.import_module(name)
+    getattr(mod, "__name__")  # 遅延モジュールは属性アクセスで本体が実行される
+    return mod
+
+
+def load_all(names) -> Dict[str, int]:
+    """まとめて読み込み、モジュールごとの所要時間(ms)を返す（読み込み済みは 0）"""
+    import time
+    out: Dict[str, int] = {}
+    for name in names:
+        t = time.perf_counter()
+        try:
+            load(name)
+        except ImportError:
+            out[name] = -1
+            continue
+        out[name] = int((time.perf_counter() - t) * 1000)
+    return out
@@ -0,0 +1,134 @@
+# app/services/llm_cache.py
+"""
+決定的なチャット呼び出し（temperature 0）の応答キャッシュ。
+
+スコープ判定（in_scope_llm）・LLM検証（validate_answer_llm）・検索語の言い換えは
+温度0・固定のプロンプトなので、同じ入力なら同じ応答が返る。毎回APIを呼ばず SQLite に保存した応答を返す。
+
+- キーは モデル・messages・パラメータ（timeout など呼び出しごとの値は除く）の SHA-256
+- 保存から LLM_CACHE_TTL_SEC 過ぎたものは使わない。件数は LLM_CACHE_MAX_ENTRIES まで（最後に使った時刻が古い順に削除）
+- ファイルは gunicorn の全ワーカーで共有する（WAL）。キャッシュの失敗は握りつぶして API を呼ぶ
+- LLM_CACHE_ENABLED=1 のときだけ使う（既定は無効）
+このリクエストでの命中数・プロバイダ側のプロンプトキャッシュのトークン数は request_stats() で trace に出す。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import current_app, g, has_app_context, has_request_context
+
+_SCHEMA = 1
+_PRUNE_EVERY = 32  # 件数の上限は put 32回ごとにまとめて確かめる（超過は最大でこの程度）
+_local = threading.local()
+_puts = 0
+_puts_lock = threading.Lock()
+
+
+def cache_key(model: str, messages: List[Dict], params: Dict[str, Any]) -> str:
+    body = json.dumps({"v": _SCHEMA, "model": model, "messages": messages, "params": params},
+                      ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def _conn(path: str) -> sqlite3.Connection:
+    """スレッドごとの接続（初回にテーブルを作る）"""
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=2.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, model TEXT, text TEXT,"
+                     " meta TEXT, created REAL, used REAL, hits INTEGER DEFAULT 0)")
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_used ON llm_cache(used)")
+        conns[path] = conn
+    return conn
+
+
+def _warn(op: str, e: Exception):
+    if has_app_context():
+        current_app.logger.warning("llm_cache.error", extra={"trace": {"op": op, "error": repr(e)}})
+
+
+def get(path: str, key: str, ttl: float) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """保存済みの (text, meta)。無い・期限切れ・読めないときは None"""
+    try:
+        conn = _conn(path)
+        row = conn.execute("SELECT text, meta, created FROM llm_cache WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if ttl > 0 and now - row[2] > ttl:
+            conn.execute("DELETE FROM llm_cache WHERE key=?", (key,))
+            return None
+        conn.execute("UPDATE llm_cache SET used=?, hits=hits+1 WHERE key=?", (now, key))
+        return row[0], json.loads(row[1])
+    except (sqlite3.Error, ValueError) as e:
+        _warn("get", e)
+        return None
+
+
+def put(path: str, key: str, model: str, text: str, meta: Dict[str, Any], ttl: float, max_entries: int):
+    global _puts
+    try:
+        conn = _conn(path)
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO llm_cache (key, model, text, meta, created, used, hits)"
+                     " VALUES (?, ?, ?, ?, ?, ?, 0)",
+                     (key, model, text, json.dumps(meta, ensure_ascii=False, default=str), now, now))
+        with _puts_lock:
+            _puts += 1
+            prune = _puts % _PRUNE_EVERY == 1
+        if prune:
+            _prune(conn, now, ttl, max_entries)
+    except sqlite3.Error as e:
+        _warn("put", e)
+
+
+def _prune(conn: sqlite3.Connection, now: float, ttl: float, max_entries: int):
+    if ttl > 0:
+        conn.execute("DELETE FROM llm_cache WHERE created < ?", (now - ttl,))
+    if max_entries > 0:
+        over = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - max_entries
+        if over > 0:
+            conn.execute("DELETE FROM llm_cache WHERE key IN"
+                         " (SELECT key FROM llm_cache ORDER BY used LIMIT ?)", (over,))
+
+
+def clear(path: str) -> int:
+    """全件削除（プロンプトの大きな変更のあとなど）。消した件数を返す"""
+    conn = _conn(path)
+    n = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+    conn.execute("DELETE FROM llm_cache")
+    return n
+
+
+# ===== リクエスト単位の集計（trace 用） =====
+def record(usage: Optional[Dict[str, Any]], hit: Optional[bool]):
+    """1回のチャット呼び出しを集計に足す（hit: キャッシュ命中か。キャッシュ対象外なら None）"""
+    if not has_request_context():
+        return
+    st = g.get("llm_cache")
+    if st is None:
+        st = g.llm_cache = {"calls": 0, "hits": 0, "misses": 0, "cached_tokens": 0, "saved_tokens": 0}
+    st["calls"] += 1
+    usage = usage or {}
+    if hit:
+        st["hits"] += 1
+        st["saved_tokens"] += int(usage.get("saved_tokens") or 0)
+    else:
+        if hit is False:
+            st["misses"] += 1
+        st["cached_tokens"] += int(usage.get("cached_tokens") or 0)
+
+
+def request_stats() -> Optional[Dict[str, int]]:
+    """このリクエストのチャット呼び出しの集計（呼び出しが無ければ None）"""
+    return dict(g.llm_cache) if has_request_context() and g.get("llm_cache") else None
@@ -1,38 +1,259 @@
 # app/services/llm_utils.py
 import os
 import time
-from typing import List, Dict, Tuple, Any, Optional
-from openai import OpenAI
+import random
+import asyncio
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Tuple, Any, Optional, Callable
+from .admission import Limiter, acquire, aacquire
+from .deadline import DeadlineExceeded, budget_ms, remaining, timeout as deadline_timeout
+from .lazy import lazy_import
+from . import llm_cache
 
-_client_singleton: Optional[OpenAI] = None
+openai = lazy_import("openai")
 
-def get_client() -> OpenAI:
+_client_singleton: Optional["openai.OpenAI"] = None
+# 非同期クライアントはイベントループごと（httpx の接続はループに紐づくため。閉じたループの分は作るときに捨てる）
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, openai.AsyncOpenAI]" = weakref.WeakKeyDictionary()
+_client_lock = threading.Lock()
+
+# ===== 設定 =====
+def _cfg(name: str, default: Any) -> Any:
+    """Flaskのconfigがあれば優先し、無ければ環境変数→既定値の順で拾う"""
+    try:
+        from flask import current_app, has_app_context
+        if has_app_context():
+            return current_app.config.get(name, default)
+    except Exception:
+        pass
+    return os.getenv(name, default)
+
+def _client_kwargs(http_client_factory: Callable) -> Dict[str, Any]:
+    """同期/非同期クライアント共通の接続設定（タイムアウト・プール）"""
+    import httpx
+    key = os.getenv("OPENAI_API_KEY")
+    if not key:
+        raise RuntimeError("OPENAI_API_KEY が未設定です（.env を確認）")
+    timeout = httpx.Timeout(
+        float(_cfg("LLM_READ_TIMEOUT", 30.0)),
+        connect=float(_cfg("LLM_CONNECT_TIMEOUT", 3.0)),
+    )
+    limits = httpx.Limits(
+        max_connections=int(_cfg("LLM_POOL_MAXSIZE", 20)),
+        max_keepalive_connections=int(_cfg("LLM_POOL_KEEPALIVE", 10)),
+        keepalive_expiry=float(_cfg("LLM_KEEPALIVE_EXPIRY", 30.0)),
+    )
+    return {
+        "api_key": key,
+        "timeout": timeout,
+        # リトライは下の _call_with_policy で jitter 付きに統一するのでSDK側は0
+        "max_retries": 0,
+        "http_client": http_client_factory(timeout=timeout, limits=limits),
+    }
+
+def get_client() -> "openai.OpenAI":
     global _client_singleton
     if _client_singleton is None:
-        key = os.getenv("OPENAI_API_KEY")
-        if not key:
-            raise RuntimeError("OPENAI_API_KEY が未設定です（.env を確認）")
-        _client_singleton = OpenAI(api_key=key)  # envから拾う場合は OpenAI() でもOK
+        with _client_lock:
+            if _client_singleton is None:
+                _client_singleton = openai.OpenAI(**_client_kwargs(openai.DefaultHttpxClient))
     return _client_singleton
 
-# ====== 埋め込み ======
+def get_async_client() -> "openai.AsyncOpenAI":
+    """asyncio 用。実行中のイベントループごとに1つ作って使い回す（接続プールはループ単位で持つ）"""
+    loop = asyncio.get_running_loop()
+    cli = _async_clients.get(loop)
+    if cli is None:
+        with _client_lock:
+            cli = _async_clients.get(loop)
+            if cli is None:
+                for old in [lp for lp in _async_clients.keys() if lp.is_closed()]:
+                    _async_clients.pop(old, None)
+                cli = _async_clients[loop] = openai.AsyncOpenAI(**_client_kwargs(openai.DefaultAsyncHttpxClient))
+    return cli
 
-def embed_texts(texts: List[str], model: str) -> List[List[float]]:
-    """後方互換：埋め込みのみ返す（計測・usageは不要な場面向け）"""
-    embs, _meta = embed_texts_with_meta(texts, model)
-    return embs
+# ===== リトライ（jitter付き指数バックオフ） =====
+def _retryable() -> Tuple[type, ...]:
+    return (
+        openai.APIConnectionError,   # APITimeoutError も含む
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )
+
+def _backoff_sec(attempt: int) -> float:
+    """full jitter: 0〜min(上限, base*2^attempt) の一様乱数"""
+    base = float(_cfg("LLM_RETRY_BASE", 0.5))
+    cap = float(_cfg("LLM_RETRY_MAX", 8.0))
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+# ===== ヘッジ（遅い呼び出しに複製リクエストを投げ、先着を採用） =====
+class _LatencyWindow:
+    """直近N件のレイテンシ(ms)を保持し、パーセンタイルを返す"""
+    def __init__(self, size: int = 200):
+        self._buf = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, ms: int):
+        with self._lock:
+            self._buf.append(ms)
+
+    def percentile(self, p: float) -> Tuple[Optional[int], int]:
+        with self._lock:
+            data = sorted(self._buf)
+        if not data:
+            return None, 0
+        i = min(len(data) - 1, int(round(p / 100.0 * (len(data) - 1))))
+        return data[i], len(data)
+
+_latency: Dict[str, _LatencyWindow] = {}
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+def _window(kind: str) -> _LatencyWindow:
+    w = _latency.get(kind)
+    if w is None:
+        w = _latency.setdefault(kind, _LatencyWindow())
+    return w
+
+def _hedge_delay_ms(kind: str) -> Optional[int]:
+    """ヘッジ発火までの待ち時間。無効 or サンプル不足なら None"""
+    if str(_cfg("LLM_HEDGE", "0")).lower() not in ("1", "true", "yes"):
+        return None
+    pct, n = _window(kind).percentile(float(_cfg("LLM_HEDGE_PERCENTILE", 95)))
+    if pct is None or n < int(_cfg("LLM_HEDGE_MIN_SAMPLES", 20)):
+        return None
+    return max(int(_cfg("LLM_HEDGE_MIN_MS", 300)), pct)
+
+def _hedge_pool_size() -> int:
+    """ヘッジ用スレッド数。実行中の試行はどれも chat/embed の枠を持つので、枠の合計があれば足りる"""
+    limits = [int(_cfg("LIMIT_CHAT", 0)), int(_cfg("LIMIT_EMBED", 0))]
+    if all(n > 0 for n in limits):
+        return sum(limits)
+    return int(_cfg("LLM_POOL_MAXSIZE", 20))
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _client_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=_hedge_pool_size(), thread_name_prefix="llm-hedge")
+    return _hedge_executor
 
-def embed_texts_with_meta(texts: List[str], model: str) -> Tuple[List[List[float]], Dict[str, Any]]:
+def _hedged(fn: Callable[[], Any], delay_ms: Optional[int], lim: Limiter) -> Tuple[Any, bool]:
     """
-    計測＆usage付き。戻り値:
-      (embeddings, {"ms": int, "usage": {...} or None, "model": str})
+    fn を実行し、delay_ms 経っても終わらなければ同じ fn をもう1本投げる。先に成功した方を返す。
+    呼び出し側が取った枠（lim）を1つ渡す。複製は依存の枠に空きがあるときだけ追加で1つ取って投げる（無ければ待つだけ）。
+    枠は各試行が終わった時点で返す（同期クライアントは中断できないので、負けた方は裏で完走するまで枠を持つ）
     """
-    cli = get_client()
+    if delay_ms is None:
+        try:
+            return fn(), False
+        finally:
+            lim.release()
+    ex = _get_hedge_executor()
+    first = _submit_holding(ex, fn, lim)
+    done, _ = wait([first], timeout=delay_ms / 1000.0)
+    if done or not lim.try_acquire():
+        return first.result(), False
+    pending = {first, _submit_holding(ex, fn, lim)}
+    err: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            if fut.exception() is None:
+                return fut.result(), True
+            err = fut.exception()
+    raise err
+
+def _submit_holding(ex: ThreadPoolExecutor, fn: Callable[[], Any], lim: Limiter):
+    """fn を投げ、終わったら（成否に関わらず）枠を1つ返す"""
+    try:
+        fut = ex.submit(fn)
+    except BaseException:
+        lim.release()
+        raise
+    fut.add_done_callback(lambda _f: lim.release())
+    return fut
+
+async def _ahedged(make_coro: Callable[[], Any], delay_ms: Optional[int], lim: Limiter) -> Tuple[Any, bool]:
+    """_hedged の asyncio 版。負けた方はキャンセルする（枠はタスクが終わった時点で返す）"""
+    t1 = asyncio.ensure_future(make_coro())
+    t1.add_done_callback(lambda _t: lim.release())
+    if delay_ms is None:
+        return await t1, False
+    done, _ = await asyncio.wait({t1}, timeout=delay_ms / 1000.0)
+    if done or not lim.try_acquire():
+        return await t1, False
+    t2 = asyncio.ensure_future(make_coro())
+    t2.add_done_callback(lambda _t: lim.release())
+    pending = {t1, t2}
+    err: Optional[BaseException] = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            if t.exception() is None:
+                for p in pending:
+                    p.cancel()
+                return t.result(), True
+            err = t.exception()
+    raise err
+
+def _deadline_opts(kind: str) -> Dict[str, Any]:
+    """リクエストの締め切りがあれば、この試行のタイムアウトを残り時間に収める（SDK の per-request timeout）"""
+    if remaining() is None:
+        return {}
+    return {"timeout": deadline_timeout(kind, float(_cfg("LLM_READ_TIMEOUT", 30.0)))}
+
+def _retry_wait(kind: str, attempt: int) -> float:
+    """次の試行までの待ち秒。締め切りまでに次を試せないなら DeadlineExceeded"""
+    wait_sec = _backoff_sec(attempt)
+    left = remaining()
+    if left is not None and left <= wait_sec:
+        raise DeadlineExceeded(kind, budget_ms())
+    return wait_sec
+
+def _call_with_policy(kind: str, fn: Callable[..., Any]) -> Tuple[Any, Dict[str, Any]]:
+    """
+    タイムアウト済みクライアント呼び出しに リトライ＋ヘッジ をかける（同期）。
+    各試行は依存ごとの同時実行枠（admission）の中で行う（バックオフ中は枠を返す。ヘッジの複製も枠を1つ使う）。
+    fn は SDK の追加引数（timeout）を受け取れる形にする。締め切りがあれば各試行のタイムアウトを残り時間に収める
+    """
+    retries = int(_cfg("LLM_MAX_RETRIES", 2))
     t0 = time.perf_counter()
-    resp = cli.embeddings.create(model=model, input=texts)
-    ms = int((time.perf_counter() - t0) * 1000)
+    for attempt in range(retries + 1):
+        try:
+            lim = acquire(kind.split(":", 1)[0])
+            t = time.perf_counter()
+            opts = _deadline_opts(kind)
+            resp, hedged = _hedged(lambda: fn(**opts), _hedge_delay_ms(kind), lim)
+            _window(kind).add(int((time.perf_counter() - t) * 1000))
+            return resp, {"ms": int((time.perf_counter() - t0) * 1000), "retries": attempt, "hedged": hedged}
+        except _retryable():
+            if attempt >= retries:
+                raise
+            time.sleep(_retry_wait(kind, attempt))
 
-    embs = [d.embedding for d in resp.data]
+async def _acall_with_policy(kind: str, make_coro: Callable[..., Any]) -> Tuple[Any, Dict[str, Any]]:
+    """_call_with_policy の asyncio 版"""
+    retries = int(_cfg("LLM_MAX_RETRIES", 2))
+    t0 = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            lim = await aacquire(kind.split(":", 1)[0])
+            t = time.perf_counter()
+            opts = _deadline_opts(kind)
+            resp, hedged = await _ahedged(lambda: make_coro(**opts), _hedge_delay_ms(kind), lim)
+            _window(kind).add(int((time.perf_counter() - t) * 1000))
+            return resp, {"ms": int((time.perf_counter() - t0) * 1000), "retries": attempt, "hedged": hedged}
+        except _retryable():
+            if attempt >= retries:
+                raise
+            await asyncio.sleep(_retry_wait(kind, attempt))
+
+def _usage_dict(resp) -> Optional[Dict[str, Any]]:
     usage = getattr(resp, "usage", None)
     if usage is not None:
         # openai-python v1系は pydantic objects → dict() で扱いやすく
@@ -40,10 +261,64 @@ def embed_texts_with_meta(texts: List[str], model: str) -> Tuple[List[List[float
             usage = usage.model_dump()  # pydantic v2
         except Exception:
             usage = dict(usage)
+        # プロバイダ側のプロンプトキャッシュ（先頭が同じプロンプト）で割り引かれた入力トークン数
+        details = usage.get("prompt_tokens_details") or {}
+        if not isinstance(details, dict):
+            details = getattr(details, "__dict__", {}) or {}
+        usage["cached_tokens"] = int(details.get("cached_tokens") or 0)
+    return usage
+
+# ====== 埋め込み ======
+
+def embed_texts(texts: List[str], model: str, dimensions: Optional[int] = None) -> List[List[float]]:
+    """後方互換：埋め込みのみ返す（計測・usageは不要な場面向け）"""
+    embs, _meta = embed_texts_with_meta(texts, model, dimensions=dimensions)
+    return embs
 
-    meta = {"ms": ms, "usage": usage, "model": model}
+def supports_dimensions(model: str) -> bool:
+    """API側で短縮ベクトルを返せるモデルか（text-embedding-3 系）"""
+    return model.startswith("text-embedding-3")
+
+def _embed_kwargs(model: str, dimensions: Optional[int]) -> Dict[str, Any]:
+    return {"dimensions": int(dimensions)} if dimensions and supports_dimensions(model) else {}
+
+def _truncate(emb: List[float], dim: int) -> List[float]:
+    """API が次元指定に対応しないモデル向け：先頭 dim 次元に切って L2 正規化し直す"""
+    v = emb[:dim]
+    norm = sum(x * x for x in v) ** 0.5 or 1.0
+    return [x / norm for x in v]
+
+def _embed_result(resp, policy: Dict[str, Any], model: str,
+                  dimensions: Optional[int]) -> Tuple[List[List[float]], Dict[str, Any]]:
+    embs = [d.embedding for d in resp.data]
+    if dimensions and not supports_dimensions(model):
+        embs = [_truncate(e, int(dimensions)) for e in embs]
+    meta = {"ms": policy["ms"], "usage": _usage_dict(resp), "model": model, "dimensions": dimensions,
+            "retries": policy["retries"], "hedged": policy["hedged"]}
     return embs, meta
 
+def embed_texts_with_meta(texts: List[str], model: str,
+                          dimensions: Optional[int] = None) -> Tuple[List[List[float]], Dict[str, Any]]:
+    """
+    計測＆usage付き。dimensions を渡すと短縮ベクトルを返す。戻り値:
+      (embeddings, {"ms": int, "usage": {...} or None, "model": str, "dimensions": int|None,
+                    "retries": int, "hedged": bool})
+    """
+    cli = get_client()
+    extra = _embed_kwargs(model, dimensions)
+    resp, policy = _call_with_policy(
+        f"embed:{model}", lambda **o: cli.embeddings.create(model=model, input=texts, **extra, **o))
+    return _embed_result(resp, policy, model, dimensions)
+
+async def aembed_texts_with_meta(texts: List[str], model: str,
+                                 dimensions: Optional[int] = None) -> Tuple[List[List[float]], Dict[str, Any]]:
+    """embed_texts_with_meta の asyncio 版（戻り値の形は同じ）"""
+    cli = get_async_client()
+    extra = _embed_kwargs(model, dimensions)
+    resp, policy = await _acall_with_policy(
+        f"embed:{model}", lambda **o: cli.embeddings.create(model=model, input=texts, **extra, **o))
+    return _embed_result(resp, policy, model, dimensions)
+
 # ====== チャット補完 ======
 
 def chat(messages: List[Dict], model: str) -> str:
@@ -51,38 +326,89 @@ def chat(messages: List[Dict], model: str) -> str:
     text, _meta = chat_with_meta(messages=messages, model=model)
     return text
 
+def _chat_result(resp, policy: Dict[str, Any], model: str) -> Tuple[str, Dict[str, Any]]:
+    choice = resp.choices[0]
+    text = (choice.message.content or "").strip()
+    meta = {
+        "ms": policy["ms"],
+        "usage": _usage_dict(resp),
+        "finish_reason": getattr(choice, "finish_reason", None),
+        "id": getattr(resp, "id", None),
+        "model": model,
+        "retries": policy["retries"],
+        "hedged": policy["hedged"],
+    }
+    return text, meta
+
+# ===== 応答キャッシュ（temperature 0 の呼び出しだけ。llm_cache） =====
+def _cache_key(model: str, messages: List[Dict], temperature: float, kwargs: Dict[str, Any]) -> Optional[str]:
+    """キャッシュしてよい呼び出しならキー（無効・温度が0でない・stream・n>1 なら None）"""
+    if str(_cfg("LLM_CACHE_ENABLED", "0")).lower() not in ("1", "true", "yes"):
+        return None
+    if float(temperature) != 0 or kwargs.get("stream") or int(kwargs.get("n") or 1) != 1:
+        return None
+    return llm_cache.cache_key(model, messages, {"temperature": 0, **kwargs})
+
+def _cache_get(key: Optional[str], t0: float) -> Optional[Tuple[str, Dict[str, Any]]]:
+    if key is None:
+        return None
+    hit = llm_cache.get(_cfg("LLM_CACHE_PATH", "data/cache/llm_cache.sqlite3"), key,
+                        float(_cfg("LLM_CACHE_TTL_SEC", 7 * 86400)))
+    if hit is None:
+        return None
+    text, meta = hit
+    saved = (meta.get("usage") or {}).get("total_tokens") or 0
+    meta.update({"ms": int((time.perf_counter() - t0) * 1000), "retries": 0, "hedged": False,
+                 "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0,
+                           "cache_hit": True, "saved_tokens": saved}})
+    llm_cache.record(meta["usage"], True)
+    return text, meta
+
+def _cache_put(key: Optional[str], model: str, text: str, meta: Dict[str, Any]):
+    if meta.get("usage") is not None and key is not None:
+        meta["usage"]["cache_hit"] = False
+    llm_cache.record(meta.get("usage"), False if key is not None else None)
+    if key is None or meta.get("finish_reason") not in (None, "stop"):
+        return  # 長さ打ち切りなどの不完全な応答は残さない
+    llm_cache.put(_cfg("LLM_CACHE_PATH", "data/cache/llm_cache.sqlite3"), key, model, text,
+                  {k: meta.get(k) for k in ("usage", "finish_reason", "id", "model")},
+                  float(_cfg("LLM_CACHE_TTL_SEC", 7 * 86400)), int(_cfg("LLM_CACHE_MAX_ENTRIES", 20000)))
+
 def chat_with_meta(messages: List[Dict], model: str, **kwargs) -> Tuple[str, Dict[str, Any]]:
     """
     計測＆usage付きチャット。戻り値:
-      (text, {"ms": int, "usage": {...} or None, "finish_reason": str|None, "id": str|None, "model": str})
+      (text, {"ms": int, "usage": {...} or None, "finish_reason": str|None, "id": str|None, "model": str,
+              "retries": int, "hedged": bool})
+    LLM_CACHE_ENABLED=1 なら temperature 0 の呼び出しは応答キャッシュを使う（命中すると API を呼ばず usage.cache_hit=True。cache=False で無効）
     """
-    cli = get_client()
     t0 = time.perf_counter()
-    resp = cli.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=kwargs.pop("temperature", 0.2),
-        **kwargs
-    )
-    ms = int((time.perf_counter() - t0) * 1000)
-
-    choice = resp.choices[0]
-    text = (choice.message.content or "").strip()
-    finish_reason = getattr(choice, "finish_reason", None)
-    resp_id = getattr(resp, "id", None)
-
-    usage = getattr(resp, "usage", None)
-    if usage is not None:
-        try:
-            usage = usage.model_dump()
-        except Exception:
-            usage = dict(usage)
+    temperature = kwargs.pop("temperature", 0.2)
+    key = _cache_key(model, messages, temperature, kwargs) if kwargs.pop("cache", True) else None
+    hit = _cache_get(key, t0)
+    if hit is not None:
+        return hit
+    cli = get_client()
+    resp, policy = _call_with_policy(
+        f"chat:{model}",
+        lambda **o: cli.chat.completions.create(model=model, messages=messages, temperature=temperature,
+                                                **kwargs, **o))
+    text, meta = _chat_result(resp, policy, model)
+    _cache_put(key, model, text, meta)
+    return text, meta
 
-    meta = {
-        "ms": ms,
-        "usage": usage,
-        "finish_reason": finish_reason,
-        "id": resp_id,
-        "model": model,
-    }
+async def achat_with_meta(messages: List[Dict], model: str, **kwargs) -> Tuple[str, Dict[str, Any]]:
+    """chat_with_meta の asyncio 版（戻り値の形・キャッシュの扱いは同じ）"""
+    t0 = time.perf_counter()
+    temperature = kwargs.pop("temperature", 0.2)
+    key = _cache_key(model, messages, temperature, kwargs) if kwargs.pop("cache", True) else None
+    hit = _cache_get(key, t0)
+    if hit is not None:
+        return hit
+    cli = get_async_client()
+    resp, policy = await _acall_with_policy(
+        f"chat:{model}",
+        lambda **o: cli.chat.completions.create(model=model, messages=messages, temperature=temperature,
+                                                **kwargs, **o))
+    text, meta = _chat_result(resp, policy, model)
+    _cache_put(key, model, text, meta)
     return text, meta
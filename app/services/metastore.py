@@ -0,0 +1,251 @@
+# app/services/metastore.py
+"""
+チャンクメタデータの列指向ストア（meta.jsonl の置き換え）。
+
+  meta/
+    page.npy         int32  ページ番号（1始まり、無ければ -1）
+    total_pages.npy  int32  総ページ数（無ければ -1）
+    doc.npy          int32  文書の序数（strings.json の docs/paths の添字）
+    chunk.npy        int32  ページ内（テキストは文書内）のチャンク番号
+    strings.json     文書名・パスの文字列表（文書ごとに1回だけ持つ）
+    text.bin         チャンク本文（UTF-8 を連結。再ランク・コンテキスト用。旧インデックスには無い）
+    text_off.npy     int64  text.bin 内の開始位置（件数+1）
+    dup_off.npy      int64  近似重複としてまとめたチャンクの dup_page/dup_chunk 内の開始位置（件数+1。重複が無ければ無い）
+    dup_page.npy     int32  まとめたチャンクのページ番号（無ければ -1）
+    dup_chunk.npy    int32  まとめたチャンクのチャンク番号
+
+配列は np.load(mmap_mode="r") で開くので、ベクトルID→メタは O(1) でページキャッシュから読むだけ。
+"""
+from __future__ import annotations
+
+import os
+import re
+import json
+import shutil
+import threading
+from array import array
+from typing import Any, Dict, Iterable, List, Optional
+
+from .lazy import lazy_import
+
+try:
+    import fcntl  # POSIXのみ。Windowsではプロセス内ロックのみ
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+np = lazy_import("numpy")
+
+META_DIRNAME = "meta"
+LEGACY_JSONL = "meta.jsonl"
+_COLUMNS = ("page", "total_pages", "doc", "chunk")
+_MIGRATE_LOCK = "meta.migrate.lock"
+_migrate_lock = threading.Lock()
+
+
+class MetaStore:
+    """列指向メタデータの読み取り側"""
+
+    def __init__(self, meta_dir: str, mmap: bool = True):
+        mode = "r" if mmap else None
+        self.meta_dir = meta_dir
+        self.page = np.load(os.path.join(meta_dir, "page.npy"), mmap_mode=mode)
+        self.total_pages = np.load(os.path.join(meta_dir, "total_pages.npy"), mmap_mode=mode)
+        self.doc = np.load(os.path.join(meta_dir, "doc.npy"), mmap_mode=mode)
+        self.chunk = np.load(os.path.join(meta_dir, "chunk.npy"), mmap_mode=mode)
+        with open(os.path.join(meta_dir, "strings.json"), "r", encoding="utf-8") as f:
+            strings = json.load(f)
+        self.docs: List[str] = strings["docs"]
+        self.paths: List[str] = strings["paths"]
+        self.text_off = None
+        self.text_blob = None
+        if os.path.exists(os.path.join(meta_dir, "text_off.npy")):
+            self.text_off = np.load(os.path.join(meta_dir, "text_off.npy"), mmap_mode=mode)
+            blob = os.path.join(meta_dir, "text.bin")
+            self.text_blob = np.memmap(blob, dtype=np.uint8, mode="r") if os.path.getsize(blob) else np.zeros(0, np.uint8)
+        self.dup_off = self.dup_page = self.dup_chunk = None
+        if os.path.exists(os.path.join(meta_dir, "dup_off.npy")):
+            self.dup_off = np.load(os.path.join(meta_dir, "dup_off.npy"), mmap_mode=mode)
+            self.dup_page = np.load(os.path.join(meta_dir, "dup_page.npy"), mmap_mode=mode)
+            self.dup_chunk = np.load(os.path.join(meta_dir, "dup_chunk.npy"), mmap_mode=mode)
+
+    def __len__(self) -> int:
+        return int(self.doc.shape[0])
+
+    def get(self, i: int) -> Dict[str, Any]:
+        """ベクトルID i のメタを dict で返す（従来の meta.jsonl 1行と同じ形）"""
+        d = int(self.doc[i])
+        page = int(self.page[i])
+        total = int(self.total_pages[i])
+        chunk = int(self.chunk[i])
+        m: Dict[str, Any] = {"doc": self.docs[d], "path": self.paths[d]}
+        if page >= 0:
+            m["chunk_id"] = f"{page}-{chunk}"
+            m["page"] = page
+        else:
+            m["chunk_id"] = chunk
+        m["total_pages"] = total if total >= 0 else None
+        if self.dup_off is not None and self.dup_off[i + 1] > self.dup_off[i]:
+            # 同じ文面としてまとめたチャンクの出典（pages は自分のページを含む出現ページ一覧）
+            a, b = int(self.dup_off[i]), int(self.dup_off[i + 1])
+            m["duplicates"] = b - a
+            if page >= 0:
+                m["pages"] = sorted({page, *(int(p) for p in self.dup_page[a:b] if p >= 0)})
+        return m
+
+    def text(self, i: int) -> Optional[str]:
+        """チャンク本文（保存されていないインデックスでは None）"""
+        if self.text_off is None:
+            return None
+        a, b = int(self.text_off[i]), int(self.text_off[i + 1])
+        return bytes(self.text_blob[a:b]).decode("utf-8")
+
+    def doc_summary(self) -> List[Dict[str, Any]]:
+        """文書ごとのチャンク数・ページ数（配列演算のみ。dict化しない）"""
+        n_docs = len(self.docs)
+        chunks = np.bincount(self.doc, minlength=n_docs)
+        total = np.full(n_docs, -1, dtype=np.int64)
+        np.maximum.at(total, self.doc, self.total_pages)
+        # total_pages が無い文書はユニークなページ数で代用
+        has_page = self.page >= 0
+        pairs = np.unique(self.doc[has_page].astype(np.int64) << 32 | self.page[has_page].astype(np.int64))
+        uniq_pages = np.bincount((pairs >> 32).astype(np.int64), minlength=n_docs)
+        out = []
+        for d in range(n_docs):
+            if not chunks[d]:
+                continue
+            pages: Optional[int] = int(total[d]) if total[d] > 0 else (int(uniq_pages[d]) or None)
+            out.append({"path": self.paths[d], "name": self.docs[d],
+                        "chunks": int(chunks[d]), "pages": pages})
+        return out
+
+
+class _Builder:
+    """dict を1件ずつ受け取り列へ積む（文書名・パスは intern）"""
+
+    def __init__(self):
+        self.cols = {c: array("i") for c in _COLUMNS}
+        self.docs: List[str] = []
+        self.paths: List[str] = []
+        self._ordinal: Dict[str, int] = {}
+        self.texts: Optional[List[bytes]] = None
+        self.dup_off = array("q", [0])
+        self.dup_page = array("i")
+        self.dup_chunk = array("i")
+
+    def add(self, doc: str, path: str, page: Optional[int], total_pages: Optional[int], chunk: int,
+            dups: Iterable = ()):
+        d = self._ordinal.get(path)
+        if d is None:
+            d = self._ordinal[path] = len(self.paths)
+            self.paths.append(path)
+            self.docs.append(doc)
+        self.cols["page"].append(page if page is not None else -1)
+        self.cols["total_pages"].append(total_pages if total_pages is not None else -1)
+        self.cols["doc"].append(d)
+        self.cols["chunk"].append(chunk)
+        for p, c in dups:
+            self.dup_page.append(p if p is not None else -1)
+            self.dup_chunk.append(c)
+        self.dup_off.append(len(self.dup_page))
+
+    def write(self, meta_dir: str):
+        """一時ディレクトリに書いてから差し替える"""
+        tmp = f"{meta_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for c in _COLUMNS:
+            np.save(os.path.join(tmp, f"{c}.npy"), np.frombuffer(self.cols[c], dtype=np.int32))
+        with open(os.path.join(tmp, "strings.json"), "w", encoding="utf-8") as f:
+            json.dump({"schema_version": 1, "docs": self.docs, "paths": self.paths},
+                      f, ensure_ascii=False)
+        if len(self.dup_page):
+            np.save(os.path.join(tmp, "dup_off.npy"), np.frombuffer(self.dup_off, dtype=np.int64))
+            np.save(os.path.join(tmp, "dup_page.npy"), np.frombuffer(self.dup_page, dtype=np.int32))
+            np.save(os.path.join(tmp, "dup_chunk.npy"), np.frombuffer(self.dup_chunk, dtype=np.int32))
+        if self.texts is not None:
+            off = np.zeros(len(self.texts) + 1, dtype=np.int64)
+            np.cumsum([len(t) for t in self.texts], out=off[1:])
+            np.save(os.path.join(tmp, "text_off.npy"), off)
+            with open(os.path.join(tmp, "text.bin"), "wb") as f:
+                for t in self.texts:
+                    f.write(t)
+        old = f"{meta_dir}.old-{os.getpid()}"
+        if os.path.exists(meta_dir):
+            os.replace(meta_dir, old)
+        os.replace(tmp, meta_dir)
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _coerce_int(x) -> Optional[int]:
+    if isinstance(x, bool):
+        return None
+    if isinstance(x, (int, np.integer)):
+        return int(x)
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    if isinstance(x, str):
+        m = re.match(r"^\s*(-?\d+)", x)
+        if m:
+            return int(m.group(1))
+    return None
+
+def _add_meta(b: _Builder, m: Dict[str, Any]):
+    path = "__unknown__"
+    for key in ("path", "source", "file", "filepath"):
+        if m.get(key):
+            path = str(m[key])
+            break
+    else:
+        if "doc_id" in m:
+            path = str(m["doc_id"])
+    doc = m.get("doc") or (os.path.basename(path) if path != "__unknown__" else "(unknown)")
+    page = _coerce_int(m.get("page"))
+    total = _coerce_int(m.get("total_pages") or (m.get("metadata") or {}).get("total_pages"))
+    cid = m.get("chunk_id")
+    # PDFは "ページ-連番"、テキストは連番
+    chunk = _coerce_int(str(cid).rsplit("-", 1)[-1]) if isinstance(cid, str) else _coerce_int(cid)
+    b.add(doc, path, page, total, chunk if chunk is not None else -1, m.get("dups") or ())
+
+def write_metas(meta_dir: str, metas: Iterable[Dict[str, Any]], texts: Optional[List[str]] = None):
+    """取り込み時のメタ(dict列)を列指向で保存。texts を渡すとチャンク本文も保存"""
+    b = _Builder()
+    for m in metas:
+        _add_meta(b, m)
+    if texts is not None:
+        b.texts = [t.encode("utf-8") for t in texts]
+    b.write(meta_dir)
+
+def migrate_jsonl(index_dir: str) -> bool:
+    """
+    旧形式 meta.jsonl を列指向へ一度だけ変換する（行ごとに読み、dictは溜めない）。
+    変換後の meta.jsonl は meta.jsonl.bak に退避。変換したら True
+    load_meta から遅延で呼ばれるので、ワーカー・スレッドが同時に来ても1つだけが変換する
+    （ロックを取ってから確かめ直し、元が無い・退避済みなら変換済みとして何もしない）
+    """
+    src = os.path.join(index_dir, LEGACY_JSONL)
+    dst = os.path.join(index_dir, META_DIRNAME)
+    if not _needs_migration(src, dst):
+        return False
+    with _migrate_lock:
+        fd = None
+        if fcntl is not None:
+            fd = os.open(os.path.join(index_dir, _MIGRATE_LOCK), os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if not _needs_migration(src, dst):
+                return False
+            b = _Builder()
+            with open(src, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        _add_meta(b, json.loads(line))
+            b.write(dst)
+            os.replace(src, src + ".bak")
+            return True
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+def _needs_migration(src: str, dst: str) -> bool:
+    return os.path.exists(src) and not os.path.isdir(dst) and not os.path.exists(src + ".bak")
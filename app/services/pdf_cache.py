@@ -0,0 +1,125 @@
+# app/services/pdf_cache.py
+"""
+PDFのページ抽出テキストのキャッシュ（キー: ファイル内容の sha256）。
+
+pypdf の抽出はこのアプリで一番重いCPU処理なので、取り込み・プレビュー・ページ数表示のどこから呼ばれても
+同じ内容のPDFは1回しか解析しない。
+
+  INDEX_DIR/pdf_text/<sha256>.ptc
+    magic "PTC1" | ページ数 uint32 | オフセット uint32 × (ページ数+1) | ページごとに zlib 圧縮した UTF-8
+
+ページ単位で圧縮しているので、プレビュー（先頭数ページ）やページ数だけなら全体を展開しない。
+"""
+import os
+import zlib
+import struct
+import threading
+from typing import Iterable, List, Optional
+
+from flask import current_app
+from .lazy import lazy_import
+
+pypdf = lazy_import("pypdf")
+
+_MAGIC = b"PTC1"
+_EXT = ".ptc"
+_STRIPES = 64
+_locks = [threading.Lock() for _ in range(_STRIPES)]
+
+
+def _cache_dir() -> str:
+    return os.path.join(current_app.config["INDEX_DIR"], "pdf_text")
+
+def _entry(sha: str) -> str:
+    return os.path.join(_cache_dir(), f"{sha}{_EXT}")
+
+def _enabled() -> bool:
+    return bool(current_app.config.get("PDF_TEXT_CACHE", True))
+
+def _key_lock(sha: str) -> threading.Lock:
+    """
+    同じPDFを同時に解析しない（プロセス内）。ロックは sha256 の先頭で選ぶ固定本数なので、文書が増えても溜まらない
+    （別のPDFが同じロックに当たったときは順番に解析するだけ）
+    """
+    return _locks[int(sha[:8], 16) % _STRIPES]
+
+
+# ===== 読み書き =====
+def _write(path: str, pages: List[str]):
+    blobs = [zlib.compress(p.encode("utf-8"), 6) for p in pages]
+    offs = [0]
+    for b in blobs:
+        offs.append(offs[-1] + len(b))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(_MAGIC + struct.pack(f"<I{len(offs)}I", len(pages), *offs))
+        for b in blobs:
+            f.write(b)
+    os.replace(tmp, path)
+
+def _read(path: str, max_pages: Optional[int] = None, count_only: bool = False):
+    """キャッシュを読む。無い/壊れていれば None。count_only ならページ数だけ"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(8)
+            if len(head) < 8 or head[:4] != _MAGIC:
+                return None
+            n = struct.unpack("<I", head[4:])[0]
+            if count_only:
+                return n
+            offs = struct.unpack(f"<{n + 1}I", f.read(4 * (n + 1)))
+            want = n if max_pages is None else min(n, max_pages)
+            data = f.read(offs[want])
+        return [zlib.decompress(data[offs[i]:offs[i + 1]]).decode("utf-8") for i in range(want)]
+    except (OSError, struct.error, zlib.error, UnicodeDecodeError):
+        return None
+
+
+def _extract(path: str) -> List[str]:
+    reader = pypdf.PdfReader(path)
+    return [(page.extract_text() or "") for page in reader.pages]
+
+
+# ===== 公開API =====
+def pdf_pages(path: str, sha: str, max_pages: Optional[int] = None) -> List[str]:
+    """
+    ページごとのテキスト（キャッシュに無ければ解析して保存）。max_pages で先頭だけ読める。
+    path はファイルパスのほか、ダウンロードしたPDFの BytesIO でもよい（sha はその内容のハッシュ）
+    """
+    if not _enabled():
+        pages = _extract(path)
+        return pages if max_pages is None else pages[:max_pages]
+    entry = _entry(sha)
+    pages = _read(entry, max_pages)
+    if pages is not None:
+        return pages
+    with _key_lock(sha):
+        pages = _read(entry, max_pages)  # 待っている間に別スレッドが作った場合
+        if pages is not None:
+            return pages
+        pages = _extract(path)
+        _write(entry, pages)
+    return pages if max_pages is None else pages[:max_pages]
+
+def pdf_page_count(path: str, sha: str) -> int:
+    """ページ数（キャッシュがあればヘッダだけ読む）"""
+    if _enabled():
+        n = _read(_entry(sha), count_only=True)
+        if n is not None:
+            return n
+    return len(pdf_pages(path, sha))
+
+def prune(keep: Iterable[str]):
+    """keep（sha256）以外のキャッシュを消す（取り込み時に PDF_DIR に無くなった内容を掃除）"""
+    keep = set(keep)
+    try:
+        entries = list(os.scandir(_cache_dir()))
+    except OSError:
+        return
+    for e in entries:
+        if e.name.endswith(_EXT) and e.name[:-len(_EXT)] not in keep:
+            try:
+                os.unlink(e.path)
+            except OSError:
+                pass
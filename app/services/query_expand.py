@@ -0,0 +1,136 @@
+# app/services/query_expand.py
+"""
+検索クエリの言い換え（multi-query）と結果の統合。
+
+利用者は「助成金」と書くが資料は「補助金」と書いている、のような表記ゆれで取りこぼすので、
+元の質問に加えて言い換えを数本作り、まとめて検索して Reciprocal Rank Fusion（RRF）で1つの順位にする。
+
+  off:   言い換えない（既定。元の質問だけで検索する）
+  rules: 同義語の表を使った置き換え（1語ずつ。LLMを呼ばないので追加の待ち時間は無い）
+  llm:   rules に加えて LLM に1回だけ言い換えを頼む（temperature 0・締め切りが近ければ飛ばす）
+言い換えは vectorstore.faiss_search_multi で埋め込み1回・検索1回にまとめるので、
+クエリが増えても費用・待ち時間は1クエリのときとほぼ変わらない。
+"""
+import json
+import re
+import time
+from typing import Any, Dict, List, Sequence, Tuple
+
+from flask import current_app
+
+from .deadline import DeadlineExceeded
+from .llm_utils import chat_with_meta
+from . import deadline
+
+# 同じものを指す語（上から順に、質問に含まれる最初の語を他の語に置き換える）
+_SYNONYM_GROUPS: List[Tuple[str, ...]] = [
+    ("補助金", "助成金", "給付金", "支援金"),
+    ("締め切り", "締切", "期限", "申請期限"),
+    ("上限額", "限度額", "上限"),
+    ("対象者", "対象", "要件"),
+    ("申請", "応募"),
+    ("中小企業", "中小事業者"),
+    ("個人事業主", "フリーランス"),
+]
+_GROUP_RES = [re.compile("|".join(map(re.escape, sorted(g, key=len, reverse=True)))) for g in _SYNONYM_GROUPS]
+_JSON_LIST = re.compile(r"\[.*\]", re.DOTALL)
+
+
+def expand_mode() -> str:
+    """off|rules|llm（不明な値は off）"""
+    mode = str(current_app.config.get("QUERY_EXPAND", "off") or "off").lower()
+    return mode if mode in ("rules", "llm") else "off"
+
+
+def rule_variants(query: str) -> List[str]:
+    """同義語の置き換えで作った言い換え（元の質問は含めない）"""
+    out: List[str] = []
+    for group, pat in zip(_SYNONYM_GROUPS, _GROUP_RES):
+        m = pat.search(query)
+        if not m:
+            continue
+        for term in group:
+            if term != m.group(0):
+                out.append(query[:m.start()] + term + query[m.end():])
+    return out
+
+
+def llm_variants(query: str, n: int) -> Tuple[List[str], Dict[str, Any]]:
+    """LLM に言い換えを n 本まで頼む（1回・temperature 0）。戻り値: (言い換え, {"ms","usage"})"""
+    model = current_app.config.get("CLASSIFIER_MODEL") or current_app.config["LLM_MODEL"]
+    messages = [
+        {"role": "system", "content": "あなたはJSONのみを返す検索クエリ生成器です。出力以外は一切書かないでください。"},
+        {"role": "user", "content": (
+            f"次の質問を、補助金・助成金の資料を検索するための別の言い方に{n}通り言い換えてください。\n"
+            "意味は変えず、資料で使われそうな語（正式名称・同義語）を使うこと。\n"
+            '出力は {"queries": ["...", ...]} のJSON一行のみ。\n\n'
+            f"質問: {query}")},
+    ]
+    text, meta = chat_with_meta(messages=messages, model=model, temperature=0, max_tokens=200,
+                                response_format={"type": "json_object"})
+    info = {"ms": meta.get("ms"), "usage": meta.get("usage")}
+    m = _JSON_LIST.search(text or "")
+    try:
+        items = json.loads(m.group(0)) if m else []
+    except ValueError:
+        items = []
+    return [str(s).strip() for s in items if isinstance(s, str) and s.strip()][:n], info
+
+
+def expand(query: str) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    検索に使うクエリ（先頭は元の質問）と trace 用の情報を返す。
+    本数は QUERY_EXPAND_MAX まで（rules と llm の言い換えを交互に詰める）
+    """
+    mode = expand_mode()
+    info: Dict[str, Any] = {"mode": mode}
+    if mode == "off":
+        return [query], info
+    t = time.perf_counter()
+    limit = max(1, int(current_app.config.get("QUERY_EXPAND_MAX", 4)))
+    rules = rule_variants(query)
+    llm: List[str] = []
+    if mode == "llm" and limit > 1 and deadline.allow(
+            "query_expand_llm", int(current_app.config.get("DEADLINE_EXPAND_MS", 8000))):
+        try:
+            llm, info["llm"] = llm_variants(query, limit - 1)
+        except DeadlineExceeded:
+            deadline.skip("query_expand_llm")
+        except Exception as e:
+            # 言い換えは任意。失敗しても元の質問と rules で検索を続ける
+            info["llm_error"] = f"{type(e).__name__}: {e}"
+
+    variants = [query]
+    seen = {query}
+    for i in range(max(len(rules), len(llm))):
+        for v in (rules[i:i + 1] + llm[i:i + 1]):
+            if v not in seen and len(variants) < limit:
+                seen.add(v)
+                variants.append(v)
+    info.update({"variants": variants, "ms": int((time.perf_counter() - t) * 1000)})
+    return variants, info
+
+
+def fuse(results: Sequence[List[Dict[str, Any]]], k: int, rrf_k: int = 60) -> List[Dict[str, Any]]:
+    """
+    クエリごとの検索結果を RRF（Σ 1/(rrf_k + 順位)）で1つにまとめて上位k件を返す。
+    同じチャンク（path, chunk_id）はまとめ、"score" は一番高いコサイン類似度、
+    "rrf" に統合スコア、"variants" にそのチャンクを拾ったクエリの番号（0 が元の質問）を付ける
+    """
+    if len(results) == 1:
+        return list(results[0][:k])
+    fused: Dict[Tuple[Any, Any], Dict[str, Any]] = {}
+    for qi, hits in enumerate(results):
+        for rank, h in enumerate(hits):
+            key = (h.get("path"), h.get("chunk_id"))
+            cur = fused.get(key)
+            if cur is None:
+                cur = fused[key] = {**h, "rrf": 0.0, "variants": []}
+            elif h["score"] > cur["score"]:
+                cur.update({**h, "rrf": cur["rrf"], "variants": cur["variants"]})
+            cur["rrf"] += 1.0 / (rrf_k + rank + 1)
+            cur["variants"].append(qi)
+    out = sorted(fused.values(), key=lambda h: (-h["rrf"], -h["score"]))[:k]
+    for h in out:
+        h["rrf"] = round(h["rrf"], 6)
+    return out
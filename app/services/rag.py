@@ -2,11 +2,15 @@
 from typing import Dict, List, Any, Tuple
 from flask import current_app, g
 from .llm_utils import chat, chat_with_meta
-from .vectorstore import faiss_exists, faiss_search
+from .vectorstore import faiss_exists, faiss_search_multi
 from .doc_utils import read_preview
 from .serp_utils import google_search
-import requests
-from bs4 import BeautifulSoup
+from .rerank import rerank
+from .web_extract import fetch_text
+from .admission import Overloaded, limit, queue_waits
+from .chunker import estimate_tokens
+from .deadline import DeadlineExceeded
+from . import conversation, crawler, deadline, llm_cache, query_expand
 import time
 import json, re
 
@@ -77,17 +81,37 @@ def _emit_decision_log(*, stage: str, query: str, mode: str, timing: Dict[str,in
 # 初期プロンプト（設定で差し替え可）
 DEFAULT_SYS = "あなたは日本語で正確に答えるアシスタントです。補助金や支援制度についてのみの質問に対し、根拠に基づき簡潔に回答し、不明な点は正直に『不明』と述べてください。絶対に関係のない質問には答えないでください。"
 
-def _fetch_text(url: str, timeout: int = 10) -> str:
-    try:
-        html = requests.get(url, timeout=timeout).text
-        soup = BeautifulSoup(html, "html.parser")
-        return soup.get_text(separator="\n")
-    except Exception:
-        return ""
+# 締め切りが近いときに飛ばす任意の段（meta.notice の表示名）
+_SKIP_LABELS = {
+    "llm_validator": "LLMによる回答の検査",
+    "hybrid_resummarize": "ドキュメントとWebの統合要約",
+    "web_source": "残りのWebページの取得",
+    "query_expand_llm": "LLMによる検索語の言い換え",
+}
+
+def _answer_reserve() -> float:
+    """Web取得の後に回答生成（LLM）のために残しておく秒"""
+    return int(current_app.config.get("DEADLINE_ANSWER_RESERVE_MS", 6000)) / 1000.0
+
+def _fetch_text(url: str, steps: Dict[str, Any] = None) -> str:
+    """
+    URL本文を取得（web_extract.fetch_text）。steps を渡すと URL ごとの取得・抽出時間を web_fetch に記録し、
+    同じリクエスト内で同じURLを再取得しない（hybrid の再要約など）。
+    締め切りがあれば、回答生成の分を残した残り時間でタイムアウトする
+    """
+    memo = steps.setdefault("_web_text", {}) if steps is not None else {}
+    if url in memo:
+        return memo[url]
+    text, info = fetch_text(url, timeout=deadline.timeout(
+        "web_fetch", float(current_app.config.get("WEB_FETCH_TIMEOUT", 10)), reserve=_answer_reserve()))
+    memo[url] = text
+    if steps is not None:
+        steps.setdefault("web_fetch", []).append(info)
+    return text
 
 # ===== 要約処理 =====
 def _summarize(contexts: List[str], query: str,
-               timing: Dict[str, int] = None, steps: Dict[str, Any] = None) -> str:
+               timing: Dict[str, int] = None, steps: Dict[str, Any] = None, history: str = "") -> str:
     sys_msg = (current_app.config.get("SYS_PROMPT") or DEFAULT_SYS).strip()
     llm_model = current_app.config["LLM_MODEL"]
     max_chunks = current_app.config.get("CTX_MAX_CHUNKS", 8)
@@ -100,10 +124,14 @@ def _summarize(contexts: List[str], query: str,
         s = " ".join(c.split())[:max_chars_per_chunk]  # 連続空白圧縮 + 文字上限
         if s: normed.append(s)
 
+    # 会話の続きなら、予算内に縮めた直近のやりとりを添える（指示語の解決用）
+    past = f"【これまでの会話】\n{history}\n\n" if history else ""
+    # 変わらない指示 → コンテキスト → 会話 → 質問 の順に並べる（続きの質問では同じ候補を使うので、
+    # 先頭の一致した部分にプロバイダ側のプロンプトキャッシュが効く）
     user = (
         "以下のコンテキストを根拠に質問へ回答してください。"
         "不足していれば『不明』と記してください。\n\n"
-        f"【質問】\n{query}\n\n【コンテキスト】\n" + "\n---\n".join(normed)
+        "【コンテキスト】\n" + "\n---\n".join(normed) + f"\n\n{past}【質問】\n{query}"
     )
     messages = [
         {"role": "system", "content": sys_msg},
@@ -172,14 +200,32 @@ def _summarize_sources(doc_hits: List[Dict[str, Any]], web_hits: List[Dict[str,
     return sources
 
 # ===== ドキュメント検索処理 =====
-def _doc(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict[str, Any]) -> Dict[str, Any]:
+def _doc(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict[str, Any],
+         reuse: Dict[str, Any] = None, history: str = "") -> Dict[str, Any]:
+    """reuse（会話の前回候補）があれば検索せずにそれを並べ替えて使う"""
+    if reuse and reuse.get("doc"):
+        hits = conversation.refine(query, reuse["doc"])
+        timing["retrieval_ms_doc"] = 0
+        return _doc_answer(query, params, timing, steps, hits, history)
     if not faiss_exists():
         msg = "インデックスがありません。先に /api/ingest を実行してください。"
         steps["doc_hits"] = []
         return {"answer": msg, "doc_hits": [], "sources": []}
 
+    # 再ランク有効時は候補を多めに拾い、クロスエンコーダで絞った上位だけをLLMへ渡す
+    use_rerank = bool(current_app.config.get("RERANK_ENABLED", False))
+    k = max(params["top_k"], int(current_app.config.get("RERANK_CANDIDATES", 20))) if use_rerank else params["top_k"]
+
+    # 会話中は続きの質問で使い回せるようにチャンク本文も受け取って保存する
+    keep = steps.get("conversation") is not None
+    # 言い換え（表記ゆれ）をまとめて検索し、RRF で1つの順位にする（埋め込み・検索はそれぞれ1回）
+    variants, expansion = query_expand.expand(query)
+    if expansion["mode"] != "off":
+        steps["query_expansion"] = expansion
+        timing["query_expand_ms"] = expansion["ms"]
     t = time.perf_counter()
-    hits = faiss_search(query, k=params["top_k"])
+    hits = query_expand.fuse(faiss_search_multi(variants, k=k, with_text=use_rerank or keep), k,
+                             int(current_app.config.get("QUERY_EXPAND_RRF_K", 60)))
     timing["retrieval_ms_doc"] = int((time.perf_counter() - t) * 1000)
 
     # パスを正規化（\ → /）
@@ -187,12 +233,28 @@ def _doc(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict
         p = h.get("path")
         if isinstance(p, str):
             h["path"] = p.replace("\\", "/")
-
-    steps["doc_hits"] = hits
-    # コンテキスト作成（上位3つを採用）
+    if keep:
+        steps["_doc_candidates"] = conversation.candidates_for_store(hits)
+    return _doc_answer(query, params, timing, steps, hits, history)
+
+def _doc_answer(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict[str, Any],
+                hits: List[Dict[str, Any]], history: str = "") -> Dict[str, Any]:
+    use_rerank = bool(current_app.config.get("RERANK_ENABLED", False))
+    ctx_hits = hits[:3]
+    if use_rerank:
+        t = time.perf_counter()
+        ctx_hits, rr = rerank(query, hits, top_n=int(current_app.config.get("RERANK_TOP_N", 3)))
+        timing["rerank_ms"] = int((time.perf_counter() - t) * 1000)
+        steps["rerank"] = rr
+        # 画面・traceには再ランク後の上位を先頭に top_k 件
+        picked = {(h.get("doc"), h.get("chunk_id")) for h in ctx_hits}
+        rest = [h for h in hits if (h.get("doc"), h.get("chunk_id")) not in picked]
+        hits = ctx_hits + rest[:max(0, params["top_k"] - len(ctx_hits))]
+
+    # コンテキスト作成（上位3つ、再ランク時は RERANK_TOP_N 件を採用）
     contexts, sources = [], []
-    for h in hits[:3]:
-        preview = read_preview(h.get("path", ""), limit=3000)
+    for h in ctx_hits:
+        preview = h.get("text") or read_preview(h.get("path", ""), limit=3000)
         if preview:
             contexts.append(preview)
         sources.append({
@@ -201,23 +263,68 @@ def _doc(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict
             "score": h.get("score"),
             "kind": "doc",
             "path": h.get("path"), 
-            "page": h.get("page")
+            "page": h.get("page"),
+            "pages": h.get("pages")  # 同じ文面が複数ページにある場合の出現ページ
         })
+    hits = [{k: v for k, v in h.items() if k != "text"} for h in hits]  # 本文は trace に載せない
+    steps["doc_hits"] = hits
 
-    ans = _summarize(contexts, query, timing=timing, steps=steps) if contexts else "該当ドキュメントが見つかりませんでした。"
+    ans = _summarize(contexts, query, timing=timing, steps=steps, history=history) if contexts else "該当ドキュメントが見つかりませんでした。"
     steps["context_preview_doc"] = _context_preview_from_doc_hits(hits)
     return {"answer": ans, "doc_hits": hits, "sources": sources}
 
 # ===== Web検索処理 =====
-def _web(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict[str, Any]) -> Dict[str, Any]:
-    t = time.perf_counter()
-    results = google_search(query, pages=1)  # 返却: [{'title','url',...}] を想定
-    timing["retrieval_ms_web"] = int((time.perf_counter() - t) * 1000)
+def _web(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict[str, Any],
+         reuse: Dict[str, Any] = None, history: str = "") -> Dict[str, Any]:
+    """
+    reuse（会話の前回候補）があれば検索・取得をせずに保存済みの本文を使う。
+    巡回済みのコレクション（crawler）に十分近いページがあればそれで答え、無ければライブ検索する
+    """
+    local: List[Dict[str, Any]] = []
+    if not reuse or not reuse.get("web"):
+        if current_app.config.get("WEB_LOCAL_ENABLED", True) and crawler.web_index_exists():
+            local, steps["web_local"] = crawler.lookup(query, params["top_k"])
+            timing["retrieval_ms_web_local"] = steps["web_local"]["ms"]
+            if not steps["web_local"]["hit"]:
+                local = []
+    if reuse and reuse.get("web"):
+        results = conversation.refine(query, reuse["web"])
+        memo = steps.setdefault("_web_text", {})
+        for r in results:
+            memo[r["url"]] = r.get("text") or ""
+        timing["retrieval_ms_web"] = 0
+    elif local:
+        results = local
+        memo = steps.setdefault("_web_text", {})
+        for r in results:
+            memo[r["url"]] = r.pop("text")
+        timing["retrieval_ms_web"] = 0
+    else:
+        t = time.perf_counter()
+        # 締め切りがあれば検索（リトライ込み）も回答生成の分を残した時間に収める
+        budget = deadline.timeout("web_search", 10.0, reserve=_answer_reserve()) if deadline.remaining() is not None else None
+        with limit("search"):
+            results = google_search(query, pages=1, budget=budget)  # 返却: [{'title','url',...}] を想定
+        timing["retrieval_ms_web"] = int((time.perf_counter() - t) * 1000)
 
     contexts, sources, web_hits = [], [], []
-    for rank, r in enumerate(results[:params["top_k"]], start=1):
+    need_ms = int(current_app.config.get("DEADLINE_FETCH_MIN_MS", 1500)) + int(_answer_reserve() * 1000)
+    top = results[:params["top_k"]]
+    for rank, r in enumerate(top, start=1):
         url = r.get("url")
-        txt = _fetch_text(url) if url else ""
+        if url and url not in steps.get("_web_text", {}):
+            # 残り時間で取りきれないソースは飛ばす（取得済みのページだけで回答する）
+            if not deadline.allow("web_source", need_ms, urls=[x.get("url") for x in top[rank - 1:]]):
+                break
+            try:
+                txt = _fetch_text(url, steps)
+            except Overloaded as e:
+                if e.reason != "deadline":
+                    raise
+                deadline.skip("web_source", urls=[x.get("url") for x in top[rank - 1:]])
+                break
+        else:
+            txt = steps["_web_text"][url] if url else ""
         if not txt:
             continue
         snippet = r.get("snippet") or (txt[:240] if txt else "")
@@ -228,7 +335,12 @@ def _web(query: str, params: Dict[str, Any], timing: Dict[str, int], steps: Dict
 
     steps["web_hits"] = web_hits
     steps["context_preview_web"] = _context_preview_from_web_hits(web_hits)
-    ans = _summarize(contexts, query, timing=timing, steps=steps) if contexts else "適切なWeb結果が見つかりませんでした。"
+    if steps.get("conversation") is not None and not reuse:
+        memo = steps.get("_web_text", {})
+        steps["_web_candidates"] = conversation.candidates_for_store(
+            [dict({k: h.get(k) for k in ("title", "url", "score", "snippet")}, text=memo.get(h["url"], ""))
+             for h in web_hits])
+    ans = _summarize(contexts, query, timing=timing, steps=steps, history=history) if contexts else "適切なWeb結果が見つかりませんでした。"
     return {"answer": ans, "web_hits": web_hits, "sources": sources}
 
 # ===== 「不明/ノイズ」かどうかのUI向け判定 =====
@@ -262,21 +374,79 @@ def _decide_hide_sources(answer_text: str,
     # ここまで引っかからなければ表示可
     return False, ""
 
+# ===== 締め切り =====
+DEADLINE_MSG = "時間内に回答を作成できませんでした。しばらくしてから、または質問を短くして再度お試しください。"
+
+def _skip_notice(skipped: List[Dict[str, Any]]) -> str:
+    labels = [_SKIP_LABELS.get(s["step"], s["step"]) for s in skipped]
+    return "時間の都合で次の処理を省略しました: " + "、".join(dict.fromkeys(labels)) if labels else ""
+
+def _deadline_payload(query: str, mode: str, e: Exception, t0: float) -> Dict[str, Any]:
+    """必須の段が締め切りに間に合わなかったときの回答（出典なし。どこで切れたかを meta に載せる）"""
+    stage = getattr(e, "stage", None) or f"queue:{getattr(e, 'dependency', '')}"
+    timing = {"total_ms": int((time.perf_counter() - t0) * 1000)}
+    _emit_decision_log(stage="deadline", query=query, mode=mode, timing=timing, decision="deadline_exceeded")
+    skipped = deadline.skipped()
+    return {"answer": DEADLINE_MSG, "sources": [],
+            "meta": {"show_sources": False, "hide_reason": "deadline",
+                     "deadline": {"budget_ms": deadline.budget_ms(), "stage": stage, "elapsed_ms": timing["total_ms"]},
+                     "skipped": skipped, "notice": _skip_notice(skipped)}}
+
 # ===== メイン回答関数 =====
-def answer(query: str, mode: str = "doc", debug: bool = False) -> Dict[str, Any]:
+def answer(query: str, mode: str = "doc", debug: bool = False,
+           conversation_id: str = None, deadline_ms: int = None,
+           new_conversation: bool = False) -> Dict[str, Any]:
+    """
+    conversation_id を渡すと会話状態（履歴・前回の検索候補）を読み書きする。
+    new_conversation=True は状態の無い最初の質問（conversation_id は呼び出し側が採番）。保存はせず、
+    保存すべき状態を payload["_conversation_state"] で返す（同時の同じ質問をまとめて実行し、状態は各自の id に保存するため）
+    deadline_ms（無ければ API が設定した締め切り、それも無ければ REQUEST_DEADLINE_MS）までに返す。
+    残りが少なければ任意の段を飛ばし（meta.skipped / meta.notice）、必須の段が間に合わなければ締め切り超過の回答を返す
+    """
+    if deadline_ms is not None:
+        deadline.start(deadline_ms)
+    else:
+        deadline.ensure()
     t0 = time.perf_counter()
+    try:
+        return _answer(query, mode, debug, conversation_id, t0, new_conversation)
+    except DeadlineExceeded as e:
+        return _deadline_payload(query, mode, e, t0)
+    except Overloaded as e:
+        if e.reason != "deadline":
+            raise
+        return _deadline_payload(query, mode, e, t0)
+
+def _answer(query: str, mode: str, debug: bool, conversation_id: str, t0: float,
+            new_conversation: bool = False) -> Dict[str, Any]:
     params: Dict[str, Any] = {
         "mode": mode,
         "top_k": current_app.config.get("RAG_TOP_K", 5),
         "threshold": current_app.config.get("RAG_THRESHOLD", 0.0),
         "embed_model": current_app.config.get("EMBED_MODEL"),
         "llm_model": current_app.config.get("LLM_MODEL"),
+        "deadline_ms": deadline.budget_ms(),
     }
     timing: Dict[str, int] = {}
     steps: Dict[str, Any] = {"query": query}
 
-    # 0) スコープ判定（LLM）
-    label, score, reason = in_scope_llm(query)
+    # 会話の続き（前回と同じモードの短い指示語つきの質問）なら、検索は前回の候補を使う
+    conv_state = conversation.load(conversation_id) if conversation_id else None
+    follow_up = conversation.is_follow_up(query, conv_state, mode)
+    reuse = conv_state["retrieval"] if follow_up else None
+    history = conversation.history_text(conv_state)
+    if conversation_id or new_conversation:
+        steps["conversation"] = {
+            "id": conversation_id,
+            "turns": len((conv_state or {}).get("turns") or []),
+            "follow_up": follow_up,
+            "reused": {"doc": len(reuse.get("doc") or []), "web": len(reuse.get("web") or [])} if reuse else None,
+            "history_tokens": estimate_tokens(history),
+        }
+
+    # 0) スコープ判定（LLM）。続きの質問でも毎回判定する（指示語の解決用に直前の質問だけ添える）
+    previous = conv_state["turns"][-1]["q"] if follow_up and conv_state.get("turns") else None
+    label, score, reason = in_scope_llm(query, previous=previous)
     steps["scope"] = {"label": label, "score": score, "reason": reason}
     _emit_decision_log(stage="scope_checked", query=query, mode=mode, timing=timing, scope=steps["scope"])
 
@@ -287,14 +457,18 @@ def answer(query: str, mode: str = "doc", debug: bool = False) -> Dict[str, Any]
         return {"answer": FIXED_MSG, "sources": [], "meta": {"show_sources": False, "hide_reason": "out_of_scope"}}
 
     # 1) 生成（一本化）
-    answer_text, sources, doc_hits, web_hits, failover = generate_answer(query, mode, params, timing, steps)
+    answer_text, sources, doc_hits, web_hits, failover = generate_answer(query, mode, params, timing, steps,
+                                                                         reuse=reuse, history=history)
     _emit_decision_log(stage="generated", query=query, mode=mode, timing=timing,
                        scope=steps["scope"], doc_hits=doc_hits, web_hits=web_hits, failover=failover)
 
     # 2) 検査（まずルール→必要時LLM）
     ok, errs = rule_validate(query, answer_text, sources)
     validator_log = None
-    if not ok:
+    if not ok and not deadline.allow("llm_validator", int(current_app.config.get("DEADLINE_VALIDATOR_MS", 3000))):
+        # 締め切りが近ければLLM検査は飛ばす（ルール検査の結果だけ残して回答は返す）
+        steps["validator"] = {"rule": errs, "llm": None, "skipped": True}
+    elif not ok:
         ok2, errs2 = validate_answer_llm(query, answer_text)
         steps["validator"] = {"rule": errs, "llm": errs2}
         validator_log = steps["validator"]
@@ -314,7 +488,10 @@ def answer(query: str, mode: str = "doc", debug: bool = False) -> Dict[str, Any]
 
     # 3) 仕上げ
     timing["total_ms"] = int((time.perf_counter() - t0) * 1000)
+    waits = queue_waits()  # 外部依存の同時実行枠を待った時間（admission）
+    timing["queue_ms"] = sum(waits.values())
     steps["failover"] = failover
+    skipped = deadline.skipped()
 
     ui_sources = _summarize_sources(doc_hits, web_hits)
     if hide_sources:
@@ -333,13 +510,21 @@ def answer(query: str, mode: str = "doc", debug: bool = False) -> Dict[str, Any]
             "query": steps.get("query"),
             "doc_hits": steps.get("doc_hits", []),
             "web_hits": steps.get("web_hits", []),
+            "web_fetch": steps.get("web_fetch", []),
+            "web_local": steps.get("web_local"),
+            "rerank": steps.get("rerank"),
+            "query_expansion": steps.get("query_expansion"),
+            "queue": waits,
             "context_preview": _contexts_combined,
             "prompt": "[hidden]",
             "usage": steps.get("usage"),
+            "llm_cache": llm_cache.request_stats(),
             "failover": steps.get("failover"),
             "scope": steps.get("scope"),
             "scope_raw": getattr(g, "scope_raw", None),
+            "conversation": steps.get("conversation"),
             "validator": steps.get("validator"),
+            "skipped": skipped,
             "ui": {"show_sources": not hide_sources, "hide_reason": hide_reason},
         },
     }
@@ -351,6 +536,17 @@ def answer(query: str, mode: str = "doc", debug: bool = False) -> Dict[str, Any]
 
     current_app.logger.info("rag.trace", extra={"trace": trace})
 
+    conv_next = None
+    if conversation_id or new_conversation:
+        # 続きの質問では前回の候補をそのまま残す（使い回した回数は record_turn が数える）
+        retrieval = None if follow_up else {
+            "mode": mode, "query": query,
+            "doc": steps.get("_doc_candidates"), "web": steps.get("_web_candidates"),
+        }
+        conv_next = conversation.record_turn(conv_state, query, answer_text, mode, retrieval, steps["scope"])
+        if conversation_id:
+            conversation.save(conversation_id, conv_next)
+
     payload: Dict[str, Any] = {
         "answer": answer_text,
         "sources": ui_sources,
@@ -358,15 +554,21 @@ def answer(query: str, mode: str = "doc", debug: bool = False) -> Dict[str, Any]
     }
     if hide_sources:
         payload["meta"]["hide_reason"] = hide_reason
+    if skipped:
+        payload["meta"]["skipped"] = skipped
+        payload["meta"]["notice"] = _skip_notice(skipped)
 
     if debug and current_app.config.get("DEBUG_RAG", False):
         payload["trace"] = trace
+    if new_conversation and conv_next is not None:
+        payload["_conversation_state"] = conv_next
     return payload
 
 # ===== 質問のドメイン内外判定 =====
-def in_scope_llm(query: str) -> tuple[str, float, str]:
+def in_scope_llm(query: str, previous: str = None) -> tuple[str, float, str]:
     """
     SYS_PROMPTは使わず、分類器専用のsystemで厳格にJSON返却させる。
+    previous（会話の直前の質問）は「その〜」などの指示語の解決にだけ使い、判定は質問文の話題で行う。
     """
     # ★ 分類器はアプリ共通SYSではなく専用system
     sys_msg = "あなたはJSONのみを返す分類器です。出力以外は一切書かないでください。"
@@ -384,7 +586,8 @@ def in_scope_llm(query: str) -> tuple[str, float, str]:
         '{"label":"IN","score":0.95,"reason":"補助金に直接言及"}\n'
         "例2: 質問『秋葉原のラーメン』→"
         '{"label":"OUT","score":0.98,"reason":"支援制度と無関係"}\n\n'
-        f"質問: {query}"
+        + (f"直前の質問（指示語の参照先。これ自体は判定しない）: {previous}\n" if previous else "")
+        + f"質問: {query}"
     )
     messages = [{"role":"system","content":sys_msg}, {"role":"user","content":user}]
 
@@ -425,26 +628,29 @@ def in_scope_llm(query: str) -> tuple[str, float, str]:
 def generate_answer(query: str, mode: str,
                     params: Dict[str, Any],
                     timing: Dict[str, int],
-                    steps: Dict[str, Any]) -> tuple[str, List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], Any]:
+                    steps: Dict[str, Any],
+                    reuse: Dict[str, Any] = None,
+                    history: str = "") -> tuple[str, List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], Any]:
     if mode == "web":
-        w = _web(query, params, timing, steps)
+        w = _web(query, params, timing, steps, reuse=reuse, history=history)
         return w["answer"], w.get("sources", []), [], w.get("web_hits", []), None
 
     if mode == "hybrid":
-        d = _doc(query, params, timing, steps)
-        w = _web(query, params, timing, steps)
+        d = _doc(query, params, timing, steps, reuse=reuse, history=history)
+        w = _web(query, params, timing, steps, reuse=reuse, history=history)
         doc_hits, web_hits = d.get("doc_hits", []), w.get("web_hits", [])
-        # 再要約（doc + web）の軽量文脈
+        # 再要約（doc + web）の軽量文脈。締め切りが近ければ再要約は飛ばし、doc / web それぞれの回答を並べる
+        resummarize = deadline.allow("hybrid_resummarize", int(current_app.config.get("DEADLINE_RESUMMARIZE_MS", 6000)))
         contexts: List[str] = []
-        for s in (d.get("sources", []) + w.get("sources", []))[:6]:
+        for s in (d.get("sources", []) + w.get("sources", []))[:6] if resummarize else []:
             if s.get("kind") == "web" and s.get("url"):
-                txt = _fetch_text(s["url"])
+                txt = _fetch_text(s["url"], steps)
                 if txt: contexts.append(txt[:1500])
             elif s.get("kind") == "doc" and s.get("path"):
                 prev = read_preview(s["path"], limit=1500)
                 if prev: contexts.append(prev)
         if contexts:
-            answer_text = _summarize(contexts, query, timing=timing, steps=steps)
+            answer_text = _summarize(contexts, query, timing=timing, steps=steps, history=history)
         else:
             answer_text = f"{d['answer']}\n\n{w['answer']}"
         sources = d.get("sources", []) + w.get("sources", [])
@@ -455,7 +661,7 @@ def generate_answer(query: str, mode: str,
     # default: doc
     if mode not in ("doc", "web", "hybrid"):
         raise ValueError(f"invalid mode: {mode}")
-    d = _doc(query, params, timing, steps)
+    d = _doc(query, params, timing, steps, reuse=reuse, history=history)
     return d["answer"], d.get("sources", []), d.get("doc_hits", []), [], None
 
 # ===== 回答バリデーション =====
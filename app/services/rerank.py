@@ -0,0 +1,77 @@
+# app/services/rerank.py
+"""
+CPU のクロスエンコーダ（sentence-transformers）で FAISS 候補を並べ替える。
+時間予算（RERANK_BUDGET_MS）を超えたらそこで採点を打ち切り、未採点の候補は FAISS 順のまま後ろに回す。
+"""
+import time
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import current_app
+
+_model = None
+_model_name: Optional[str] = None
+_model_lock = threading.Lock()
+
+
+def _get_model():
+    """CrossEncoder を1プロセス1回だけロード（sentence-transformers は任意依存）"""
+    global _model, _model_name
+    name = current_app.config.get("RERANK_MODEL")
+    if _model is None or _model_name != name:
+        with _model_lock:
+            if _model is None or _model_name != name:
+                from sentence_transformers import CrossEncoder
+                _model = CrossEncoder(name, device="cpu",
+                                      max_length=int(current_app.config.get("RERANK_MAX_LENGTH", 512)))
+                _model_name = name
+    return _model
+
+
+def rerank(query: str, hits: List[Dict[str, Any]], top_n: int) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    hits（"text" 付きの FAISS 候補、スコア順）をクロスエンコーダで採点し直して上位 top_n 件を返す。
+    戻り値: (並べ替え後の上位, trace 用の情報)
+    """
+    t0 = time.perf_counter()
+    budget_ms = int(current_app.config.get("RERANK_BUDGET_MS", 300))
+    batch = max(1, int(current_app.config.get("RERANK_BATCH", 8)))
+    info: Dict[str, Any] = {"model": current_app.config.get("RERANK_MODEL"), "candidates": len(hits),
+                            "scored": 0, "budget_ms": budget_ms, "budget_hit": False}
+
+    cands = [h for h in hits if h.get("text")]
+    if not cands:
+        info.update({"skipped": "no_text", "ms": 0})
+        return hits[:top_n], info
+    try:
+        model = _get_model()
+    except ImportError:
+        info.update({"skipped": "sentence_transformers_not_installed", "ms": 0})
+        return hits[:top_n], info
+
+    scores: List[float] = []
+    for i in range(0, len(cands), batch):
+        if scores and (time.perf_counter() - t0) * 1000 > budget_ms:
+            info["budget_hit"] = True
+            break
+        pairs = [(query, h["text"]) for h in cands[i:i + batch]]
+        scores.extend(float(s) for s in model.predict(pairs, batch_size=batch, show_progress_bar=False))
+
+    scored = sorted(zip(cands[:len(scores)], scores), key=lambda x: -x[1])
+    ranked = [dict(h, rerank_score=s) for h, s in scored] + cands[len(scores):]
+
+    # FAISS順位 → 再ランク後順位 の移動量（どれだけ並びが変わったか）
+    faiss_rank = {id(h): r for r, h in enumerate(hits, start=1)}
+    shift = []
+    for r, (h, s) in enumerate(scored, start=1):
+        fr = faiss_rank[id(h)]
+        shift.append({"doc": h.get("doc"), "chunk_id": h.get("chunk_id"), "faiss_rank": fr, "rerank_rank": r,
+                      "faiss_score": h.get("score"), "rerank_score": round(s, 4)})
+    info.update({
+        "scored": len(scores),
+        "ms": int((time.perf_counter() - t0) * 1000),
+        "top1_changed": bool(shift) and shift[0]["faiss_rank"] != 1,
+        "mean_abs_rank_shift": round(sum(abs(x["faiss_rank"] - x["rerank_rank"]) for x in shift) / len(shift), 3) if shift else 0.0,
+        "shift": shift[:max(top_n, 10)],
+    })
+    return ranked[:top_n], info
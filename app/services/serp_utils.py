@@ -5,10 +5,9 @@ import time
 from typing import Dict, Any, List, Optional, Iterable, TypedDict
 from urllib.parse import urlparse
 
-from dotenv import load_dotenv
-from serpapi import GoogleSearch
+from .lazy import lazy_import
 
-load_dotenv()
+serpapi = lazy_import("serpapi")
 
 # === 環境変数からAPIキー取得（両表記に対応） ===
 def get_serpapi_key() -> str:
@@ -30,16 +29,29 @@ class Hit(TypedDict, total=False):
     date: str    # ニュースなどで使う
 
 # === 指数バックオフ付きの呼び出し ===
-def serpapi_call(params: Dict[str, Any], retries: int = 4, timeout: float = 10.0) -> Dict[str, Any]:
+def serpapi_call(params: Dict[str, Any], retries: int = 4, timeout: float = 10.0,
+                 budget: Optional[float] = None) -> Dict[str, Any]:
+    """
+    timeout は1回の呼び出しの秒数。budget（秒）を渡すとリトライ・待ちを含めた全体をその時間内に収める
+    （残りで次を試せなければ打ち切る）
+    """
     backoff = 1.0
     last_err: Optional[Exception] = None
+    stop_at = time.monotonic() + budget if budget is not None else None
     for _ in range(retries):
+        t = timeout
+        if stop_at is not None:
+            t = min(timeout, stop_at - time.monotonic())
+            if t <= 0:
+                break
         try:
-            search = GoogleSearch(params)
-            # GoogleSearch側でtimeoutは管理されるため、明示的timeoutは不要
+            search = serpapi.GoogleSearch(params)
+            search.timeout = t  # requests.get の timeout になる（既定は実質無制限）
             return search.get_dict()
         except Exception as e:
             last_err = e
+            if stop_at is not None and time.monotonic() + backoff >= stop_at:
+                break
             time.sleep(backoff)
             backoff *= 2
     raise RuntimeError(f"SerpAPI呼び出しに失敗: {repr(last_err)}")
@@ -92,10 +104,13 @@ def normalize_news(data: Dict[str, Any]) -> List[Hit]:
 
 # === Google検索（ページング対応・重複除去・ドメイン多様性） ===
 def google_search(q: str, *, hl: str = "ja", gl: str = "jp", safe: str = "active",
-                  num: int = 10, pages: int = 1, tbs: Optional[str] = None) -> List[Hit]:
+                  num: int = 10, pages: int = 1, tbs: Optional[str] = None,
+                  budget: Optional[float] = None) -> List[Hit]:
+    """budget（秒）を渡すと全ページ・リトライを含めてその時間内に収める"""
     api_key = get_serpapi_key()
     all_hits: List[Hit] = []
     seen_urls = set()
+    stop_at = time.monotonic() + budget if budget is not None else None
 
     for p in range(pages):
         params = {
@@ -111,7 +126,9 @@ def google_search(q: str, *, hl: str = "ja", gl: str = "jp", safe: str = "active
         if tbs:
             params["tbs"] = tbs  # 期間指定など
 
-        data = serpapi_call(params)
+        if stop_at is not None and stop_at <= time.monotonic():
+            break
+        data = serpapi_call(params, budget=stop_at - time.monotonic() if stop_at is not None else None)
         hits = normalize_organic(data)
 
         # URL重複を弾く
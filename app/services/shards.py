@@ -0,0 +1,274 @@
+# app/services/shards.py
+"""
+ベクトルインデックスのシャード分割と scatter-gather 検索。
+
+INDEX_SHARDS > 1 のとき、版ディレクトリは次の形になる:
+  versions/<版名>/shards.json   … シャード数・割り当て方式・シャードごとの文書一覧（名前, sha256）
+  versions/<版名>/shards/<k>/   … faiss.index / meta / vectors.npy / index_info.json（非シャード版と同じ形式）
+  versions/<版名>/catalog.json, index_info.json（全体の一覧・集計）
+文書は sha256 の先頭32bitをシャード数で割った余りで割り当てる（同じ内容は常に同じシャード）。
+取り込みでは、文書一覧と取り込み設定が前の版と同じシャードはハードリンクで引き継ぎ、変わったシャードだけ作り直す。
+
+検索ではクエリを1回だけ埋め込み、全シャードをスレッドプールで並列に検索し、各シャードの上位k件から全体の上位k件を選ぶ。
+INDEX_REMOTE_SHARDS（カンマ区切りURL）を指定すると、scripts/shard_server.py で立てたシャードサーバも同じように検索する。
+複数クエリ（言い換え）は scatter_search_multi で、シャードごとに全クエリを1回で検索してクエリごとにマージする。
+"""
+from __future__ import annotations
+
+import os
+import json
+import heapq
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from flask import current_app
+
+from .lazy import lazy_import
+
+from .vectorstore import (SHARDS_DIRNAME, SHARDS_MANIFEST, active_index_dir, faiss_save, ingest_signature,
+                          is_sharded, load_index_info, search_vectors_multi)
+
+np = lazy_import("numpy")
+requests = lazy_import("requests")
+
+SCHEME = "sha256_mod"
+
+
+def shard_of(sha: str, n: int) -> int:
+    """文書の割り当て先シャード"""
+    return int(sha[:8], 16) % n if n > 1 else 0
+
+
+def load_manifest(root: Optional[str] = None) -> Dict[str, Any]:
+    """shards.json（シャード版でなければ {}）"""
+    try:
+        with open(os.path.join(root or active_index_dir(), SHARDS_MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# ===== 検索対象 =====
+class LocalShard:
+    """このプロセスで mmap して検索するシャード（非シャード版のインデックス1つも同じ扱い）"""
+
+    def __init__(self, root: str, name: str):
+        self.root = root
+        self.name = name
+
+    def search(self, qvs: np.ndarray, k: int, with_text: bool) -> List[List[Dict]]:
+        return search_vectors_multi(self.root, qvs, k, with_text)
+
+
+_local = threading.local()
+
+
+class RemoteShard:
+    """scripts/shard_server.py の POST /search を呼ぶシャード"""
+
+    def __init__(self, url: str, timeout: float):
+        self.url = url.rstrip("/")
+        self.name = self.url
+        self.timeout = timeout
+
+    def search(self, qvs: np.ndarray, k: int, with_text: bool) -> List[List[Dict]]:
+        session = getattr(_local, "session", None)
+        if session is None:
+            session = _local.session = requests.Session()
+        r = session.post(f"{self.url}/search", timeout=self.timeout, json={
+            "vectors": qvs.tolist(), "k": k, "with_text": with_text,
+            "embed_model": current_app.config["EMBED_MODEL"]})
+        r.raise_for_status()
+        return r.json().get("hits") or [[] for _ in range(len(qvs))]
+
+
+def list_shards(root: Optional[str] = None) -> List[Any]:
+    """検索するシャード（ローカルの各シャード＋INDEX_REMOTE_SHARDS）"""
+    root = root or active_index_dir()
+    out: List[Any] = []
+    if is_sharded(root):
+        for e in load_manifest(root).get("entries", []):
+            if e.get("dir"):
+                out.append(LocalShard(os.path.join(root, e["dir"]), f"local:{e['id']}"))
+    elif os.path.exists(os.path.join(root, "faiss.index")):
+        out.append(LocalShard(root, "local"))
+    cfg = current_app.config
+    timeout = float(cfg.get("INDEX_REMOTE_TIMEOUT", 2.0))
+    for url in (cfg.get("INDEX_REMOTE_SHARDS") or "").split(","):
+        if url.strip():
+            out.append(RemoteShard(url.strip(), timeout))
+    return out
+
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    # fork 前（gunicorn のマスター）には作らない。最初の検索時にワーカー内で作る
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=int(current_app.config.get("INDEX_SEARCH_THREADS", 8)),
+                                           thread_name_prefix="shard-search")
+    return _pool
+
+
+def scatter_search(root: str, qv: np.ndarray, k: int, with_text: bool = False) -> List[Dict]:
+    """
+    全シャードを並列に検索し、スコア順に上位k件へマージする。各ヒットには "shard" を付ける。
+    リモートシャードの失敗はログに残して残りのシャードで返す（ローカルの失敗・全滅は例外）
+    """
+    return scatter_search_multi(root, qv.reshape(1, -1), k, with_text)[0]
+
+
+def scatter_search_multi(root: str, qvs: np.ndarray, k: int, with_text: bool = False) -> List[List[Dict]]:
+    """scatter_search の複数クエリ版（シャードごとに全クエリを1回で検索し、クエリごとに上位k件へマージ）"""
+    shards = list_shards(root)
+    if not shards:
+        raise RuntimeError("検索できるシャードがありません。再インデックスしてください。")
+    app = current_app._get_current_object()
+
+    def run(shard) -> List[List[Dict]]:
+        with app.app_context():
+            rows = shard.search(qvs, k, with_text)
+        for hits in rows:
+            for h in hits:
+                h["shard"] = shard.name
+        return rows
+
+    if len(shards) == 1:
+        return [hits[:k] for hits in run(shards[0])]
+    futures = [(s, _executor().submit(run, s)) for s in shards]
+    merged: List[List[Dict]] = [[] for _ in range(len(qvs))]
+    failed = []
+    for shard, fut in futures:
+        try:
+            for row, hits in zip(merged, fut.result()):
+                row.extend(hits)
+        except requests.RequestException as e:
+            failed.append(shard.name)
+            current_app.logger.warning("index.shard_error", extra={"trace": {
+                "schema_version": 1, "shard": shard.name, "error": f"{type(e).__name__}: {e}"}})
+    if len(failed) == len(shards):
+        raise RuntimeError(f"全シャードの検索に失敗しました: {failed}")
+    return [heapq.nlargest(k, hits, key=lambda h: h["score"]) for hits in merged]
+
+
+# ===== 取り込み（シャードごとに作成 / 引き継ぎ） =====
+def _link_tree(src: str, dst: str):
+    """前の版のシャードをハードリンクで引き継ぐ（版は作成後に書き換えないので共有してよい）。別FSならコピー"""
+    def link(s, d):
+        try:
+            os.link(s, d)
+        except OSError:
+            shutil.copy2(s, d)
+    shutil.copytree(src, dst, copy_function=link)
+
+
+def _shard_docs(catalog: List[Dict], n: int) -> List[List[List[str]]]:
+    docs: List[List[List[str]]] = [[] for _ in range(n)]
+    for entry in catalog:
+        docs[shard_of(entry["sha256"], n)].append([entry["name"], entry["sha256"]])
+    return [sorted(d) for d in docs]
+
+
+def check_shard_config(n: int):
+    """
+    シャード分割できる設定か確かめる（できなければ ValueError）。
+    EMBED_DIM_METHOD=pca はシャードごとに別の射影を学習するので、シャード間でスコアを比べられずマージできない
+    """
+    cfg = current_app.config
+    if n > 1 and cfg.get("EMBED_DIM") and (cfg.get("EMBED_DIM_METHOD") or "api").lower() == "pca":
+        raise ValueError("INDEX_SHARDS > 1 と EMBED_DIM_METHOD=pca は併用できません（api 方式で次元を落としてください）")
+
+
+def reusable_shards(catalog: List[Dict], n: int, rebuild: Iterable[int] = ()) -> Set[int]:
+    """前の版から引き継げるシャード（シャード数・取り込み設定・保存形式・文書一覧が同じ）"""
+    root = active_index_dir()
+    old = load_manifest(root)
+    if not old or old.get("shards") != n or old.get("scheme") != SCHEME:
+        return set()
+    storage = (current_app.config.get("VECTOR_STORAGE") or "flat").lower()
+    if old.get("ingest_signature") != ingest_signature() or old.get("storage") != storage:
+        return set()
+    docs = _shard_docs(catalog, n)
+    rebuild = set(rebuild)
+    out = set()
+    for e in old.get("entries", []):
+        k = e["id"]
+        if k in rebuild or k >= n or e.get("docs") != docs[k]:
+            continue
+        if e.get("dir") is None or os.path.isdir(os.path.join(root, e["dir"])):
+            out.add(k)
+    return out
+
+
+def save_shards(staging: str, n: int, vecs: List, metas: List[Dict], texts: List[str],
+                catalog: List[Dict], keep: Set[int]) -> Dict:
+    """
+    staging にシャード版を作る。keep のシャードは稼働版からハードリンク、それ以外は faiss_save で作る。
+    vecs は catalog の順に並んだチャンクのベクトル（keep のシャードの分は None でよい）
+    戻り値: 全体の index_info（シャードごとのビルドレポートを含む）
+    """
+    active = active_index_dir()
+    old = {e["id"]: e for e in load_manifest(active).get("entries", [])}
+    docs = _shard_docs(catalog, n)
+    rows: List[List[int]] = [[] for _ in range(n)]
+    start = 0
+    for entry in catalog:
+        k = shard_of(entry["sha256"], n)
+        rows[k].extend(range(start, start + entry["chunks"]))
+        start += entry["chunks"]
+
+    entries, reports = [], []
+    for k in range(n):
+        rel = os.path.join(SHARDS_DIRNAME, str(k)) if rows[k] else None
+        if rel and k in keep:
+            _link_tree(os.path.join(active, old[k]["dir"]), os.path.join(staging, rel))
+            report, built = load_index_info(os.path.join(staging, rel)), False
+        elif rel:
+            ids = rows[k]
+            report = faiss_save(np.asarray([vecs[i] for i in ids], dtype="float32"), [metas[i] for i in ids],
+                                root=os.path.join(staging, rel), texts=[texts[i] for i in ids])
+            built = True
+        else:
+            report, built = {}, False
+        entries.append({"id": k, "dir": rel, "docs": docs[k], "chunks": len(rows[k]), "built": built})
+        reports.append({"id": k, **{key: report.get(key) for key in ("vectors", "index_bytes", "recall_at_k")}})
+
+    first = next((r for r in (load_index_info(os.path.join(staging, e["dir"])) for e in entries if e["dir"])), {})
+    storage = (current_app.config.get("VECTOR_STORAGE") or "flat").lower()
+    info = {"schema_version": 1, "shards": n, "scheme": SCHEME, "storage": storage,
+            "vectors": sum(e["chunks"] for e in entries),
+            "rebuilt_shards": [e["id"] for e in entries if e["built"]],
+            "shard_reports": reports,
+            **{key: first.get(key) for key in ("dim", "embed_model", "embed_dim_target", "dim_method")},
+            "ingest_signature": ingest_signature()}
+    with open(os.path.join(staging, "index_info.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False)
+    # shards.json は最後に置く（これがあればシャード版として揃っている）
+    manifest = {"schema_version": 1, "shards": n, "scheme": SCHEME, "storage": storage,
+                "ingest_signature": ingest_signature(), "entries": entries}
+    tmp = os.path.join(staging, SHARDS_MANIFEST + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, os.path.join(staging, SHARDS_MANIFEST))
+    return info
+
+
+def shard_status(root: Optional[str] = None) -> List[Dict[str, Any]]:
+    """稼働版のシャードごとの文書数・チャンク数・ファイルサイズ"""
+    root = root or active_index_dir()
+    out = []
+    for e in load_manifest(root).get("entries", []):
+        size = 0
+        if e.get("dir"):
+            for dirpath, _, names in os.walk(os.path.join(root, e["dir"])):
+                size += sum(os.path.getsize(os.path.join(dirpath, n)) for n in names)
+        out.append({"id": e["id"], "docs": len(e.get("docs", [])), "chunks": e.get("chunks", 0),
+                    "bytes": size, "built_in_this_version": e.get("built", False)})
+    return out
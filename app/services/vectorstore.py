@@ -1,146 +1,541 @@
 # app/services/vectorstore.py
-import os, json
-from typing import List, Dict, Tuple
+from __future__ import annotations
+import os, json, time, shutil, threading
+from typing import List, Dict, Tuple, Optional
 from flask import current_app
-import faiss
-import numpy as np
+from .lazy import lazy_import
 from .llm_utils import embed_texts
 from .doc_utils import page_count_pdf
+from .chunker import chunker_config
+from .dedup import dedup_config
+from .metastore import MetaStore, write_metas, migrate_jsonl, META_DIRNAME, LEGACY_JSONL
+
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
+
+# ===== 稼働中インデックスの切り替え（ダブルバッファ） =====
+# INDEX_DIR/
+#   CURRENT              … 稼働中の版名（os.replace で原子的に差し替え）
+#   versions/<版名>/     … faiss.index / meta / vectors.npy / index_info.json / catalog.json
+#   staging/<ジョブID>/  … 作成中（完成したら versions/ へ rename）
+#   versions/<版名>/shards.json, shards/<k>/ … シャード分割した版（INDEX_SHARDS > 1。shards.py）
+# CURRENT が無い古い配置では INDEX_DIR 直下のファイルをそのまま使う。
+# 巡回したWebページの別コレクション（WEB_INDEX_DIR。crawler.py）も同じ配置で、base に渡して使う。
+SHARDS_DIRNAME = "shards"
+SHARDS_MANIFEST = "shards.json"
+
+def active_index_dir(base: Optional[str] = None) -> str:
+    base = base or current_app.config["INDEX_DIR"]
+    try:
+        with open(os.path.join(base, "CURRENT"), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+        if name:
+            return os.path.join(base, "versions", name)
+    except OSError:
+        pass
+    return base
+
+def new_staging_dir(name: str, base: Optional[str] = None) -> str:
+    path = os.path.join(base or current_app.config["INDEX_DIR"], "staging", name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+def promote_index(staging: str, base: Optional[str] = None) -> str:
+    """作成済みの staging を versions/ へ移し、CURRENT を差し替えて稼働版にする。戻り値は版名"""
+    base = base or current_app.config["INDEX_DIR"]
+    os.makedirs(os.path.join(base, "versions"), exist_ok=True)
+    name = time.strftime("%Y%m%d-%H%M%S") + "-" + os.path.basename(staging)
+    # 同じ秒に同名の staging を昇格した場合は連番を付ける（古い版の削除は名前順なので、既存より後ろに並ぶ番号にする）
+    same = [v for v in os.listdir(os.path.join(base, "versions")) if v == name or v.startswith(name + ".")]
+    if same:
+        last = max(int(v[len(name) + 1:] or 0) if v != name else 0 for v in same)
+        name = f"{name}.{last + 1:03d}"
+    os.replace(staging, os.path.join(base, "versions", name))
+    tmp = os.path.join(base, f"CURRENT.tmp-{os.getpid()}")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(tmp, os.path.join(base, "CURRENT"))
+    _prune_versions(base, keep=int(current_app.config.get("INDEX_KEEP_VERSIONS", 2)))
+    return name
+
+def _prune_versions(base: str, keep: int):
+    """古い版を削除（直前の版は読み取り中のリクエストがあり得るので keep 件残す）"""
+    vdir = os.path.join(base, "versions")
+    names = sorted(os.listdir(vdir))
+    for name in names[:-max(1, keep)]:
+        shutil.rmtree(os.path.join(vdir, name), ignore_errors=True)
 
 # インデックス保存先ディレクトリを作成し、
-# FAISSバイナリ(index)とメタデータ(JSON Lines)の各パスを返す
-def _paths() -> Tuple[str, str]:
-    idx_dir = current_app.config["INDEX_DIR"]
+# FAISSバイナリ(index)とメタデータ(列指向ディレクトリ)の各パスを返す
+def _paths(root: Optional[str] = None) -> Tuple[str, str]:
+    idx_dir = root or active_index_dir()
     os.makedirs(idx_dir, exist_ok=True)
-    return os.path.join(idx_dir, "faiss.index"), os.path.join(idx_dir, "meta.jsonl")
+    return os.path.join(idx_dir, "faiss.index"), os.path.join(idx_dir, META_DIRNAME)
+
+def is_sharded(root: Optional[str] = None) -> bool:
+    return os.path.exists(os.path.join(root or active_index_dir(), SHARDS_MANIFEST))
+
+def index_roots(root: Optional[str] = None) -> List[str]:
+    """検索対象のインデックスディレクトリ（シャード版ならベクトルを持つ各シャード、そうでなければ root 自身）"""
+    root = root or active_index_dir()
+    if not is_sharded(root):
+        return [root]
+    with open(os.path.join(root, SHARDS_MANIFEST), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    return [os.path.join(root, e["dir"]) for e in manifest.get("entries", []) if e.get("dir")]
+
+# FAISSのインデックスファイルとメタデータが両方存在するかを確認（旧 meta.jsonl も可）
+def faiss_exists(root: Optional[str] = None) -> bool:
+    if root is None and current_app.config.get("INDEX_REMOTE_SHARDS"):
+        return True  # 検索はリモートのシャードサーバだけでもできる
+    root = root or active_index_dir()
+    if is_sharded(root):
+        return True  # shards.json は全シャードを書き終えてから置く
+    idx, meta = _paths(root)
+    legacy = os.path.join(os.path.dirname(meta), LEGACY_JSONL)
+    return os.path.exists(idx) and (os.path.isdir(meta) or os.path.exists(legacy))
+
+# インデックスの版（版ディレクトリ＋更新時刻とサイズ）。再インデックスで変わるのでキャッシュキーに使う
+def index_version(root: Optional[str] = None) -> str:
+    root = root or active_index_dir()
+    idx = os.path.join(root, SHARDS_MANIFEST) if is_sharded(root) else _paths(root)[0]
+    try:
+        st = os.stat(idx)
+    except OSError:
+        return "none"
+    name = os.path.basename(root)
+    if os.path.basename(os.path.dirname(root)) == SHARDS_DIRNAME:  # シャードは 版名/shards/k
+        name = f"{os.path.basename(os.path.dirname(os.path.dirname(root)))}/{name}"
+    return f"{name}-{st.st_mtime_ns:x}-{st.st_size:x}"
+
+# ===== 開いたインデックス・メタのプロセス内キャッシュ =====
+# キーは開いたディレクトリ。同じディレクトリの版が変わったら開き直し、
+# 別の版を開いた時点で同じコレクションの古い版（のシャード群）の分は捨てる（参照が切れれば munmap される）
+def _version_dir(root: str) -> str:
+    parent = os.path.dirname(root)
+    return os.path.dirname(parent) if os.path.basename(parent) == SHARDS_DIRNAME else root
+
+def _collection_dir(root: str) -> str:
+    """版ディレクトリの持ち主（INDEX_DIR / WEB_INDEX_DIR）"""
+    vdir = _version_dir(root)
+    parent = os.path.dirname(vdir)
+    return os.path.dirname(parent) if os.path.basename(parent) == "versions" else vdir
+
+def _cached(cache: Dict[str, Tuple[str, object]], lock: threading.Lock, root: str, make):
+    ver = index_version(root)
+    with lock:
+        hit = cache.get(root)
+        if hit is not None and hit[0] == ver:
+            return hit[1]
+        obj = make()
+        family, owner = _version_dir(root), _collection_dir(root)
+        for r in [r for r in cache if r == root or (_version_dir(r) != family and _collection_dir(r) == owner)]:
+            del cache[r]
+        cache[root] = (ver, obj)
+    return obj
+
+# ===== メタデータ（列指向・mmap） =====
+_meta_cache: Dict[str, Tuple[str, MetaStore]] = {}
+_meta_lock = threading.Lock()
+
+def load_meta(root: Optional[str] = None) -> MetaStore:
+    """メタストアを開く（版ごとにキャッシュ）。旧 meta.jsonl しか無ければここで一度だけ変換"""
+    root = root or active_index_dir()
+
+    def make():
+        _, meta_dir = _paths(root)
+        migrate_jsonl(os.path.dirname(meta_dir))
+        return MetaStore(meta_dir)
+    return _cached(_meta_cache, _meta_lock, root, make)
+
+
+# ===== ベクトル保存形式（flat / fp16 / int8） =====
+_SQ_TYPES = {
+    "fp16": "QT_fp16",
+    "int8": "QT_8bit",
+}
+
+def _index_file(name: str, root: Optional[str] = None) -> str:
+    return os.path.join(root or active_index_dir(), name)
+
+def load_index_info(root: Optional[str] = None) -> Dict:
+    """index_info.json（保存形式・次元・ビルド時レポート）。古いインデックスでは {}"""
+    try:
+        with open(_index_file("index_info.json", root), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# ===== 検索用に開いたインデックス（プロセス内で版ごとに1つ） =====
+# INDEX_MMAP=1 では faiss.index を IO_FLAG_MMAP_IFC で開き、ベクトル本体はファイルを mmap したまま使う。
+# メタ(列指向)・vectors.npy も mmap なので、gunicorn の全ワーカーが同じページキャッシュを共有する。
+_index_cache: Dict[str, Tuple[str, "faiss.Index"]] = {}
+_full_cache: Dict[str, Tuple[str, np.ndarray]] = {}
+_index_lock = threading.Lock()
+
+def _mmap_flag() -> int:
+    # IO_FLAG_MMAP_IFC（faiss 1.10+）は Flat/SQ のコードもコピーせず mmap する。古い faiss は IO_FLAG_MMAP
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+def load_index(root: Optional[str] = None):
+    """検索用の FAISS インデックス（版ごとにキャッシュ。INDEX_MMAP なら mmap で開く）"""
+    root = root or active_index_dir()
+
+    def make():
+        idx_path, _ = _paths(root)
+        if current_app.config.get("INDEX_MMAP", True):
+            return faiss.read_index(idx_path, _mmap_flag())
+        return faiss.read_index(idx_path)
+    return _cached(_index_cache, _index_lock, root, make)
+
+def _load_full_vectors(root: str) -> np.ndarray:
+    """再ランク用のフル精度ベクトル（mmap）"""
+    return _cached(_full_cache, _index_lock, root,
+                   lambda: np.load(_index_file("vectors.npy", root), mmap_mode="r"))
+
+def _prefault(path: str, bufsize: int = 1 << 20):
+    """ファイルを読み流してページキャッシュに載せる（プロセスのメモリには残らない）"""
+    try:
+        with open(path, "rb", buffering=0) as f:
+            while f.read(bufsize):
+                pass
+    except OSError:
+        pass
+
+def warm_up(load: bool = True, probe: bool = False) -> Dict:
+    """
+    起動直後の初回検索が遅くならないように、稼働中インデックスのファイルをページキャッシュへ載せる。
+    load=True ならこのプロセスでインデックス・メタ・カタログを開いておく（gunicorn ではワーカー起動時に呼ぶ）。
+    probe=True ならさらにゼロベクトルで1件検索し、FAISS の初回検索時の準備（スレッド・再ランク用 mmap）も済ませる。
+    """
+    t = time.perf_counter()
+    root = active_index_dir()
+    if not faiss_exists(root):
+        return {"ok": False, "reason": "no_index"}
+    roots = index_roots(root)
+    files = []
+    for r in roots:
+        idx_path, meta_dir = _paths(r)
+        files += [idx_path, _index_file("vectors.npy", r)]
+        files += [os.path.join(meta_dir, n) for n in os.listdir(meta_dir)] if os.path.isdir(meta_dir) else []
+    for path in files:
+        if os.path.exists(path):
+            _prefault(path)
+    out: Dict = {"ok": True, "version": index_version(root), "files": len(files), "shards": len(roots)}
+    if load:
+        vectors = 0
+        for r in roots:
+            index = load_index(r)
+            vectors += int(index.ntotal)
+            load_meta(r)
+            if probe and index.ntotal:
+                full = _load_full_vectors(r) if load_index_info(r).get("storage", "flat") != "flat" else None
+                _search_reranked(index, full, np.zeros((1, index.d), dtype="float32"), 1, 1)
+        load_catalog(root)
+        out.update({"vectors": vectors, "mmap": bool(current_app.config.get("INDEX_MMAP", True))})
+    out["ms"] = int((time.perf_counter() - t) * 1000)
+    return out
+
+# ===== 埋め込み次元（短縮 / PCA） =====
+def _dim_config() -> Tuple[Optional[int], str]:
+    """(目標次元 or None=フル, 方式 "api"|"pca")"""
+    dim = int(current_app.config.get("EMBED_DIM") or 0) or None
+    method = (current_app.config.get("EMBED_DIM_METHOD") or "api").lower()
+    if method not in ("api", "pca"):
+        raise ValueError(f"EMBED_DIM_METHOD は api|pca のいずれかです: {method}")
+    return dim, method
+
+def embed_request_dim() -> Optional[int]:
+    """埋め込みAPIに要求する次元（api方式のみ。pca はフル次元で受け取って取り込み時に射影）"""
+    dim, method = _dim_config()
+    return dim if method == "api" else None
+
+_pca_cache: Dict[str, Tuple[str, "faiss.VectorTransform"]] = {}
+_pca_lock = threading.Lock()
+
+def _load_pca(root: str):
+    return _cached(_pca_cache, _pca_lock, root, lambda: faiss.read_VectorTransform(_index_file("pca.bin", root)))
+
+def check_query_dim(info: Dict):
+    """インデックス作成時と現在の設定で埋め込みモデル・次元が食い違う場合は検索を拒否"""
+    if not info.get("embed_model"):
+        return  # 次元情報を持たない古いインデックス（検索時のベクトル長チェックのみ）
+    dim, method = _dim_config()
+    want = {"embed_model": current_app.config["EMBED_MODEL"], "embed_dim_target": dim, "dim_method": method}
+    have = {key: info.get(key) for key in want}
+    if want != have:
+        raise RuntimeError(
+            f"インデックスの埋め込み設定 {have} が現在の設定 {want} と一致しません。再インデックスしてください。")
+
+def ingest_signature() -> Dict:
+    """ベクトルを使い回してよいかの判定に使う取り込み設定"""
+    dim, method = _dim_config()
+    return {"embed_model": current_app.config["EMBED_MODEL"], "embed_dim_target": dim, "dim_method": method,
+            "chunker": chunker_config(), "dedup": dedup_config()}
+
+def reusable_vectors(signature: Dict, root: Optional[str] = None) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    稼働中インデックス（root で別コレクションも可）から {文書sha256: (フル精度ベクトル(mmap), 行番号(チャンク順))} を返す
+    （シャード版は各シャードから）。設定が変わった / PCA射影済み / 古い形式 / 無い の場合は再利用しない（空dict）
+    """
+    root = root or active_index_dir()
+    info = load_index_info(root)
+    if info.get("ingest_signature") != signature or info.get("dim_method") == "pca":
+        return {}
+    files = load_catalog(root)
+    if not files:
+        return {}
+    sha_by_path = {f["path"]: f.get("sha256") for f in files}
+    out: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+    for r in index_roots(root):
+        vec_path = _index_file("vectors.npy", r)
+        if not os.path.exists(vec_path):
+            continue
+        full = np.load(vec_path, mmap_mode="r")
+        ms = load_meta(r)
+        order = np.argsort(ms.doc, kind="stable")  # 文書ごとにまとめつつチャンク順は保つ
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(ms.doc, minlength=len(ms.paths)))])
+        for d, path in enumerate(ms.paths):
+            sha = sha_by_path.get(path)
+            if sha and bounds[d + 1] > bounds[d]:
+                out[sha] = (full, order[bounds[d]:bounds[d + 1]])
+    return out
+
+def _build_index(arr: np.ndarray, storage: str):
+    dim = arr.shape[1]
+    if storage == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif storage in _SQ_TYPES:
+        qtype = getattr(faiss.ScalarQuantizer, _SQ_TYPES[storage])
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+        index.train(arr)
+    else:
+        raise ValueError(f"VECTOR_STORAGE は flat|fp16|int8 のいずれかです: {storage}")
+    index.add(arr)
+    return index
+
+def _search_reranked(index, full: Optional[np.ndarray], qs: np.ndarray, k: int, overfetch: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    圧縮インデックスで k*overfetch 件を粗く拾い、フル精度ベクトル(mmap)で内積を取り直して上位k件に絞る。
+    full が None（flat）の場合はそのまま検索。
+    """
+    if full is None:
+        return index.search(qs, k)
+    D, I = index.search(qs, k * max(1, overfetch))
+    outD = np.full((len(qs), k), -np.inf, dtype="float32")
+    outI = np.full((len(qs), k), -1, dtype="int64")
+    for r in range(len(qs)):
+        cand = np.sort(I[r][I[r] >= 0])  # 昇順に読むとmmapのページアクセスが素直になる
+        if cand.size == 0:
+            continue
+        exact = np.asarray(full[cand], dtype="float32") @ qs[r]
+        order = np.argsort(-exact)[:k]
+        outD[r, :len(order)] = exact[order]
+        outI[r, :len(order)] = cand[order]
+    return outD, outI
+
+def _build_report(index, arr: np.ndarray, storage: str, overfetch: int) -> Dict:
+    """メモリ使用量と、flat を正解とした recall@k（フル精度での再ランク前後）を測る"""
+    n, dim = arr.shape
+    k = min(int(current_app.config.get("VECTOR_RECALL_K", 10)), n)
+    report = {
+        "storage": storage,
+        "vectors": int(n),
+        "dim": int(dim),
+        "index_bytes": int(faiss.serialize_index(index).size),
+        "flat_bytes": int(n * dim * 4),
+        "overfetch": overfetch,
+    }
+    if storage == "flat" or k == 0:
+        report["recall_at_k"] = {"k": k, "raw": 1.0, "reranked": 1.0}
+        return report
+
+    sample = min(int(current_app.config.get("VECTOR_RECALL_SAMPLE", 200)), n)
+    rng = np.random.default_rng(0)
+    qs = arr[rng.choice(n, size=sample, replace=False)]
+    flat = faiss.IndexFlatIP(dim)
+    flat.add(arr)
+    _, truth = flat.search(qs, k)
+    _, raw = index.search(qs, k)
+    _, rer = _search_reranked(index, arr, qs, k, overfetch)
 
-# FAISSのインデックスファイルとメタデータ(JSONL)が両方存在するかを確認
-def faiss_exists() -> bool:
-    idx, meta = _paths()
-    return os.path.exists(idx) and os.path.exists(meta)
+    def recall(found: np.ndarray) -> float:
+        hit = sum(len(set(t) & set(f[f >= 0])) for t, f in zip(truth.tolist(), found))
+        return round(hit / float(sample * k), 4)
 
+    report["recall_at_k"] = {"k": k, "queries": sample, "raw": recall(raw), "reranked": recall(rer)}
+    return report
 
-# ベクトル群と対応メタデータを受け取り、FAISSインデックス(内積)＋JSONLメタを保存する
-def faiss_save(vectors: List[List[float]], metas: List[Dict]):
-    import numpy as np, faiss, os, json
-    dim = len(vectors[0]) if vectors else 0
+# ベクトル群と対応メタデータを受け取り、FAISSインデックス(内積)＋列指向メタを保存する
+def faiss_save(vectors: List[List[float]], metas: List[Dict], root: Optional[str] = None,
+               texts: Optional[List[str]] = None) -> Dict:
+    """
+    root（既定は稼働中ディレクトリ。通常は staging）へ保存してビルドレポート（メモリ量・recall@k）を返す。
+    texts（チャンク本文）を渡すとメタと一緒に保存し、再ランクやコンテキストに使える
+    """
+    root = root or active_index_dir()
     arr = np.array(vectors, dtype="float32")
     # ★ 正規化（L2ノルム1に）
     norms = np.linalg.norm(arr, axis=1, keepdims=True) + 1e-12
     arr = arr / norms
 
-    index = faiss.IndexFlatIP(dim)
-    index.add(arr)
-    idx_path, meta_path = _paths()
-    faiss.write_index(index, idx_path)
-    with open(meta_path, "w", encoding="utf-8") as f:
-        for m in metas:
-            f.write(json.dumps(m, ensure_ascii=False) + "\n")
-
-
-# クエリを埋め込み→L2正規化→内積(IndexFlatIP)で上位k件を検索し、scoreとメタを返す
-def faiss_search(query: str, k: int = 5) -> List[Dict]:
-    """クエリを埋め込み→内積で上位k件返却"""
-    idx_path, meta_path = _paths()
-    index = faiss.read_index(idx_path)
-    with open(meta_path, "r", encoding="utf-8") as f:
-        metas = [json.loads(l) for l in f]
-
-    qv = embed_texts([query], model=current_app.config["EMBED_MODEL"])[0]
-    qv = np.asarray(qv, dtype="float32")
-    qv = qv / (np.linalg.norm(qv) + 1e-12) 
-    D, I = index.search(np.array([qv], dtype="float32"), k)
-    out = []
-    for score, idx in zip(D[0], I[0]):
-        if idx == -1: continue
-        m = metas[idx]
-        out.append({"score": float(score), **m})
-    return out
+    # PCA方式で次元を落とす（api方式は埋め込み時点で短縮済み）
+    target, method = _dim_config()
+    pca = None
+    if method == "pca" and target and arr.shape[1] > target:
+        pca = faiss.PCAMatrix(arr.shape[1], target)
+        pca.train(arr)
+        arr = pca.apply(arr)
+        arr = arr / (np.linalg.norm(arr, axis=1, keepdims=True) + 1e-12)
 
-def list_indexed_files() -> List[Dict]:
+    storage = (current_app.config.get("VECTOR_STORAGE") or "flat").lower()
+    overfetch = int(current_app.config.get("VECTOR_OVERFETCH", 4))
+    index = _build_index(arr, storage)
+    report = _build_report(index, arr, storage, overfetch)
+    report.update({"embed_model": current_app.config["EMBED_MODEL"],
+                   "embed_dim_target": target, "dim_method": method,
+                   "ingest_signature": ingest_signature()})
+
+    idx_path, meta_dir = _paths(root)
+    write_metas(meta_dir, metas, texts)  # index より先に（版＝index の更新時刻が変わる時点でメタが揃っているように）
+    # 再ランク用のフル精度ベクトル（検索時は mmap で必要行だけ読む）
+    np.save(_index_file("vectors.npy", root), arr)
+    if pca is not None:
+        faiss.write_VectorTransform(pca, _index_file("pca.bin", root))
+    elif os.path.exists(_index_file("pca.bin", root)):
+        os.remove(_index_file("pca.bin", root))
+    with open(_index_file("index_info.json", root), "w", encoding="utf-8") as f:
+        json.dump({"schema_version": 1, **report}, f, ensure_ascii=False)
+    # mmap で開いているワーカーがいるので上書きせず、別名に書いて差し替える
+    faiss.write_index(index, idx_path + ".tmp")
+    os.replace(idx_path + ".tmp", idx_path)
+    legacy = os.path.join(os.path.dirname(meta_dir), LEGACY_JSONL)
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+    current_app.logger.info("index.build", extra={"trace": {"schema_version": 1, **report}})
+    return report
+
+
+def embed_query(query: str) -> np.ndarray:
+    """クエリの埋め込み（射影・正規化の前。シャードごとに search_vectors が処理する）"""
+    return embed_queries([query])[0]
+
+def embed_queries(queries: List[str]) -> np.ndarray:
+    """複数クエリを1回の埋め込みAPI呼び出しで埋め込む（行ごとに1クエリ）"""
+    qvs = embed_texts(list(queries), model=current_app.config["EMBED_MODEL"], dimensions=embed_request_dim())
+    return np.asarray(qvs, dtype="float32")
+
+# クエリを埋め込み→L2正規化→内積で上位k件を検索し、scoreとメタを返す（圧縮形式ならフル精度で再ランク）
+def faiss_search(query: str, k: int = 5, with_text: bool = False) -> List[Dict]:
+    """クエリを埋め込み→内積で上位k件返却（with_text=True でチャンク本文 "text" も付ける）"""
+    return faiss_search_multi([query], k, with_text)[0]
+
+def faiss_search_multi(queries: List[str], k: int = 5, with_text: bool = False) -> List[List[Dict]]:
     """
-    meta.jsonl を走査して、取り込まれているファイルの一覧を返す。
-    pages は以下の優先順位で決める:
-      1) meta に total_pages があればそれを優先
-      2) page のユニーク数（文字列でも OK）
-      3) それでも不明で .pdf かつ実体ありなら pypdf で直接数える（任意）
+    複数クエリ（言い換えなど）をまとめて検索する。埋め込みは1回の API 呼び出し、
+    検索はインデックス（シャード）ごとに全クエリを行列にした1回の index.search。戻り値はクエリごとの上位k件
     """
-    if not faiss_exists():
-        return []
+    root = active_index_dir()  # 途中で版が切り替わっても同じ版のファイルだけを読む
+    if is_sharded(root) or current_app.config.get("INDEX_REMOTE_SHARDS"):
+        from .shards import scatter_search_multi
+        return scatter_search_multi(root, embed_queries(queries), k, with_text)
+    check_query_dim(load_index_info(root))  # 埋め込みAPIを呼ぶ前に設定の食い違いを弾く
+    return search_vectors_multi(root, embed_queries(queries), k, with_text)
+
+def search_vectors(root: str, qv: np.ndarray, k: int, with_text: bool = False) -> List[Dict]:
+    """
+    1つのインデックス（非シャード版、またはシャード1つ）をクエリベクトルで検索する。
+    qv は embed_query の戻り値（PCA射影・正規化はここで行う）
+    """
+    return search_vectors_multi(root, qv.reshape(1, -1), k, with_text)[0]
+
+def search_vectors_multi(root: str, qvs: np.ndarray, k: int, with_text: bool = False) -> List[List[Dict]]:
+    """search_vectors の複数クエリ版（qvs は embed_queries の戻り値。1回の index.search で全行を検索）"""
+    metas = load_meta(root)
+    index = load_index(root)
+    info = load_index_info(root)
+    check_query_dim(info)
+    full = _load_full_vectors(root) if info.get("storage", "flat") != "flat" else None
 
-    _, meta_path = _paths()
-    files: Dict[str, Dict] = {}
+    qs = np.asarray(qvs, dtype="float32").reshape(len(qvs), -1)
+    if info.get("dim_method") == "pca" and os.path.exists(_index_file("pca.bin", root)):
+        qs = _load_pca(root).apply(qs)
+    if qs.shape[1] != index.d:
+        raise RuntimeError(f"クエリの埋め込み次元({qs.shape[1]})がインデックス({index.d})と一致しません。再インデックスしてください。")
+    qs = np.ascontiguousarray(qs / (np.linalg.norm(qs, axis=1, keepdims=True) + 1e-12), dtype="float32")
+    D, I = _search_reranked(index, full, qs, k,
+                            int(info.get("overfetch") or current_app.config.get("VECTOR_OVERFETCH", 4)))
+    outs = []
+    for row_d, row_i in zip(D, I):
+        out = []
+        for score, idx in zip(row_d, row_i):
+            if idx == -1: continue
+            m = metas.get(int(idx))
+            if with_text:
+                m["text"] = metas.text(int(idx))
+            out.append({"score": float(score), **m})
+        outs.append(out)
+    return outs
 
-    def pick_path(m: Dict) -> str:
-        for key in ("source", "file", "filepath", "path"):
-            v = m.get(key)
-            if v:
-                return v
-        if "doc_id" in m:
-            return str(m["doc_id"])
-        return "__unknown__"
+# ===== ドキュメントカタログ（取り込み時に作る一覧） =====
+_catalog_cache: Dict[str, Tuple[str, Optional[List[Dict]]]] = {}
+_catalog_lock = threading.Lock()
+
+def _catalog_path(root: Optional[str] = None) -> str:
+    return _index_file("catalog.json", root)
+
+def catalog_save(files: List[Dict], root: Optional[str] = None):
+    """取り込み時に1ファイル1行の一覧（chunks/pages/size/sha256/ingested_at）を保存"""
+    path = _catalog_path(root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"schema_version": 1, "files": sorted(files, key=lambda x: x["name"])},
+                  f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+
+def load_catalog(root: Optional[str] = None) -> Optional[List[Dict]]:
+    """
+    カタログを読む（インデックス版ごとにメモリキャッシュ）。無ければ None。
+    キャッシュはインデックス・メタと同じく開いたディレクトリ単位で、捨てるのは同じコレクションの古い版だけ
+    （INDEX_DIR と WEB_INDEX_DIR を交互に引いても互いに追い出さない）
+    """
+    root = root or active_index_dir()
 
-    def coerce_int(x):
-        if isinstance(x, bool):
+    def make():
+        try:
+            with open(_catalog_path(root), "r", encoding="utf-8") as f:
+                return json.load(f).get("files") or []
+        except (OSError, ValueError):
             return None
-        if isinstance(x, (int, np.integer)):
-            return int(x)
-        if isinstance(x, float) and x.is_integer():
-            return int(x)
-        if isinstance(x, str):
-            xs = x.strip()
-            if xs.isdigit():
-                return int(xs)
-            import re
-            m = re.match(r"^(-?\d+)", xs)
-            if m:
-                return int(m.group(1))
-        return None
-
-    with open(meta_path, "r", encoding="utf-8") as f:
-        for line in f:
-            m = json.loads(line)
-            p = pick_path(m)
-            if p not in files:
-                files[p] = {
-                    "path": p,
-                    "name": os.path.basename(p) if p != "__unknown__" else "(unknown)",
-                    "chunks": 0,
-                    "pages_set": set(),
-                    "total_pages": m.get("total_pages") or (m.get("metadata") or {}).get("total_pages"),
-                }
-            files[p]["chunks"] += 1
-
-            # ページ番号（int/str どちらでも拾う）
-            pg = m.get("page")
-            iv = coerce_int(pg)
-            if iv is not None:
-                files[p]["pages_set"].add(iv)
-
-            # total_pages が行によって入っているなら拾っておく（未設定時のみ）
-            tp = m.get("total_pages") or (m.get("metadata") or {}).get("total_pages")
-            if tp is not None and files[p]["total_pages"] is None:
-                files[p]["total_pages"] = coerce_int(tp) or tp  # 数値化できれば数値化
-
-    out = []
-    for v in files.values():
-        pages = v.get("total_pages")
-        if pages in (None, 0):
-            pages = len(v["pages_set"]) if v["pages_set"] else None
+    return _cached(_catalog_cache, _catalog_lock, root, make)
 
+def list_indexed_files() -> List[Dict]:
+    """
+    取り込まれているファイルの一覧を返す（name/path/chunks/pages ほか）。
+    取り込み時に作ったカタログがあればそれを返し、無い（古いインデックス）場合はメタから集計する。
+    """
+    if not faiss_exists(active_index_dir()):
+        return []
+    files = load_catalog()
+    if files is not None:
+        return files
+    return _list_indexed_files_from_meta()
+
+def _list_indexed_files_from_meta() -> List[Dict]:
+    """
+    列指向メタから文書ごとの一覧を作る（カタログが無い古いインデックス向け）。
+    pages は total_pages → page のユニーク数 → （PDF実体があれば）pypdf の順で決める
+    """
+    out = [d for r in index_roots() for d in load_meta(r).doc_summary()]
+    for v in out:
         # 必要なら最終フォールバック（I/Oが重いので任意）
-        if pages in (None, 0) and str(v["path"]).lower().endswith(".pdf") and os.path.exists(v["path"]):
+        if v["pages"] is None and str(v["path"]).lower().endswith(".pdf") and os.path.exists(v["path"]):
             try:
-                pages = page_count_pdf(v["path"])
+                v["pages"] = page_count_pdf(v["path"])
             except Exception:
                 pass
-
-        out.append({
-            "path": v["path"],
-            "name": v["name"],
-            "chunks": v["chunks"],
-            "pages": pages,
-        })
-
     out.sort(key=lambda x: x["name"])
-    return out
\ No newline at end of file
+    return out
@@ -0,0 +1,85 @@
+# app/services/warmup.py
+"""
+起動後の warm-up（重い依存の読み込み・OpenAI クライアント作成・インデックスを開いて1回検索）。
+
+create_app は重い依存を遅延 import（lazy.py）にしているので、何もしなければ最初のリクエストがその分遅くなる。
+WARMUP で前倒しする:
+  none        … しない（最初に使うリクエストで読み込む。/readyz は常に 200）
+  background  … create_app 後に別スレッドで行う。終わるまで /readyz は 503
+  sync        … create_app の中で終わらせる
+gunicorn では gunicorn.conf.py がマスターで依存の読み込み、ワーカー起動時に run() を呼ぶ。
+"""
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from .lazy import load_all
+
+# マスター（fork 前）で読み込んでよいもの。faiss は OpenMP のスレッドを作るのでワーカーで読む
+HEAVY_MODULES = ("numpy", "openai", "requests", "bs4", "pypdf", "serpapi")
+
+_state: Dict[str, Any] = {"mode": "none", "ready": False, "started": None, "result": None, "error": None}
+_lock = threading.Lock()
+
+
+def preload_modules() -> Dict[str, int]:
+    """fork 前に読み込んでよい依存を読み込む（モジュールごとの ms）"""
+    return load_all(HEAVY_MODULES)
+
+
+def run(app) -> Dict[str, Any]:
+    """このプロセスで warm-up を行い、終わったら ready にする（失敗しても ready にする。初回リクエストが遅いだけ）"""
+    from .llm_utils import get_client
+    from .vectorstore import warm_up
+
+    t = time.perf_counter()
+    with _lock:
+        _state["started"] = _state["started"] or time.time()
+    result: Dict[str, Any] = {}
+    try:
+        result["modules_ms"] = load_all(HEAVY_MODULES + ("faiss",))
+        with app.app_context():
+            if app.config.get("OPENAI_API_KEY"):
+                get_client()
+                result["openai_client"] = True
+            result["index"] = warm_up(load=True, probe=True)
+    except Exception as e:
+        app.logger.exception("warmup.error")
+        with _lock:
+            _state["error"] = f"{type(e).__name__}: {e}"
+    result["ms"] = int((time.perf_counter() - t) * 1000)
+    with _lock:
+        _state.update(ready=True, result=result)
+    app.logger.info("warmup.done", extra={"trace": {"schema_version": 1, **result}})
+    return result
+
+
+def start(app, mode: Optional[str] = None):
+    """create_app から呼ぶ。WARMUP の設定に従って warm-up を始める"""
+    mode = (mode or app.config.get("WARMUP") or "none").lower()
+    if mode not in ("none", "background", "sync"):
+        raise ValueError(f"WARMUP は none|background|sync のいずれかです: {mode}")
+    with _lock:
+        _state["mode"] = mode
+        _state["ready"] = mode == "none"
+    if mode == "sync":
+        run(app)
+    elif mode == "background":
+        threading.Thread(target=run, args=(app,), name="warmup", daemon=True).start()
+
+
+def expect(mode: str = "background"):
+    """外（gunicorn のワーカー起動フックなど）で run() を呼ぶ場合に、それまで ready にしない"""
+    with _lock:
+        _state["mode"] = mode
+        _state["ready"] = False
+
+
+def status() -> Dict[str, Any]:
+    with _lock:
+        return dict(_state)
+
+
+def is_ready() -> bool:
+    with _lock:
+        return bool(_state["ready"])
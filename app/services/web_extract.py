@@ -0,0 +1,183 @@
+# app/services/web_extract.py
+"""
+Web検索結果のURLから本文を取り出す。
+
+- ダウンロードは stream で読み、WEB_FETCH_MAX_BYTES（PDFは WEB_PDF_MAX_BYTES）で打ち切る
+- HTML は lxml パーサ（未インストールなら html.parser）で読み、script/nav/footer などの定型部分を捨ててから
+  main/article など本文らしい要素のテキストだけを返す。メニューのリンク文字列だけの行も落とす
+- PDF はローカルPDFと同じ抽出キャッシュ（pdf_cache）を通す（同じ内容なら2回目以降は解析しない）
+- 巡回（crawler.py）向けに、条件付きGET（If-None-Match / If-Modified-Since）とページ内リンクの取り出しもできる
+戻り値の info は trace に載せる（URLごとの取得・抽出時間と文字数）。
+"""
+import io
+import re
+import time
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urldefrag, urljoin
+
+from flask import current_app
+
+from .admission import Overloaded, limit
+from .lazy import lazy_import
+from .pdf_cache import pdf_pages
+
+requests = lazy_import("requests")
+bs4 = lazy_import("bs4")
+_parser = None
+
+_DROP_TAGS = ["script", "style", "noscript", "template", "iframe", "svg", "canvas", "form",
+              "nav", "header", "footer", "aside", "button", "select", "input"]
+_DROP_ROLES = ["navigation", "banner", "contentinfo", "complementary", "search", "menu", "menubar"]
+_BOILER_RE = re.compile(
+    r"(^|[-_\s])(g?nav|navi|menu|footer|header|breadcrumbs?|pankuzu|topicpath|sidebar|side|"
+    r"cookie|banner|share|sns|social|related|recommend|pagetop|skip|ads?|pr)([-_\s]|$)", re.I)
+_KEEP_TAGS = {"html", "body", "main", "article"}
+_BLOCK_TAGS = ["p", "div", "section", "li", "ul", "ol", "dl", "dt", "dd", "tr", "table", "pre", "blockquote",
+               "h1", "h2", "h3", "h4", "h5", "h6"]
+_MAIN_SELECTORS = ["main", "article", "[role=main]", "#main", "#content", "#contents", ".main", ".content"]
+
+
+def _is_boilerplate(tag) -> bool:
+    if tag.name in _KEEP_TAGS or tag.attrs is None:
+        return False
+    cls = tag.get("class") or []
+    ident = " ".join(cls) + " " + (tag.get("id") or "")
+    return bool(_BOILER_RE.search(ident))
+
+
+def extract_html(html, encoding: str = None) -> str:
+    """HTML（bytes / str）から本文らしいテキストを取り出す"""
+    global _parser
+    if _parser is None:
+        from bs4.builder import builder_registry
+        _parser = "lxml" if builder_registry.lookup("lxml") else "html.parser"
+    soup = bs4.BeautifulSoup(html, _parser, from_encoding=encoding if isinstance(html, bytes) else None)
+    for t in soup(_DROP_TAGS):
+        t.decompose()
+    for t in soup.find_all(attrs={"role": _DROP_ROLES}):
+        t.decompose()
+    for t in soup.find_all(_is_boilerplate):
+        t.decompose()
+
+    # 本文候補（main/article 等）のうち一番テキストが多いもの。十分な量が無ければ body 全体
+    root = soup.body or soup
+    best = 0
+    for sel in _MAIN_SELECTORS:
+        for el in soup.select(sel):
+            n = len(el.get_text(strip=True))
+            if n > best:
+                root, best = el, n
+    if best < 200:
+        root = soup.body or soup
+
+    # 改行はブロック要素の境目だけに入れる（文中のリンク等で行が切れないように）
+    for br in root.find_all("br"):
+        br.replace_with("\n")
+    for el in root.find_all(_BLOCK_TAGS):
+        el.insert_after("\n")
+
+    # リンク文字列だけの短い行（残ったメニュー・関連リンク）は捨てる
+    link_texts = {" ".join(a.get_text(" ").split()) for a in root.find_all("a")}
+    lines, prev = [], None
+    for line in root.get_text().splitlines():
+        s = " ".join(line.split())
+        if not s or s == prev:
+            continue
+        if s in link_texts and len(s) < 40:
+            continue
+        lines.append(s)
+        prev = s
+    return "\n".join(lines)
+
+
+def page_links(html, base_url: str, encoding: str = None) -> Tuple[str, List[str]]:
+    """HTML の <title> と、ページ内リンクの絶対URL（#以降を除き、出てきた順・重複なし）"""
+    soup = bs4.BeautifulSoup(html, _parser or "html.parser",
+                             from_encoding=encoding if isinstance(html, bytes) else None)
+    title = " ".join(soup.title.get_text().split()) if soup.title else ""
+    links: List[str] = []
+    seen = set()
+    for a in soup.find_all("a", href=True):
+        url = urldefrag(urljoin(base_url, a["href"].strip()))[0]
+        if url.startswith(("http://", "https://")) and url not in seen:
+            seen.add(url)
+            links.append(url)
+    return title, links
+
+
+def _read_capped(resp: "requests.Response", cap: int, stop_at: float = None) -> Tuple[bytes, bool]:
+    """
+    cap バイトまで読んで (本文, 打ち切ったか) を返す。
+    stop_at（time.monotonic()）を過ぎたら TimeoutError（少しずつ届く遅いサーバでも読み続けない）
+    """
+    buf = bytearray()
+    # urllib3 2.x の read1 は届いた分だけ返すので、ブロックが埋まるのを待たずに締め切りを確かめられる
+    read1 = getattr(resp.raw, "read1", None)
+    if stop_at is not None and read1 is not None:
+        blocks = iter(lambda: read1(64 * 1024, decode_content=True), b"")
+    else:
+        blocks = resp.iter_content(64 * 1024)
+    for block in blocks:
+        buf += block
+        if len(buf) >= cap:
+            return bytes(buf[:cap]), True
+        if stop_at is not None and time.monotonic() > stop_at:
+            raise TimeoutError("fetch deadline")
+    return bytes(buf), False
+
+
+def fetch_text(url: str, timeout: float = None, headers: Optional[Dict[str, str]] = None,
+               links: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """
+    URL を取得して本文テキストを返す。失敗時は空文字。
+    timeout は接続・読み取りごとのタイムアウトで、本文の読み込み全体もこの秒数で打ち切る。
+    headers（If-None-Match など）を付けて 304 が返ったら空文字で info["not_modified"]=True。
+    links=True なら HTML の "title" と "links"（ページ内リンク）も info に入れる。
+    戻り値: (本文, {"url","kind","status","bytes","truncated","fetch_ms","extract_ms","chars",
+                   "etag","last_modified","error"?})
+    """
+    cfg = current_app.config
+    timeout = timeout or float(cfg.get("WEB_FETCH_TIMEOUT", 10))
+    info: Dict[str, Any] = {"url": url, "kind": None, "status": None, "bytes": 0, "truncated": False,
+                            "fetch_ms": 0, "extract_ms": 0, "chars": 0}
+    t = time.perf_counter()
+    stop_at = time.monotonic() + timeout
+    try:
+        with limit("fetch"), requests.get(url, timeout=timeout, stream=True, headers=headers) as r:
+            info.update({"status": r.status_code, "etag": r.headers.get("ETag"),
+                         "last_modified": r.headers.get("Last-Modified")})
+            ctype = (r.headers.get("Content-Type") or "").lower()
+            is_pdf = "application/pdf" in ctype or url.lower().split("?")[0].endswith(".pdf")
+            info["kind"] = "pdf" if is_pdf else "html"
+            if r.status_code == 304:
+                info.update({"not_modified": True, "fetch_ms": int((time.perf_counter() - t) * 1000)})
+                return "", info
+            if r.status_code >= 400:
+                info["error"] = f"http_{r.status_code}"
+                return "", info
+            cap = int(cfg.get("WEB_PDF_MAX_BYTES" if is_pdf else "WEB_FETCH_MAX_BYTES", 1_500_000))
+            body, truncated = _read_capped(r, cap, stop_at)
+            # requests はヘッダに charset が無いと ISO-8859-1 扱いにするので、その場合は bs4 に判定させる
+            encoding = r.encoding if "charset=" in ctype else None
+        info.update({"bytes": len(body), "truncated": truncated, "fetch_ms": int((time.perf_counter() - t) * 1000)})
+
+        t = time.perf_counter()
+        if is_pdf:
+            if truncated:  # 途中までのPDFは読めない
+                info["error"] = "pdf_too_large"
+                return "", info
+            sha = hashlib.sha256(body).hexdigest()
+            text = "\n".join(pdf_pages(io.BytesIO(body), sha))
+        else:
+            text = extract_html(body, encoding)
+            if links:
+                info["title"], info["links"] = page_links(body, url, encoding)
+    except Overloaded:
+        raise
+    except Exception as e:
+        info["error"] = type(e).__name__
+        info["fetch_ms"] = info["fetch_ms"] or int((time.perf_counter() - t) * 1000)
+        return "", info
+    info.update({"extract_ms": int((time.perf_counter() - t) * 1000), "chars": len(text)})
+    return text, info
@@ -1,5 +1,11 @@
 # config.py
 import os
+from dotenv import load_dotenv
+
+load_dotenv()  # Config より先に .env を環境変数へ（以前は serp_utils の import 時に読んでいた）
+
+def _env_bool(name: str, default: str = "0") -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
 
 class Config:
     SECRET_KEY = os.getenv("SECRET_KEY", "dev")
@@ -10,4 +16,154 @@ class Config:
     INDEX_DIR = os.getenv("INDEX_DIR", "data/index")
     CTX_MAX_CHUNKS = 4
     CTX_MAX_CHARS = 1500
-    SYS_PROMPT = os.getenv("SYS_PROMPT", "あなたは日本語で正確に答えるアシスタントです。根拠に基づき簡潔に回答し、不明な点は正直に『不明』と述べてください。")
\ No newline at end of file
+    SYS_PROMPT = os.getenv("SYS_PROMPT", "あなたは日本語で正確に答えるアシスタントです。根拠に基づき簡潔に回答し、不明な点は正直に『不明』と述べてください。")
+
+    # LLMクライアント（接続プール・タイムアウト・リトライ・ヘッジ）
+    LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "3"))
+    LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))
+    LLM_POOL_MAXSIZE = int(os.getenv("LLM_POOL_MAXSIZE", "20"))
+    LLM_POOL_KEEPALIVE = int(os.getenv("LLM_POOL_KEEPALIVE", "10"))
+    LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "0.5"))
+    LLM_RETRY_MAX = float(os.getenv("LLM_RETRY_MAX", "8"))
+    LLM_HEDGE = _env_bool("LLM_HEDGE")
+    LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+    LLM_HEDGE_MIN_MS = int(os.getenv("LLM_HEDGE_MIN_MS", "300"))
+    LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+    # temperature 0 のチャット（スコープ判定・LLM検証・言い換え）の応答キャッシュ（SQLite。全ワーカーで共有。既定は無効）
+    LLM_CACHE_ENABLED = _env_bool("LLM_CACHE_ENABLED")
+    LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/cache/llm_cache.sqlite3")
+    LLM_CACHE_TTL_SEC = float(os.getenv("LLM_CACHE_TTL_SEC", str(7 * 86400)))
+    LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+
+    # 外部依存ごとの同時実行数（プロセス単位、0=無制限）と待ち行列。満杯・待ち時間切れは 503
+    LIMIT_CHAT = int(os.getenv("LIMIT_CHAT", "8"))
+    LIMIT_EMBED = int(os.getenv("LIMIT_EMBED", "8"))
+    LIMIT_SEARCH = int(os.getenv("LIMIT_SEARCH", "4"))
+    LIMIT_FETCH = int(os.getenv("LIMIT_FETCH", "8"))
+    LIMIT_QUEUE_MAX = int(os.getenv("LIMIT_QUEUE_MAX", "32"))
+    LIMIT_QUEUE_TIMEOUT_SEC = float(os.getenv("LIMIT_QUEUE_TIMEOUT_SEC", "5"))
+    LIMIT_RETRY_AFTER_SEC = int(os.getenv("LIMIT_RETRY_AFTER_SEC", "2"))
+
+    # 構造化ログ（LOG_ASYNC=1 ならキュー経由で別スレッドが出力。満杯時は捨てて件数を log.dropped で出す）
+    LOG_ASYNC = _env_bool("LOG_ASYNC", "1")
+    LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+    LOG_DECISION_SAMPLE = float(os.getenv("LOG_DECISION_SAMPLE", "1.0"))       # rag.decision 途中段階を残す割合
+    LOG_TRACE_DETAIL_SAMPLE = float(os.getenv("LOG_TRACE_DETAIL_SAMPLE", "1.0"))  # rag.trace の hits 等を丸ごと残す割合
+    LOG_MAX_STR = int(os.getenv("LOG_MAX_STR", "1000"))
+    LOG_MAX_LIST = int(os.getenv("LOG_MAX_LIST", "10"))
+
+    # 起動後の warm-up（none: 最初のリクエストで読み込む / background: 別スレッドで前倒し / sync: create_app 内で完了）
+    # 重い依存は遅延 import。gunicorn では gunicorn.conf.py が設定に関係なくワーカー起動時に行う
+    WARMUP = os.getenv("WARMUP", "none")
+
+    # リクエストの締め切り。既定は 0（無制限）。有効にするには REQUEST_DEADLINE_MS=30000 などを設定するか、
+    # /api/ask に deadline_ms を渡す（こちらが優先。MAX は指定できる上限）
+    # 残りが各 DEADLINE_*_MS 未満なら任意の段（LLM検証・hybrid の再要約・残りのWebページ取得・LLMの言い換え）を飛ばす
+    REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "0"))
+    REQUEST_DEADLINE_MAX_MS = int(os.getenv("REQUEST_DEADLINE_MAX_MS", "110000"))
+    DEADLINE_VALIDATOR_MS = int(os.getenv("DEADLINE_VALIDATOR_MS", "3000"))
+    DEADLINE_RESUMMARIZE_MS = int(os.getenv("DEADLINE_RESUMMARIZE_MS", "6000"))
+    DEADLINE_FETCH_MIN_MS = int(os.getenv("DEADLINE_FETCH_MIN_MS", "1500"))
+    DEADLINE_ANSWER_RESERVE_MS = int(os.getenv("DEADLINE_ANSWER_RESERVE_MS", "6000"))
+    DEADLINE_EXPAND_MS = int(os.getenv("DEADLINE_EXPAND_MS", "8000"))
+
+    # 同一質問の同時実行の集約（COALESCE_DIR はワーカー間で共有するロック置き場。空ならプロセス内のみ）
+    COALESCE_ENABLED = _env_bool("COALESCE_ENABLED", "1")
+    COALESCE_DIR = os.getenv("COALESCE_DIR", "data/run/coalesce")
+    COALESCE_WAIT_SEC = float(os.getenv("COALESCE_WAIT_SEC", "60"))
+
+    # 会話状態（続きの質問は前回の検索候補を使い回す。履歴は CONV_HISTORY_TOKENS の近似トークン数まで LLM へ）
+    CONV_ENABLED = _env_bool("CONV_ENABLED", "1")
+    CONV_DIR = os.getenv("CONV_DIR", "data/conversations")
+    CONV_TTL_SEC = float(os.getenv("CONV_TTL_SEC", "1800"))
+    CONV_MAX = int(os.getenv("CONV_MAX", "2000"))
+    CONV_MAX_TURNS = int(os.getenv("CONV_MAX_TURNS", "8"))
+    CONV_ANSWER_CHARS = int(os.getenv("CONV_ANSWER_CHARS", "400"))
+    CONV_CANDIDATE_CHARS = int(os.getenv("CONV_CANDIDATE_CHARS", "1500"))
+    CONV_HISTORY_TOKENS = int(os.getenv("CONV_HISTORY_TOKENS", "600"))
+    CONV_FOLLOWUP_MAX_CHARS = int(os.getenv("CONV_FOLLOWUP_MAX_CHARS", "40"))
+    CONV_MAX_FOLLOWUPS = int(os.getenv("CONV_MAX_FOLLOWUPS", "3"))
+    CONV_REUSE_MIN_OVERLAP = float(os.getenv("CONV_REUSE_MIN_OVERLAP", "0.2"))
+
+    # ベクトル保存形式: flat(float32) / fp16 / int8（圧縮時は VECTOR_OVERFETCH 倍拾ってフル精度で再ランク）
+    VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "flat")
+    VECTOR_OVERFETCH = int(os.getenv("VECTOR_OVERFETCH", "4"))
+    VECTOR_RECALL_K = int(os.getenv("VECTOR_RECALL_K", "10"))
+    VECTOR_RECALL_SAMPLE = int(os.getenv("VECTOR_RECALL_SAMPLE", "200"))
+
+    # 埋め込み次元（0=モデルのフル次元）。api: text-embedding-3 は dimensions 指定・他モデルは先頭を切り詰め / pca: 取り込み時にPCA射影
+    EMBED_DIM = int(os.getenv("EMBED_DIM", "0"))
+    EMBED_DIM_METHOD = os.getenv("EMBED_DIM_METHOD", "api")
+
+    # 検索時に faiss.index を mmap で開く（gunicorn の全ワーカーでページキャッシュを共有）
+    INDEX_MMAP = _env_bool("INDEX_MMAP", "1")
+
+    # 取り込み（埋め込みのバッチ件数・残しておく旧インデックス版の数）
+    EMBED_BATCH = int(os.getenv("EMBED_BATCH", "256"))
+    INDEX_KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "2"))
+
+    # シャード分割（INDEX_SHARDS > 1 で文書を sha256 でシャードに振り分け、検索は全シャードを並列に引いてマージ）
+    # EMBED_DIM_METHOD=pca とは併用できない（シャードごとの射影ではスコアを比べられない）
+    INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+    INDEX_SEARCH_THREADS = int(os.getenv("INDEX_SEARCH_THREADS", "8"))
+    INDEX_REMOTE_SHARDS = os.getenv("INDEX_REMOTE_SHARDS", "")  # scripts/shard_server.py のURL（カンマ区切り）
+    INDEX_REMOTE_TIMEOUT = float(os.getenv("INDEX_REMOTE_TIMEOUT", "2"))
+
+    # PDFのページ抽出テキストを INDEX_DIR/pdf_text/<sha256>.ptc にキャッシュ（取り込み・プレビュー・ページ数で共有）
+    PDF_TEXT_CACHE = _env_bool("PDF_TEXT_CACHE", "1")
+
+    # Web本文の取得（HTMLは WEB_FETCH_MAX_BYTES、PDFは WEB_PDF_MAX_BYTES で打ち切り）
+    WEB_FETCH_TIMEOUT = float(os.getenv("WEB_FETCH_TIMEOUT", "10"))
+    WEB_FETCH_MAX_BYTES = int(os.getenv("WEB_FETCH_MAX_BYTES", str(1_500_000)))
+    WEB_PDF_MAX_BYTES = int(os.getenv("WEB_PDF_MAX_BYTES", str(20 * 1024 * 1024)))
+
+    # 信頼できるサイトの巡回（CRAWL_SITES はURLの前方一致をカンマ区切り。scripts/crawl.py で定期実行）
+    # 例: https://www.mhlw.go.jp/stf/seisakunitsuite/bunya/koyou_roudou/koyou/kyufukin/,https://it-shien.smrj.go.jp/
+    # Webモードは WEB_INDEX_DIR の巡回済みページを先に引き、最上位のスコアが WEB_LOCAL_MIN_SCORE 未満ならライブ検索する
+    WEB_INDEX_DIR = os.getenv("WEB_INDEX_DIR", "data/web_index")
+    WEB_LOCAL_ENABLED = _env_bool("WEB_LOCAL_ENABLED", "1")
+    WEB_LOCAL_MIN_SCORE = float(os.getenv("WEB_LOCAL_MIN_SCORE", "0.45"))
+    CRAWL_SITES = os.getenv("CRAWL_SITES", "")
+    CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", "300"))
+    CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", "2"))
+    CRAWL_DELAY_SEC = float(os.getenv("CRAWL_DELAY_SEC", "1.0"))
+    CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", "15"))
+    CRAWL_USER_AGENT = os.getenv("CRAWL_USER_AGENT", "subsidy-rag-crawler/1.0")
+    CRAWL_ROBOTS = _env_bool("CRAWL_ROBOTS", "1")
+    CRAWL_INTERVAL_SEC = float(os.getenv("CRAWL_INTERVAL_SEC", str(24 * 3600)))
+
+    # チャンク分割: fixed（従来の800文字固定長。既定）/ sentence（文・段落・見出し単位、CHUNK_TOKENS は近似トークン数）
+    # 切り替えると取り込み設定が変わるので、次の取り込みで全文書を埋め込み直す
+    CHUNKER = os.getenv("CHUNKER", "fixed")
+    CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "500"))
+    CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "60"))
+
+    # 近似重複チャンクの除去（既定は無効。文書内で MinHash の推定 Jaccard が DEDUP_THRESHOLD 以上なら1ベクトルにまとめる）
+    # 切り替えると取り込み設定が変わるので、次の取り込みで全文書を埋め込み直す
+    DEDUP_ENABLED = _env_bool("DEDUP_ENABLED")
+    DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+    DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "64"))
+
+    # アップロード（1ファイルの上限・同一内容の扱い reject|alias・保存後に取り込みを依頼するか）
+    UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+    MAX_CONTENT_LENGTH = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(200 * 1024 * 1024)))
+    UPLOAD_DUPLICATE = os.getenv("UPLOAD_DUPLICATE", "reject")
+    UPLOAD_AUTO_INDEX = _env_bool("UPLOAD_AUTO_INDEX")
+
+    # 検索語の言い換え off|rules|llm（既定は off。同義語の置き換え／＋LLMの言い換え1回）。QUERY_EXPAND_MAX 本（元の質問を含む）を
+    # 埋め込み1回・検索1回でまとめて引き、RRF（1/(QUERY_EXPAND_RRF_K + 順位) の和）で統合する
+    QUERY_EXPAND = os.getenv("QUERY_EXPAND", "off")
+    QUERY_EXPAND_MAX = int(os.getenv("QUERY_EXPAND_MAX", "4"))
+    QUERY_EXPAND_RRF_K = int(os.getenv("QUERY_EXPAND_RRF_K", "60"))
+
+    # クロスエンコーダ再ランク（CPU。既定は無効）。RERANK_CANDIDATES 件を拾い、予算内で採点して RERANK_TOP_N 件をLLMへ
+    RERANK_ENABLED = _env_bool("RERANK_ENABLED")
+    RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+    RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+    RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "3"))
+    RERANK_BATCH = int(os.getenv("RERANK_BATCH", "8"))
+    RERANK_BUDGET_MS = int(os.getenv("RERANK_BUDGET_MS", "300"))
+    RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "512"))
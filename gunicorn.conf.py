@@ -0,0 +1,39 @@
+# gunicorn.conf.py
+"""
+本番起動用の gunicorn 設定。
+
+  gunicorn -c gunicorn.conf.py
+
+- preload_app: マスターで一度だけアプリを読み込んでから fork（コード・設定のメモリをワーカー間で共有）
+- インデックスはワーカーごとに mmap で開く（INDEX_MMAP=1）。実体はページキャッシュ1つを全ワーカーで共有
+- マスター起動時にインデックスのファイルを読み流してページキャッシュへ載せ、各ワーカーは起動時に開いておく
+  （FAISS の OpenMP スレッドを fork 前に作らないよう、マスターでは FAISS を触らない）
+- アプリの重い依存は遅延 import。FAISS 以外はマスターで読み込んで fork で共有し、
+  ワーカーは起動時に warm-up（OpenAI クライアント・インデックスを開いて1回検索）を済ませてから /readyz を 200 にする
+ワーカーごとのメモリは scripts/worker_memory.py で確認できる。
+"""
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+wsgi_app = "wsgi:app"
+preload_app = True
+
+# warm-up はワーカー起動時に post_worker_init で行う（マスターで create_app から始めると fork 前に FAISS を読んでしまう）
+os.environ["WARMUP"] = "none"
+
+
+def when_ready(server):
+    from app.services import warmup
+    from app.services.vectorstore import warm_up
+    server.log.info("module preload: %s", warmup.preload_modules())
+    with server.app.wsgi().app_context():
+        server.log.info("index warm-up (page cache): %s", warm_up(load=False))
+    warmup.expect()
+
+
+def post_worker_init(worker):
+    from app.services import warmup
+    worker.log.info("warm-up (worker %s): %s", worker.pid, warmup.run(worker.wsgi))
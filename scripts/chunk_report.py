@@ -0,0 +1,61 @@
+# scripts/chunk_report.py
+"""
+チャンク分割の比較レポート（従来の固定長 vs 文・段落単位）。
+
+  python scripts/chunk_report.py
+  python scripts/chunk_report.py --tokens 300 500 800 --overlap 60
+
+PDF_DIR の全ファイルを分割し、チャンク数・近似トークン数の分布・文の途中で終わるチャンクの割合・分割時間を出す。
+埋め込みAPIは呼ばない。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import create_app  # noqa: E402
+from app.services.chunker import chunk_stats, split_text, CHUNKER_VERSION  # noqa: E402
+from app.services.doc_utils import cached_sha256, is_allowed_ext, read_preview  # noqa: E402
+from app.services.pdf_cache import pdf_pages  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tokens", type=int, nargs="+", default=[500], help="sentence 分割の目安トークン数（複数可）")
+    ap.add_argument("--overlap", type=int, default=60)
+    args = ap.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        pdf_dir = app.config["PDF_DIR"]
+        configs = [{"name": "fixed", "size": 800, "overlap": 120}]
+        configs += [{"name": "sentence", "version": CHUNKER_VERSION, "tokens": t, "overlap": args.overlap}
+                    for t in args.tokens]
+
+        # PDFは抽出キャッシュから読む。取り込みと同じくページ単位で分割する
+        raw_pages = []
+        for name in sorted(os.listdir(pdf_dir)):
+            path = os.path.join(pdf_dir, name)
+            if not (os.path.isfile(path) and is_allowed_ext(name)):
+                continue
+            if name.lower().endswith(".pdf"):
+                raw_pages += [(p, False) for p in pdf_pages(path, cached_sha256(path))]
+            else:
+                raw_pages.append((read_preview(path, limit=10 ** 12), name.lower().endswith((".md", ".markdown"))))
+
+        rows = []
+        for cfg in configs:
+            t = time.perf_counter()
+            chunks = [c for text, md in raw_pages for c in split_text(text, markdown=md, cfg=cfg)]
+            ms = int((time.perf_counter() - t) * 1000)
+            rows.append({"chunker": cfg, "split_ms": ms, **chunk_stats(chunks)})
+
+    print(json.dumps({"pdf_dir": pdf_dir, "pages_or_files": len(raw_pages), "rows": rows},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# scripts/crawl.py
+"""
+信頼できるサイト（CRAWL_SITES）を巡回して、Webモード用のコレクション（WEB_INDEX_DIR）を更新する。
+
+  python scripts/crawl.py                                  # 1回だけ（cron 向け）
+  python scripts/crawl.py --interval 86400                 # 常駐して定期的に巡回
+  python scripts/crawl.py --sites http://127.0.0.1:8000/ --delay 0   # ローカルの静的サーバで試す
+
+ETag / Last-Modified で条件付きGETするので、変わっていないページは取り直さず、何も変わらなければ再インデックスもしない。
+結果は1回ごとに1行のJSONで出す。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import create_app  # noqa: E402
+from app.services.crawler import CrawlConflict, crawl  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser(description="信頼できるサイトの巡回")
+    ap.add_argument("--sites", help="CRAWL_SITES を上書き（URLの前方一致をカンマ区切り）")
+    ap.add_argument("--interval", type=float, default=None,
+                    help="常駐して N 秒ごとに巡回（省略時は1回だけ。0 なら CRAWL_INTERVAL_SEC）")
+    ap.add_argument("--max-pages", type=int, help="CRAWL_MAX_PAGES を上書き")
+    ap.add_argument("--delay", type=float, help="CRAWL_DELAY_SEC を上書き")
+    args = ap.parse_args()
+
+    app = create_app()
+    if args.sites is not None:
+        app.config["CRAWL_SITES"] = args.sites
+    if args.max_pages is not None:
+        app.config["CRAWL_MAX_PAGES"] = args.max_pages
+    if args.delay is not None:
+        app.config["CRAWL_DELAY_SEC"] = args.delay
+    interval = args.interval
+    if interval == 0:
+        interval = float(app.config.get("CRAWL_INTERVAL_SEC", 86400))
+
+    status = 0
+    while True:
+        with app.app_context():
+            try:
+                report = crawl()
+                status = 0
+            except (CrawlConflict, RuntimeError) as e:
+                report = {"error": str(e)}
+                status = 1
+        print(json.dumps(report, ensure_ascii=False), flush=True)
+        if interval is None:
+            return status
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+# scripts/embed_dim_report.py
+"""
+埋め込み次元ごとの インデックスサイズ / 検索レイテンシ / recall@k をフル次元と比較するレポート。
+
+  python scripts/embed_dim_report.py --dims 256 512 1024 --sample 1000 --k 10
+  python scripts/embed_dim_report.py --dims 256 --queries queries.txt   # 1行1クエリ
+
+PDF_DIR のチャンクから --sample 件を埋め込み、フル次元の IndexFlatIP の上位k件を正解として比較する。
+--queries を省略した場合はサンプルチャンクの先頭文を疑似クエリに使う。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import faiss
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import create_app  # noqa: E402
+from app.services.doc_utils import collect_chunks  # noqa: E402
+from app.services.llm_utils import embed_texts, supports_dimensions  # noqa: E402
+
+
+def _embed(texts, model, dim=None, batch=256) -> np.ndarray:
+    out = []
+    for i in range(0, len(texts), batch):
+        out.extend(embed_texts(texts[i:i + batch], model=model, dimensions=dim))
+    arr = np.asarray(out, dtype="float32")
+    return arr / (np.linalg.norm(arr, axis=1, keepdims=True) + 1e-12)
+
+
+def _measure(docs: np.ndarray, qs: np.ndarray, k: int):
+    index = faiss.IndexFlatIP(docs.shape[1])
+    index.add(docs)
+    t = time.perf_counter()
+    _, found = index.search(qs, k)
+    ms = (time.perf_counter() - t) * 1000 / max(1, len(qs))
+    return found, ms, int(faiss.serialize_index(index).size)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dims", type=int, nargs="+", required=True, help="比較する次元（複数可）")
+    ap.add_argument("--sample", type=int, default=1000, help="コーパスから使うチャンク数")
+    ap.add_argument("--queries", help="クエリファイル（1行1クエリ）")
+    ap.add_argument("--n-queries", type=int, default=100)
+    ap.add_argument("--k", type=int, default=10)
+    args = ap.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        model = app.config["EMBED_MODEL"]
+        texts, _, _ = collect_chunks(app.config["PDF_DIR"])
+        rng = np.random.default_rng(0)
+        if len(texts) > args.sample:
+            texts = [texts[i] for i in sorted(rng.choice(len(texts), args.sample, replace=False))]
+        if args.queries:
+            with open(args.queries, "r", encoding="utf-8") as f:
+                queries = [l.strip() for l in f if l.strip()]
+        else:
+            picks = rng.choice(len(texts), min(args.n_queries, len(texts)), replace=False)
+            queries = [texts[i].split("。")[0][:120] for i in picks]
+        k = min(args.k, len(texts))
+
+        full_docs = _embed(texts, model)
+        full_qs = _embed(queries, model)
+        truth, full_ms, full_bytes = _measure(full_docs, full_qs, k)
+        rows = [{"dim": int(full_docs.shape[1]), "method": "full", "index_bytes": full_bytes,
+                 "search_ms_per_query": round(full_ms, 3), "recall_at_k": 1.0}]
+
+        for dim in args.dims:
+            if supports_dimensions(model):
+                # API側の短縮（実運用の EMBED_DIM_METHOD=api と同じ経路）
+                docs, qs, method = _embed(texts, model, dim), _embed(queries, model, dim), "api"
+            else:
+                docs, qs, method = full_docs[:, :dim], full_qs[:, :dim], "truncate"
+                docs = docs / (np.linalg.norm(docs, axis=1, keepdims=True) + 1e-12)
+                qs = qs / (np.linalg.norm(qs, axis=1, keepdims=True) + 1e-12)
+            found, ms, nbytes = _measure(docs, qs, k)
+            rows.append(_row(dim, method, nbytes, ms, truth, found, k))
+
+            # PCA（コーパスで学習した射影）も併記
+            pca = faiss.PCAMatrix(full_docs.shape[1], dim)
+            pca.train(full_docs)
+            pdocs, pqs = pca.apply(full_docs), pca.apply(full_qs)
+            pdocs = pdocs / (np.linalg.norm(pdocs, axis=1, keepdims=True) + 1e-12)
+            pqs = pqs / (np.linalg.norm(pqs, axis=1, keepdims=True) + 1e-12)
+            found, ms, nbytes = _measure(pdocs, pqs, k)
+            rows.append(_row(dim, "pca", nbytes, ms, truth, found, k))
+
+    print(json.dumps({"model": model, "chunks": len(texts), "queries": len(queries), "k": k, "rows": rows},
+                     ensure_ascii=False, indent=2))
+
+
+def _row(dim, method, nbytes, ms, truth, found, k):
+    hit = sum(len(set(t) & set(f)) for t, f in zip(truth.tolist(), found.tolist()))
+    return {"dim": dim, "method": method, "index_bytes": nbytes,
+            "search_ms_per_query": round(ms, 3), "recall_at_k": round(hit / float(len(truth) * k), 4)}
+
+
+if __name__ == "__main__":
+    main()
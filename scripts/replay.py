@@ -0,0 +1,227 @@
+# scripts/replay.py
+"""
+rag.trace ログから質問を取り出し、稼働中のインスタンスへ再生する負荷試験ツール。
+
+  python scripts/replay.py app.log --url http://localhost:5000 --rate 2 --concurrency 16
+  python scripts/replay.py app.log --arrival closed --concurrency 8       # 応答を待って次を投げる
+  python scripts/replay.py app.log --arrival poisson --qps 5 --limit 200   # 元の時刻を使わずポアソン到着
+  cat app.log | python scripts/replay.py - --debug                         # 段階別 timing も比較
+
+到着モデル:
+- open（既定）: ログの到着時刻（ts − total_ms）の間隔を --rate 倍速で再現。応答を待たずに投げる（開ループ）
+- poisson: 平均 --qps のポアソン到着（開ループ）
+- closed: --concurrency 本のクライアントが応答を待ってから次を投げる（閉ループ）
+開ループで同時実行が --concurrency を超えると送信が遅れるので、その遅れ（lag_ms）も出す。
+
+--debug を付けると debug=true で投げ、サーバが DEBUG_RAG=True なら trace.timing を受け取り、
+ログの timing と段階ごとに比較する（無ければ total_ms と X-RTT-Ms の比較のみ）。
+ログ以外に {"query": ..., "mode": ...} の1行1JSON（リクエストログ形式）もそのまま読める。
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+
+# ===== ログ読み込み =====
+def _parse_line(line: str) -> Optional[Dict[str, Any]]:
+    i = line.find("{")
+    if i < 0:
+        return None
+    try:
+        rec = json.loads(line[i:])
+    except ValueError:
+        return None
+    if rec.get("msg") == "rag.trace":
+        timing = rec.get("timing") or {}
+        query = (rec.get("steps") or {}).get("query")
+        mode = (rec.get("params") or {}).get("mode", "doc")
+        ts = rec.get("ts")
+        # ログは応答時に出るので、到着時刻は ts − total_ms
+        arrival = ts - timing.get("total_ms", 0) / 1000.0 if ts is not None else None
+        return {"query": query, "mode": mode, "arrival": arrival, "timing": timing} if query else None
+    if rec.get("query") and "msg" not in rec:
+        return {"query": rec["query"], "mode": rec.get("mode", "doc"), "arrival": rec.get("ts"), "timing": {}}
+    return None
+
+
+def load_requests(paths: List[str]) -> List[Dict[str, Any]]:
+    out = []
+    for path in paths:
+        f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8", errors="ignore")
+        try:
+            for line in f:
+                rec = _parse_line(line)
+                if rec:
+                    out.append(rec)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    if out and all(r["arrival"] is not None for r in out):
+        out.sort(key=lambda r: r["arrival"])
+    return out
+
+
+# ===== 送信 =====
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = _local.session = requests.Session()
+    return s
+
+
+def _send(base: str, req: Dict[str, Any], debug: bool, timeout: float) -> Dict[str, Any]:
+    t = time.perf_counter()
+    out: Dict[str, Any] = {"status": None, "error": None, "timing": {}, "coalesced": False}
+    try:
+        r = _session().post(f"{base}/api/ask", timeout=timeout,
+                            json={"query": req["query"], "mode": req["mode"], "debug": debug})
+        out["status"] = r.status_code
+        try:
+            body = r.json()
+        except ValueError:
+            body = {}
+        if r.status_code != 200 or not body.get("ok", False):
+            out["error"] = body.get("reason") or body.get("error") or f"http_{r.status_code}"
+        out["timing"] = dict((body.get("trace") or {}).get("timing") or {})
+        if "total_ms" not in out["timing"] and r.headers.get("X-RTT-Ms"):
+            out["timing"]["total_ms"] = int(r.headers["X-RTT-Ms"])
+        out["coalesced"] = bool((body.get("meta") or {}).get("coalesced"))
+    except requests.RequestException as e:
+        out["error"] = type(e).__name__
+    out["latency_ms"] = int((time.perf_counter() - t) * 1000)
+    return out
+
+
+def _schedule(reqs: List[Dict[str, Any]], arrival: str, rate: float, qps: float) -> List[float]:
+    """各リクエストの送信予定（開始からの秒）"""
+    if arrival == "poisson" or (arrival == "open" and any(r["arrival"] is None for r in reqs)):
+        rng = random.Random(0)
+        at, out = 0.0, []
+        for _ in reqs:
+            out.append(at)
+            at += rng.expovariate(qps)
+        return out
+    t0 = reqs[0]["arrival"]
+    return [(r["arrival"] - t0) / rate for r in reqs]
+
+
+def replay(reqs: List[Dict[str, Any]], base: str, arrival: str, rate: float, qps: float,
+           concurrency: int, debug: bool, timeout: float) -> Tuple[List[Dict[str, Any]], float]:
+    """戻り値: (リクエストごとの結果, 経過秒)"""
+    results: List[Optional[Dict[str, Any]]] = [None] * len(reqs)
+    start = time.perf_counter()
+
+    def run(i: int, due: Optional[float]):
+        lag = int(max(0.0, time.perf_counter() - start - due) * 1000) if due is not None else 0
+        res = _send(base, reqs[i], debug, timeout)
+        res["lag_ms"] = lag
+        results[i] = res
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if arrival == "closed":
+            for i in range(len(reqs)):
+                pool.submit(run, i, None)
+        else:
+            for i, due in enumerate(_schedule(reqs, arrival, rate, qps)):
+                wait = due - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+                pool.submit(run, i, due)
+    return results, time.perf_counter() - start
+
+
+# ===== 集計 =====
+def _pcts(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+    pick = lambda p: v[min(len(v) - 1, int(p * len(v) / 100))]  # noqa: E731
+    return {"n": len(v), "p50": pick(50), "p90": pick(90), "p95": pick(95), "p99": pick(99),
+            "max": v[-1], "mean": round(sum(v) / len(v), 1)}
+
+
+def report(reqs: List[Dict[str, Any]], results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    n = len(results)
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r["error"]:
+            errors[str(r["error"])] = errors.get(str(r["error"]), 0) + 1
+    ok = [r for r in results if not r["error"]]
+
+    # 段階別 timing: ログ（元） vs 再生
+    keys = sorted({k for q in reqs for k in q["timing"]} | {k for r in ok for k in r["timing"]})
+    stages = {}
+    for k in keys:
+        orig = [q["timing"][k] for q in reqs if k in q["timing"]]
+        new = [r["timing"][k] for r in ok if k in r["timing"]]
+        if not orig and not new:
+            continue
+        o, w = _pcts(orig), _pcts(new)
+        row = {"orig": o, "replay": w}
+        if o.get("n") and w.get("n"):
+            row["delta_p50"] = w["p50"] - o["p50"]
+            row["delta_p95"] = w["p95"] - o["p95"]
+        stages[k] = row
+
+    return {
+        "requests": n,
+        "elapsed_sec": round(elapsed, 2),
+        "throughput_rps": round(n / elapsed, 2) if elapsed else None,
+        "error_rate": round((n - len(ok)) / n, 4) if n else 0.0,
+        "errors": errors,
+        "status": {str(s): sum(1 for r in results if r["status"] == s) for s in {r["status"] for r in results}},
+        "coalesced": sum(1 for r in ok if r["coalesced"]),
+        "latency_ms": _pcts([r["latency_ms"] for r in ok]),
+        "latency_ms_all": _pcts([r["latency_ms"] for r in results]),
+        "send_lag_ms": _pcts([r["lag_ms"] for r in results]),
+        "stages": stages,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="rag.trace ログの再生・負荷試験")
+    ap.add_argument("logs", nargs="+", help="ログファイル（- で標準入力）")
+    ap.add_argument("--url", default="http://localhost:5000")
+    ap.add_argument("--arrival", choices=("open", "poisson", "closed"), default="open")
+    ap.add_argument("--rate", type=float, default=1.0, help="open: 元の到着間隔の何倍速で流すか")
+    ap.add_argument("--qps", type=float, default=2.0, help="poisson（またはログに時刻が無い open）の平均到着率")
+    ap.add_argument("--concurrency", type=int, default=16, help="同時に投げる上限（closed ではクライアント数）")
+    ap.add_argument("--limit", type=int, default=0, help="先頭から何件流すか（0=全部）")
+    ap.add_argument("--repeat", type=int, default=1, help="ログを何周流すか")
+    ap.add_argument("--mode", choices=("doc", "web", "hybrid"), help="ログのモードを上書き")
+    ap.add_argument("--debug", action="store_true", help="debug=true で投げて段階別 timing を受け取る")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    args = ap.parse_args()
+
+    reqs = load_requests(args.logs)
+    if not reqs:
+        sys.exit("再生できる rag.trace が見つかりません")
+    if args.repeat > 1 and reqs[0]["arrival"] is not None:
+        span = reqs[-1]["arrival"] - reqs[0]["arrival"] + 1.0
+        reqs = [dict(r, arrival=r["arrival"] + span * k) for k in range(args.repeat) for r in reqs]
+    else:
+        reqs = reqs * args.repeat
+    if args.limit:
+        reqs = reqs[:args.limit]
+    if args.mode:
+        reqs = [dict(r, mode=args.mode) for r in reqs]
+
+    results, elapsed = replay(reqs, args.url.rstrip("/"), args.arrival, max(args.rate, 1e-6), max(args.qps, 1e-6),
+                     max(1, args.concurrency), args.debug, args.timeout)
+    out = {"url": args.url, "arrival": args.arrival, "rate": args.rate, "concurrency": args.concurrency,
+           **report(reqs, results, elapsed)}
+    print(json.dumps(out, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# scripts/shard_server.py
+"""
+シャード1つを HTTP で検索させるシャードサーバ（INDEX_REMOTE_SHARDS の接続先）。
+
+  python scripts/shard_server.py --shard 0 --port 7001          # INDEX_DIR の稼働版の shards/0 を配信
+  python scripts/shard_server.py --root /srv/index --port 7002  # 任意のインデックス（非シャード版でも可）
+  INDEX_REMOTE_SHARDS=http://127.0.0.1:7001,http://127.0.0.1:7002 gunicorn -c gunicorn.conf.py
+
+--shard の場合はリクエストごとに CURRENT を見るので、取り込みで版が切り替わればそのまま新しい版を返す。
+POST /search {"vector": [...], "k": 5, "with_text": false, "embed_model": "..."} → {"hits": [...], "version": "..."}
+vector は埋め込みAPIの生ベクトル（PCA射影・正規化はサーバ側で行う）。
+複数クエリは {"vectors": [[...], ...], ...} で送ると1回の検索で返す → {"hits": [[クエリ1の上位k件], ...], ...}
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+from flask import Flask, jsonify, request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from config import Config  # noqa: E402
+from app.services.shards import load_manifest  # noqa: E402
+from app.services.vectorstore import (active_index_dir, index_version, is_sharded, search_vectors,  # noqa: E402
+                                      search_vectors_multi)
+
+
+def create_shard_app(shard: int = None, root: str = None) -> Flask:
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config["INDEX_REMOTE_SHARDS"] = ""  # サーバ自身はリモートを辿らない
+
+    def resolve() -> str:
+        if root:
+            return root
+        base = active_index_dir()
+        if not is_sharded(base):
+            return base
+        for e in load_manifest(base).get("entries", []):
+            if e["id"] == shard and e.get("dir"):
+                return os.path.join(base, e["dir"])
+        raise FileNotFoundError(f"稼働版にシャード {shard} がありません")
+
+    @app.post("/search")
+    def search():
+        data = request.get_json(silent=True) or {}
+        model = data.get("embed_model")
+        if model and model != app.config["EMBED_MODEL"]:
+            return jsonify({"error": f"埋め込みモデルが違います: {model} != {app.config['EMBED_MODEL']}"}), 409
+        try:
+            r = resolve()
+            k, with_text = int(data.get("k", 5)), bool(data.get("with_text"))
+            if "vectors" in data:
+                hits = search_vectors_multi(r, np.asarray(data["vectors"], dtype="float32"), k, with_text)
+            else:
+                hits = search_vectors(r, np.asarray(data["vector"], dtype="float32"), k, with_text)
+        except (KeyError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        except (FileNotFoundError, RuntimeError) as e:
+            return jsonify({"error": str(e)}), 503
+        return jsonify({"hits": hits, "version": index_version(r)})
+
+    @app.get("/healthz")
+    def healthz():
+        try:
+            r = resolve()
+        except FileNotFoundError as e:
+            return jsonify({"ok": False, "error": str(e)}), 503
+        return jsonify({"ok": True, "root": r, "version": index_version(r)})
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description="シャードサーバ")
+    g = ap.add_mutually_exclusive_group(required=True)
+    g.add_argument("--shard", type=int, help="稼働版のシャード番号")
+    g.add_argument("--root", help="インデックスのディレクトリ（faiss.index と meta/ がある所）")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=7001)
+    args = ap.parse_args()
+    create_shard_app(args.shard, args.root).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
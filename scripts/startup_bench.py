@@ -0,0 +1,96 @@
+# scripts/startup_bench.py
+"""
+コールドスタートの計測（毎回新しい Python プロセスで測る）。
+
+  python scripts/startup_bench.py                          # import+create_app と初回リクエストを5回ずつ測って中央値
+  python scripts/startup_bench.py --repeat 10 --ask "申請期限は？"   # 初回の /api/ask も測る（API を呼ぶ）
+  python scripts/startup_bench.py --save base.json         # 結果を保存
+  python scripts/startup_bench.py --baseline base.json     # 保存した結果より --tolerance 以上遅ければ終了コード1
+
+測る項目（ms）:
+  import_ms        … import app + create_app()（WARMUP の設定どおり。sync なら warm-up を含む）
+  first_<path>_ms  … そのプロセスで最初のリクエスト（Flask のテストクライアント経由）
+各回で実際に読み込まれていた重い依存（lazy.py の遅延 import が効いているか）も表示する。
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行する計測。結果は最終行の JSON
+_CHILD = r"""
+import json, sys, time
+t = time.perf_counter()
+from app import create_app
+app = create_app()
+out = {"import_ms": (time.perf_counter() - t) * 1000}
+from app.services.lazy import is_loaded
+heavy = ("numpy", "faiss", "openai", "requests", "bs4", "pypdf", "serpapi")
+out["loaded_at_start"] = [m for m in heavy if is_loaded(m)]
+client = app.test_client()
+for path, body in json.loads(sys.argv[1]):
+    t = time.perf_counter()
+    r = client.post(path, json=body) if body is not None else client.get(path)
+    out[f"first_{path.strip('/').replace('/', '_') or 'root'}_ms"] = (time.perf_counter() - t) * 1000
+    out[f"status_{path.strip('/').replace('/', '_') or 'root'}"] = r.status_code
+out["loaded_at_end"] = [m for m in heavy if is_loaded(m)]
+print(json.dumps(out))
+"""
+
+
+def _run_once(requests_: list, env: dict) -> dict:
+    p = subprocess.run([sys.executable, "-c", _CHILD, json.dumps(requests_)], cwd=ROOT, env=env,
+                       capture_output=True, text=True, timeout=600)
+    if p.returncode != 0:
+        sys.exit(f"計測プロセスが失敗しました:\n{p.stderr[-2000:]}")
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser(description="import / create_app / 初回リクエストの所要時間")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--warmup", choices=["none", "background", "sync"], help="WARMUP を上書き")
+    ap.add_argument("--ask", help="初回の /api/ask も測る（この質問で。OpenAI API を呼ぶ）")
+    ap.add_argument("--mode", default="doc", help="--ask のモード")
+    ap.add_argument("--save", help="中央値を JSON で保存")
+    ap.add_argument("--baseline", help="比較する --save の JSON")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="baseline からの許容悪化率（0.2=20%%）")
+    args = ap.parse_args()
+
+    reqs = [["/healthz", None], ["/api/files", None]]
+    if args.ask:
+        reqs.append(["/api/ask", {"query": args.ask, "mode": args.mode}])
+    env = dict(os.environ)
+    if args.warmup:
+        env["WARMUP"] = args.warmup
+
+    runs = [_run_once(reqs, env) for _ in range(max(1, args.repeat))]
+    keys = [k for k in runs[0] if k.endswith("_ms")]
+    med = {k: round(statistics.median(r[k] for r in runs), 1) for k in keys}
+    for k in keys:
+        vals = sorted(r[k] for r in runs)
+        print(f"{k:28s} median={med[k]:8.1f}  min={vals[0]:8.1f}  max={vals[-1]:8.1f}")
+    for k in (k for k in runs[0] if k.startswith("status_")):
+        print(f"{k:28s} {sorted({r[k] for r in runs})}")
+    print(f"{'loaded_at_start':28s} {runs[-1]['loaded_at_start']}")
+    print(f"{'loaded_at_end':28s} {runs[-1]['loaded_at_end']}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"repeat": len(runs), "median": med}, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            base = json.load(f)["median"]
+        worse = {k: (base[k], med[k]) for k in med if k in base and med[k] > base[k] * (1 + args.tolerance)}
+        for k, (b, m) in worse.items():
+            print(f"REGRESSION {k}: {b} -> {m} ms")
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
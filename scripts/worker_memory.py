@@ -0,0 +1,103 @@
+# scripts/worker_memory.py
+"""
+gunicorn のマスター・ワーカーごとのメモリ使用量（Linux の /proc を読む）。
+
+  python scripts/worker_memory.py              # gunicorn マスターを自動検出
+  python scripts/worker_memory.py --pid 12345  # マスターの PID を指定
+
+RSS は共有ページも各プロセスに数えるので、ワーカー数倍に見える。実際の負担は
+PSS（共有ページをプロセス数で割った値）と USS（そのプロセス専有分）で見る。
+index_* は INDEX_DIR 配下のファイル（faiss.index / vectors.npy / meta）を mmap している分。
+"""
+import os
+import sys
+import json
+import argparse
+
+
+def _find_master() -> int:
+    """コマンドラインに gunicorn を含み、親が gunicorn でないプロセス"""
+    cands = {}
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmd = f.read().replace(b"\0", b" ").decode(errors="ignore")
+            with open(f"/proc/{pid}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except OSError:
+            continue
+        if "gunicorn" in cmd:
+            cands[int(pid)] = ppid
+    masters = [p for p, pp in cands.items() if pp not in cands]
+    if not masters:
+        sys.exit("gunicorn のプロセスが見つかりません（--pid で指定してください）")
+    return min(masters)
+
+
+def _children(pid: int) -> list:
+    out = []
+    for p in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    out.append(int(p))
+        except OSError:
+            continue
+    return sorted(out)
+
+
+def _usage(pid: int, index_dir: str) -> dict:
+    """smaps を集計（kB → MiB）。INDEX_DIR 配下のマッピングは別に集計"""
+    tot = {"rss": 0, "pss": 0, "uss": 0, "shared": 0}
+    idx = {"index_rss": 0, "index_pss": 0}
+    in_index = False
+    with open(f"/proc/{pid}/smaps") as f:
+        for line in f:
+            head = line.split()
+            if not head:
+                continue
+            if not head[0].endswith(":"):
+                # マッピングの見出し行: アドレス 権限 offset dev inode [パス]
+                parts = line.split(None, 5)
+                path = parts[5].strip() if len(parts) == 6 else ""
+                in_index = bool(index_dir) and path.startswith(index_dir)
+                continue
+            key, val = head[0][:-1], int(head[1]) if len(head) > 1 and head[1].isdigit() else 0
+            if key == "Rss":
+                tot["rss"] += val
+                if in_index:
+                    idx["index_rss"] += val
+            elif key == "Pss":
+                tot["pss"] += val
+                if in_index:
+                    idx["index_pss"] += val
+            elif key in ("Private_Clean", "Private_Dirty"):
+                tot["uss"] += val
+            elif key in ("Shared_Clean", "Shared_Dirty"):
+                tot["shared"] += val
+    return {k: round(v / 1024, 1) for k, v in {**tot, **idx}.items()}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pid", type=int, help="gunicorn マスターの PID")
+    ap.add_argument("--index-dir", default=os.getenv("INDEX_DIR", "data/index"))
+    args = ap.parse_args()
+
+    index_dir = os.path.realpath(args.index_dir)
+    master = args.pid or _find_master()
+    rows = [{"role": "master", "pid": master, **_usage(master, index_dir)}]
+    rows += [{"role": "worker", "pid": p, **_usage(p, index_dir)} for p in _children(master)]
+    workers = [r for r in rows if r["role"] == "worker"]
+    summary = {
+        "workers": len(workers),
+        "sum_rss_mib": round(sum(r["rss"] for r in rows), 1),
+        "sum_pss_mib": round(sum(r["pss"] for r in rows), 1),  # 実際に消費している量に近い
+        "index_rss_per_worker_mib": max((r["index_rss"] for r in workers), default=0),
+        "index_pss_total_mib": round(sum(r["index_pss"] for r in rows), 1),
+    }
+    print(json.dumps({"processes": rows, "summary": summary}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
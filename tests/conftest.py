@@ -0,0 +1,58 @@
+# tests/conftest.py
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import create_app  # noqa: E402
+from app.services import crawler, doc_utils, vectorstore  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """データ置き場をすべて tmp_path に向けたアプリ（外部API・重い依存は各テストで差し替える）"""
+    app = create_app()
+    app.config.update(
+        TESTING=True,
+        INDEX_DIR=str(tmp_path / "index"),
+        WEB_INDEX_DIR=str(tmp_path / "web_index"),
+        CONV_DIR=str(tmp_path / "conversations"),
+        COALESCE_DIR=str(tmp_path / "coalesce"),
+        LLM_CACHE_ENABLED=False,
+        DEBUG_RAG=False,
+    )
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def bigram_embed(texts, model=None, dimensions=None):
+    """文字bigramを64次元にハッシュした決定的な埋め込み（APIを呼ばない）"""
+    out = []
+    for t in texts:
+        v = np.zeros(64, dtype="float32")
+        for i in range(len(t) - 1):
+            v[int(hashlib.md5(t[i:i + 2].encode()).hexdigest()[:8], 16) % 64] += 1.0
+        out.append(v.tolist())
+    return out
+
+
+@pytest.fixture
+def fake_embed(monkeypatch):
+    """取り込み・巡回・検索の埋め込みを bigram_embed に差し替える。埋め込んだテキストの一覧を返す"""
+    embedded = []
+
+    def embed(texts, model, dimensions=None):
+        embedded.extend(texts)
+        return bigram_embed(texts)
+
+    for mod in (doc_utils, vectorstore, crawler):
+        monkeypatch.setattr(mod, "embed_texts", embed)
+    return embedded
@@ -0,0 +1,126 @@
+# tests/test_admission.py
+"""外部依存の同時実行枠と待ち行列（スレッドで枠を埋めて確かめる）"""
+import logging
+import threading
+import time
+
+import pytest
+
+from app import api
+from app.services import admission
+from app.services.admission import Limiter, Overloaded
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    monkeypatch.setattr(admission, "_limiters", {})
+
+
+def _wait(cond, timeout=5.0):
+    until = time.time() + timeout
+    while time.time() < until:
+        if cond():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def _waiter(lim, out):
+    """枠を待つスレッド（取れたら out に待った ms、取れなければ例外を入れる）"""
+    def run():
+        try:
+            out.append(lim.acquire())
+        except Overloaded as e:
+            out.append(e)
+    t = threading.Thread(target=run)
+    t.start()
+    assert _wait(lambda: lim.waiting == 1)
+    return t
+
+
+def test_queue_full_is_rejected_immediately():
+    lim = Limiter("chat", limit=1, queue_max=1, timeout=5.0)
+    lim.acquire()
+    out = []
+    t = _waiter(lim, out)
+
+    t0 = time.perf_counter()
+    with pytest.raises(Overloaded) as e:
+        lim.acquire()
+    assert e.value.reason == "queue_full" and e.value.dependency == "chat"
+    assert time.perf_counter() - t0 < 0.5
+    assert lim.stats()["rejected"] == 1
+
+    lim.release()
+    t.join()
+    assert isinstance(out[0], int)  # 待っていた方は枠を取れる
+    assert lim.stats()["active"] == 1 and lim.stats()["waiting"] == 0
+
+
+def test_wait_timeout_is_rejected():
+    lim = Limiter("serp", limit=1, queue_max=4, timeout=0.2)
+    lim.acquire()
+    t0 = time.perf_counter()
+    with pytest.raises(Overloaded) as e:
+        lim.acquire()
+    assert e.value.reason == "timeout"
+    assert 150 <= e.value.waited_ms < 1000
+    assert time.perf_counter() - t0 >= 0.2
+    assert lim.stats() == {"limit": 1, "active": 1, "waiting": 0, "rejected": 1, "extra": 0, "extra_denied": 0}
+
+
+def test_try_acquire_never_overtakes_waiters():
+    lim = Limiter("chat", limit=2, queue_max=4, timeout=5.0)
+    assert lim.try_acquire()
+    lim.acquire()
+    out = []
+    t = _waiter(lim, out)
+    assert not lim.try_acquire()  # 空きが無い
+
+    lim.release()
+    assert not lim.try_acquire()  # 空いた枠は待っている人のもの
+    t.join()
+    assert isinstance(out[0], int)
+
+    lim.release()
+    lim.release()
+    assert lim.try_acquire()  # 誰も待っていなければ取れる
+    st = lim.stats()
+    assert st["extra"] == 2 and st["extra_denied"] == 2 and st["active"] == 1
+
+
+def test_limit_context_uses_config(app):
+    app.config.update(LIMIT_FETCH=1, LIMIT_QUEUE_MAX=0)
+    with app.app_context():
+        with admission.limit("fetch"):
+            assert admission.limiter_stats()["fetch"]["active"] == 1
+            with pytest.raises(Overloaded) as e:
+                with admission.limit("fetch"):
+                    pass
+            assert e.value.reason == "queue_full"
+        assert admission.limiter_stats()["fetch"]["active"] == 0
+
+
+def test_overloaded_maps_to_503_with_trace_id(app, client, monkeypatch, caplog):
+    app.config.update(LIMIT_CHAT=1, LIMIT_QUEUE_MAX=0, LIMIT_RETRY_AFTER_SEC=7)
+
+    def busy_answer(query, mode="doc", debug=False, conversation_id=None, deadline_ms=None,
+                    new_conversation=False):
+        with admission.limit("chat"):
+            raise AssertionError("枠は埋まっているはず")
+
+    monkeypatch.setattr(api, "answer", busy_answer)
+    with app.app_context():
+        admission.get_limiter("chat").acquire()
+
+    with caplog.at_level(logging.WARNING):
+        resp = client.post("/api/ask", json={"query": "IT導入補助金の上限額は？"})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "7"
+    body = resp.get_json()
+    assert body["ok"] is False
+    assert body["dependency"] == "chat" and body["reason"] == "queue_full"
+    assert body["trace_id"] and body["trace_id"] == resp.headers["X-Trace-Id"]
+    rec = [r for r in caplog.records if r.getMessage() == "overloaded"]
+    assert rec and rec[0].trace["trace_id"] == body["trace_id"]
+    assert rec[0].trace["dependency"] == "chat"
@@ -0,0 +1,66 @@
+# tests/test_chunker.py
+"""文・段落単位のチャンク分割（見出し・表・箇条書き・重ね・長い塊の切断）"""
+from app.services.chunker import estimate_tokens, split_fixed, split_sentences
+
+
+def test_sentences_are_packed_up_to_target_with_overlap():
+    text = "".join(f"これは{i:02d}番目の文です。" for i in range(30))
+    chunks = split_sentences(text, tokens=40, overlap=12)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(c) <= 40 for c in chunks)
+    assert all(c.endswith("。") for c in chunks)
+    for prev, nxt in zip(chunks, chunks[1:]):
+        last = prev.split("。")[-2] + "。"
+        assert nxt.startswith(last)  # 前のチャンク末尾の文が重なる
+        assert not prev.startswith(nxt) and prev not in nxt
+
+
+def test_no_overlap():
+    text = "".join(f"これは{i:02d}番目の文です。" for i in range(30))
+    chunks = split_sentences(text, tokens=40, overlap=0)
+    assert "".join(chunks) == text
+
+
+def test_markdown_headings_split_and_prefix():
+    text = "# 補助金\n概要の文。\n## 対象\n中小企業が対象です。\n## 上限\n上限は450万円です。\n"
+    chunks = split_sentences(text, tokens=100, overlap=20, markdown=True)
+    assert chunks == ["補助金\n概要の文。", "補助金 > 対象\n中小企業が対象です。", "補助金 > 上限\n上限は450万円です。"]
+    # Markdown でなければ見出しは普通の行
+    assert len(split_sentences(text, tokens=100, overlap=20)) == 1
+
+
+def test_table_rows_are_not_split_into_sentences():
+    text = "| 枠 | 上限。備考 |\n| 通常枠 | 150万円。 |\n名前\t金額\t備考\n"
+    chunks = split_sentences(text, tokens=100, overlap=0)
+    assert chunks == ["| 枠 | 上限。備考 |\n| 通常枠 | 150万円。 |\n名前\t金額\t備考"]
+
+
+def test_bullets_are_one_unit_per_line():
+    text = "・箇条書き\nあいう。\n●二つ目\n- 三つ目\n-四つ目ではない\n1. 番号\n①丸数字"
+    chunks = split_sentences(text, tokens=100, overlap=0)
+    lines = chunks[0].split("\n")
+    assert lines[:4] == ["・箇条書き", "あいう。", "●二つ目", "- 三つ目"]
+    assert lines[4] == "-四つ目ではない"
+    assert lines[5:] == ["1. 番号", "①丸数字"]
+
+
+def test_long_run_is_hard_split():
+    chunks = split_sentences("あ" * 250, tokens=100, overlap=20)
+    assert [estimate_tokens(c) for c in chunks] == [100, 100, 50]
+    words = " ".join(["word"] * 200)
+    parts = split_sentences(words, tokens=20, overlap=0)
+    assert all(p.split(" ") == ["word"] * len(p.split(" ")) for p in parts)  # 空白で切る
+    assert all(estimate_tokens(p) <= 20 for p in parts)
+
+
+def test_carry_never_repeats_whole_chunk_or_overflows():
+    text = "これは文です。次の文！\n\n| a | b |\n| c | d |\n・箇条書き\n" + "あ" * 1200 + "。"
+    chunks = split_sentences(text, 100, 20)
+    assert chunks[0] == "これは文です。次の文！\n| a | b |\n| c | d |\n・箇条書き"
+    assert all(estimate_tokens(c) <= 100 for c in chunks)
+    assert chunks[1] == "あ" * 100  # 前のチャンクを持ち越さない
+    assert "".join(chunks[1:]) == "あ" * 1200 + "。"
+
+
+def test_fixed():
+    assert split_fixed("a" * 2000, 800, 120) == ["a" * 800, "a" * 800, "a" * 640]
@@ -0,0 +1,157 @@
+# tests/test_coalesce.py
+"""/api/ask の同時実行の集約（最初の質問は会話 id に関係なくまとめ、続きは会話ごとに分ける）"""
+import threading
+import time
+
+import pytest
+
+from app import api
+from app.services import coalesce, conversation
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def fake_answer(query, mode="doc", debug=False, conversation_id=None, deadline_ms=None,
+                    new_conversation=False):
+        with lock:
+            calls.append({"conversation_id": conversation_id, "new_conversation": new_conversation})
+        time.sleep(0.3)  # 後続が相乗りできるように
+        res = {"answer": f"答え: {query}", "sources": [], "meta": {}}
+        if new_conversation:
+            res["_conversation_state"] = {"turns": [{"q": query, "a": res["answer"], "mode": mode}]}
+        return res
+
+    monkeypatch.setattr(api, "answer", fake_answer)
+    monkeypatch.setattr(api, "index_version", lambda: "v1")
+    return calls
+
+
+def _ask_concurrently(app, bodies):
+    out = [None] * len(bodies)
+
+    def run(i, body):
+        out[i] = app.test_client().post("/api/ask", json=body).get_json()
+
+    threads = [threading.Thread(target=run, args=(i, b)) for i, b in enumerate(bodies)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return out
+
+
+def test_first_questions_coalesce_and_get_own_conversation(app, calls):
+    res = _ask_concurrently(app, [{"query": "IT導入補助金の上限額は？"}] * 5)
+    assert len(calls) == 1
+    assert calls[0] == {"conversation_id": None, "new_conversation": True}
+    assert all(r["ok"] and r["answer"] == "答え: IT導入補助金の上限額は？" for r in res)
+    assert sum(bool(r["meta"].get("coalesced")) for r in res) == 4
+    ids = {r["conversation_id"] for r in res}
+    assert len(ids) == 5
+    with app.app_context():
+        for conv_id in ids:
+            assert conversation.load(conv_id)["turns"][0]["q"] == "IT導入補助金の上限額は？"
+    assert all("_conversation_state" not in r for r in res)
+
+
+def test_existing_conversations_do_not_coalesce(app, calls):
+    with app.app_context():
+        ids = [conversation.new_id() for _ in range(2)]
+        for conv_id in ids:
+            conversation.save(conv_id, {"turns": [{"q": "前の質問", "a": "...", "mode": "doc"}]})
+    bodies = [{"query": "その上限額は？", "conversation_id": i} for i in ids]
+    res = _ask_concurrently(app, bodies)
+    assert len(calls) == 2
+    assert sorted(c["conversation_id"] for c in calls) == sorted(ids)
+    assert not any(c["new_conversation"] for c in calls)
+    assert [r["conversation_id"] for r in res] == ids
+    assert not any(r["meta"].get("coalesced") for r in res)
+
+
+def test_same_conversation_resend_coalesces(app, calls):
+    with app.app_context():
+        conv_id = conversation.new_id()
+        conversation.save(conv_id, {"turns": [{"q": "前の質問", "a": "...", "mode": "doc"}]})
+    res = _ask_concurrently(app, [{"query": "その上限額は？", "conversation_id": conv_id}] * 3)
+    assert len(calls) == 1
+    assert {r["conversation_id"] for r in res} == {conv_id}
+
+
+def test_unknown_conversation_id_is_kept(app, calls):
+    res = app.test_client().post("/api/ask", json={"query": "締切は？", "conversation_id": "abcdef0123456789"})
+    body = res.get_json()
+    assert body["conversation_id"] == "abcdef0123456789"
+    assert calls == [{"conversation_id": None, "new_conversation": True}]
+    with app.app_context():
+        assert conversation.load("abcdef0123456789") is not None
+
+
+# ===== run_coalesced（先着の失敗・待ちきれない場合） =====
+def _run_all(n, target):
+    out = [None] * n
+
+    def run(i):
+        try:
+            out[i] = target()
+        except Exception as e:  # noqa: BLE001
+            out[i] = e
+
+    threads = []
+    for i in range(n):
+        threads.append(threading.Thread(target=run, args=(i,)))
+        threads[-1].start()
+        time.sleep(0.02)  # 最初のスレッドが先着になるように
+    for t in threads:
+        t.join()
+    return out
+
+
+def test_leader_error_is_shared_not_retried():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.2)
+        raise RuntimeError("混雑")
+
+    out = _run_all(4, lambda: coalesce.run_coalesced("k-error", fn))
+    assert len(calls) == 1
+    assert all(isinstance(r, RuntimeError) for r in out)
+    assert "k-error" not in coalesce._inflight
+
+
+def test_follower_timeout_elects_one_new_leader():
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            calls.append(1)
+            first = len(calls) == 1
+        time.sleep(1.0 if first else 0.1)
+        return "slow" if first else "fast"
+
+    out = _run_all(5, lambda: coalesce.run_coalesced("k-slow", fn, wait_timeout=0.3))
+    assert len(calls) == 2  # 後続4つが一斉に fn() を呼ばない
+    assert out[0] == ("slow", False)
+    assert sorted(out[1:]) == [("fast", False), ("fast", True), ("fast", True), ("fast", True)]
+    assert "k-slow" not in coalesce._inflight
+
+
+@pytest.mark.parametrize("body", [
+    {"query": "  "},
+    {"query": "締切は？", "mode": "image"},
+    {"query": "締切は？", "deadline_ms": "soon"},
+])
+def test_invalid_request_does_not_read_conversation(app, calls, monkeypatch, body):
+    def no_load(conv_id):
+        raise AssertionError("検査前に会話状態を読まない")
+
+    monkeypatch.setattr(conversation, "load", no_load)
+    res = app.test_client().post("/api/ask", json={**body, "conversation_id": "abcdef0123456789"})
+    assert res.status_code == 400
+    assert res.get_json()["trace_id"]
+    assert calls == []
@@ -0,0 +1,83 @@
+# tests/test_conversation.py
+"""続きの質問の判定（is_follow_up）とスコープ判定が毎回行われること"""
+import pytest
+
+from app.services import conversation, rag
+
+
+def _state(**retrieval):
+    doc = [{"path": "a.pdf", "chunk_id": 0, "text": "補助金の上限額は100万円。対象者は中小企業。"}]
+    return {"turns": [{"q": "ものづくり補助金とは", "a": "...", "mode": "doc"}],
+            "retrieval": {"mode": "doc", "doc": doc, "web": [], **retrieval}}
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("その上限額は？", True),       # 指示語つき・候補と重なる
+    ("それは？", True),             # 指示語だけ
+    ("上限額は？", False),          # 短いだけでは続きとみなさない
+    ("秋葉原のラーメン", False),    # 指示語なし
+    ("そのラーメン屋の場所は？", False),  # 指示語はあるが候補と重ならない
+])
+def test_is_follow_up(app, query, expected):
+    with app.app_context():
+        assert conversation.is_follow_up(query, _state(), "doc") is expected
+
+
+def test_is_follow_up_requires_same_mode_and_state(app):
+    with app.app_context():
+        assert not conversation.is_follow_up("その上限額は？", _state(), "web")
+        assert not conversation.is_follow_up("その上限額は？", None, "doc")
+
+
+def test_follow_ups_are_limited(app):
+    app.config["CONV_MAX_FOLLOWUPS"] = 2
+    with app.app_context():
+        state = _state()
+        for _ in range(2):
+            assert conversation.is_follow_up("その上限額は？", state, "doc")
+            state = conversation.record_turn(state, "その上限額は？", "100万円", "doc", None, None)
+        assert state["retrieval"]["follow_ups"] == 2
+        assert not conversation.is_follow_up("その上限額は？", state, "doc")
+        # 検索し直すと数え直し
+        state = conversation.record_turn(state, "その対象者は？", "...", "doc", _state()["retrieval"], None)
+        assert conversation.is_follow_up("その上限額は？", state, "doc")
+
+
+@pytest.fixture
+def scope_calls(monkeypatch):
+    calls = []
+
+    def fake_scope(query, previous=None):
+        calls.append((query, previous))
+        if "ラーメン" in query:
+            return "OUT", 0.95, "補助金と無関係"
+        return "IN", 0.9, "補助金の質問"
+
+    def fake_generate(query, mode, params, timing, steps, reuse=None, history=""):
+        raise AssertionError("スコープ外の質問で生成まで進んだ")
+
+    monkeypatch.setattr(rag, "in_scope_llm", fake_scope)
+    monkeypatch.setattr(rag, "generate_answer", fake_generate)
+    return calls
+
+
+@pytest.mark.parametrize("query", ["秋葉原のラーメン", "それで、そのラーメンは？"])
+def test_scope_is_checked_within_conversation(app, scope_calls, query):
+    with app.test_request_context("/api/ask"):
+        conv_id = conversation.new_id()
+        conversation.save(conv_id, _state())
+        res = rag.answer(query, mode="doc", conversation_id=conv_id)
+    assert res["answer"] == rag.FIXED_MSG
+    assert res["meta"]["hide_reason"] == "out_of_scope"
+    assert [q for q, _ in scope_calls] == [query]
+
+
+def test_scope_gets_previous_question_for_follow_up(app, scope_calls, monkeypatch):
+    monkeypatch.setattr(rag, "generate_answer",
+                        lambda *a, **kw: (_ for _ in ()).throw(RuntimeError("stop")))
+    with app.test_request_context("/api/ask"):
+        conv_id = conversation.new_id()
+        conversation.save(conv_id, _state())
+        with pytest.raises(RuntimeError):
+            rag.answer("その上限額は？", mode="doc", conversation_id=conv_id)
+    assert scope_calls == [("その上限額は？", "ものづくり補助金とは")]
@@ -0,0 +1,151 @@
+# tests/test_crawler.py
+"""ローカルの静的HTTPサーバ（ETag / Last-Modified 付き）に対する巡回と、Webモードでの巡回済みページの利用"""
+import hashlib
+import http.server
+import os
+import threading
+from functools import partial
+
+import pytest
+
+from app.services import crawler, rag
+
+PAGES = {
+    "index.html": '<html><head><title>トップ</title></head><body><main>補助金の案内です。'
+                  '<a href="a.html">A</a> <a href="b.html">B</a> <a href="private/c.html">C</a></main></body></html>',
+    "a.html": "<html><head><title>IT導入補助金</title></head><body><main>IT導入補助金の上限額は450万円です。"
+              "申請はオンラインで行います。</main></body></html>",
+    "b.html": "<html><head><title>雇用調整助成金</title></head><body><main>雇用調整助成金は休業手当の一部を"
+              "助成します。</main></body></html>",
+    "private/c.html": "<html><head><title>非公開</title></head><body><main>巡回してはいけないページ。</main></body></html>",
+    # * と別のエージェントを並べたグループ（* の規則も自分に当てはまる）
+    "robots.txt": "User-agent: *\nUser-agent: other-bot\nDisallow: /private/\n\nUser-agent: bad-bot\nDisallow: /\n",
+}
+
+
+class _Handler(http.server.SimpleHTTPRequestHandler):
+    """内容の md5 を ETag にし、If-None-Match が一致すれば 304（Last-Modified / If-Modified-Since は標準のまま）"""
+    requests_seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        _Handler.requests_seen.append((self.path, self.headers.get("User-Agent")))
+        path = self.translate_path(self.path)
+        self._etag = None
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                tag = '"%s"' % hashlib.md5(f.read()).hexdigest()
+            if self.headers.get("If-None-Match") == tag:
+                self.send_response(304)
+                self.send_header("ETag", tag)
+                self.end_headers()
+                return None
+            self._etag = tag
+        return super().send_head()
+
+    def end_headers(self):
+        if getattr(self, "_etag", None):
+            self.send_header("ETag", self._etag)
+            self._etag = None
+        super().end_headers()
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    root = tmp_path / "site"
+    for name, body in PAGES.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(body, encoding="utf-8")
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1,localhost")
+    _Handler.requests_seen = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), partial(_Handler, directory=str(root)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield root, f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def crawl_app(app, site, fake_embed):
+    app.config.update(CRAWL_SITES=site[1], CRAWL_DELAY_SEC=0, CRAWL_MAX_DEPTH=2,
+                      CRAWL_USER_AGENT="test-crawler/1.0", WEB_LOCAL_ENABLED=True)
+    return app
+
+
+def test_crawl_incremental(crawl_app, site, fake_embed):
+    root, base = site
+    with crawl_app.app_context():
+        first = crawler.crawl()
+        assert first["pages"] == 3 and first["new"] == 3 and first["rebuilt"]
+        assert first["robots_skipped"] == 1
+        assert first["embedded_chunks"] == first["chunks"] > 0
+        assert set(crawler.load_state()) == {base, base + "a.html", base + "b.html"}
+        assert all(agent == "test-crawler/1.0" for _, agent in _Handler.requests_seen)
+        assert ("/robots.txt", "test-crawler/1.0") in _Handler.requests_seen
+
+        # 変わっていなければ 304 だけで、埋め込みも再インデックスもしない
+        embedded = len(fake_embed)
+        second = crawler.crawl()
+        assert second["not_modified"] == 3 and second["fetched"] == 0
+        assert not second["rebuilt"]
+        assert len(fake_embed) == embedded
+
+        # 1ページだけ変えると、そのページだけ埋め込み直す
+        (root / "a.html").write_text(PAGES["a.html"].replace("450万円", "350万円"), encoding="utf-8")
+        third = crawler.crawl()
+        assert third["changed"] == 1 and third["not_modified"] == 2 and third["rebuilt"]
+        assert third["embedded_chunks"] == 1
+        assert third["reused_chunks"] == third["chunks"] - 1
+        assert any("350万円" in t for t in fake_embed[embedded:])
+
+
+def test_robots_groups():
+    robots = crawler._Robots("subsidy-rag-crawler/1.0", 1.0, 0.0, {})
+    assert robots.parse(PAGES["robots.txt"]) == ["/private/"]
+    assert robots.parse("User-agent: other\nUser-agent: *\nDisallow: /a\nUser-agent: other\nDisallow: /b\n") == ["/a"]
+    assert robots.parse("User-agent: subsidy-rag-crawler\nDisallow: /x\n") == ["/x"]
+    assert robots.parse("User-agent: other\nDisallow: /x\n") == []
+
+
+@pytest.fixture
+def web_answer(crawl_app, monkeypatch):
+    """rag._web を、ライブ検索・ページ取得・要約を差し替えて呼ぶ"""
+    live = []
+
+    def fake_search(query, pages=1, budget=None):
+        live.append(query)
+        return [{"title": "live", "url": "https://example.go.jp/live", "snippet": "ライブ検索の結果"}]
+
+    monkeypatch.setattr(rag, "google_search", fake_search)
+    monkeypatch.setattr(rag, "_fetch_text", lambda url, steps=None: "ライブで取得した本文")
+    monkeypatch.setattr(rag, "_summarize", lambda contexts, query, **kw: "要約")
+    with crawl_app.app_context():
+        crawler.crawl()
+
+    def run(query):
+        steps, timing = {}, {}
+        with crawl_app.test_request_context("/api/ask"):
+            res = rag._web(query, {"top_k": 3}, timing, steps)
+        return res, steps
+    return run, live
+
+
+def test_lookup_local_hit(crawl_app, web_answer):
+    run, live = web_answer
+    crawl_app.config["WEB_LOCAL_MIN_SCORE"] = 0.3
+    res, steps = run("IT導入補助金の上限額は")
+    assert steps["web_local"]["hit"]
+    assert live == []
+    assert res["web_hits"][0]["url"].endswith("a.html")
+
+
+def test_lookup_falls_back_to_live_search(crawl_app, web_answer):
+    run, live = web_answer
+    crawl_app.config["WEB_LOCAL_MIN_SCORE"] = 0.99
+    res, steps = run("IT導入補助金の上限額は")
+    assert steps["web_local"]["hit"] is False
+    assert steps["web_local"]["top_score"] < 0.99
+    assert live == ["IT導入補助金の上限額は"]
+    assert [h["url"] for h in res["web_hits"]] == ["https://example.go.jp/live"]
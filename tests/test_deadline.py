@@ -0,0 +1,148 @@
+# tests/test_deadline.py
+"""リクエストの締め切り（既定は無制限。短い deadline_ms と、sleep する LLM / SerpAPI の差し替えで確かめる）"""
+import threading
+import time
+
+import pytest
+
+from app.services import admission, deadline, rag
+from app.services.admission import Overloaded
+from app.services.deadline import DeadlineExceeded
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    monkeypatch.setattr(admission, "_limiters", {})
+
+
+def test_default_is_unlimited(app):
+    assert app.config["REQUEST_DEADLINE_MS"] == 0
+    with app.test_request_context("/api/ask"):
+        assert deadline.start() is None
+        assert deadline.remaining() is None
+        assert deadline.timeout("llm", 30.0) == 30.0
+        assert deadline.allow("llm_validator", 10 ** 9)
+        assert deadline.skipped() == []
+
+
+def test_start_caps_and_keeps_configured_deadline(app):
+    app.config.update(REQUEST_DEADLINE_MS=500, REQUEST_DEADLINE_MAX_MS=2000)
+    with app.test_request_context("/api/ask"):
+        assert deadline.start() == 500
+        assert deadline.start(5000) == 2000
+        assert deadline.start(0) == 2000  # 締め切りを設定した運用では 0 でも無制限にしない
+
+
+def test_timeout_allow_skip(app):
+    with app.test_request_context("/api/ask"):
+        assert deadline.start(300) == 300
+        assert 0 < deadline.timeout("llm", 30.0) <= 0.3
+        with pytest.raises(DeadlineExceeded) as e:
+            deadline.timeout("llm", 30.0, reserve=1.0)
+        assert e.value.stage == "llm" and e.value.budget_ms == 300
+
+        assert deadline.allow("fast", 100)
+        assert not deadline.allow("llm_validator", 3000, reason="x")
+        deadline.skip("web_source", urls=["https://example.go.jp/"])
+        steps = deadline.skipped()
+        assert [s["step"] for s in steps] == ["llm_validator", "web_source"]
+        assert steps[0]["reason"] == "x" and 0 < steps[0]["remaining_ms"] <= 300
+        assert steps[1]["urls"] == ["https://example.go.jp/"]
+
+        time.sleep(0.35)
+        with pytest.raises(DeadlineExceeded):
+            deadline.check("answer")
+
+
+@pytest.fixture
+def in_scope(monkeypatch):
+    monkeypatch.setattr(rag, "in_scope_llm", lambda query, previous=None: ("IN", 1.0, "stub"))
+    monkeypatch.setattr(rag, "rule_validate", lambda query, text, sources: (False, ["stub"]))
+
+    def no_validator(*a, **kw):
+        raise AssertionError("締め切りが近いので LLM 検証は呼ばれないはず")
+    monkeypatch.setattr(rag, "validate_answer_llm", no_validator)
+
+
+def test_slow_web_sources_are_skipped(app, monkeypatch, in_scope):
+    app.config.update(DEADLINE_FETCH_MIN_MS=700, DEADLINE_ANSWER_RESERVE_MS=100, RAG_TOP_K=5)
+    urls = [f"https://example.go.jp/{i}" for i in range(5)]
+    fetched = []
+
+    def slow_search(query, pages=1, budget=None):
+        assert budget is not None and budget <= 1.5
+        time.sleep(0.1)
+        return [{"title": u, "url": u, "snippet": "s"} for u in urls]
+
+    def slow_fetch(url, steps=None):
+        time.sleep(0.4)
+        fetched.append(url)
+        return "本文"
+
+    monkeypatch.setattr(rag, "google_search", slow_search)
+    monkeypatch.setattr(rag, "_fetch_text", slow_fetch)
+    monkeypatch.setattr(rag, "_summarize", lambda contexts, query, **kw: "要約")
+    with app.test_request_context("/api/ask"):
+        res = rag.answer("IT導入補助金の上限額は？", mode="web", deadline_ms=1500)
+
+    assert res["answer"] == "要約"
+    assert 1 <= len(fetched) < len(urls)
+    steps = {s["step"]: s for s in res["meta"]["skipped"]}
+    assert steps["web_source"]["urls"] == urls[len(fetched):]
+    assert "llm_validator" in steps
+    assert res["meta"]["notice"]
+
+
+def test_required_stage_past_deadline_returns_deadline_answer(app, monkeypatch, in_scope):
+    def slow_generate(query, mode, params, timing, steps, reuse=None, history=""):
+        time.sleep(0.3)
+        deadline.timeout("llm_answer", 30.0)  # LLM 呼び出しのタイムアウトを決める時点で締め切りを過ぎている
+        raise AssertionError("ここには来ない")
+
+    monkeypatch.setattr(rag, "generate_answer", slow_generate)
+    with app.test_request_context("/api/ask"):
+        res = rag.answer("IT導入補助金の上限額は？", deadline_ms=200)
+    assert res["answer"] == rag.DEADLINE_MSG
+    assert res["sources"] == []
+    assert res["meta"]["hide_reason"] == "deadline"
+    assert res["meta"]["deadline"]["stage"] == "llm_answer"
+    assert res["meta"]["deadline"]["budget_ms"] == 200
+
+
+def test_limiter_wait_is_cut_at_deadline(app, monkeypatch):
+    app.config.update(LIMIT_CHAT=1, LIMIT_QUEUE_TIMEOUT_SEC=5.0)
+    release = threading.Event()
+
+    def hold():
+        with app.app_context():
+            with admission.limit("chat"):
+                release.wait(5)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    try:
+        with app.app_context():
+            while admission.get_limiter("chat").active < 1:
+                time.sleep(0.01)
+
+        with app.test_request_context("/api/ask"):
+            deadline.start(200)
+            t0 = time.perf_counter()
+            with pytest.raises(Overloaded) as e:
+                with admission.limit("chat"):
+                    pass
+            assert e.value.reason == "deadline"
+            assert time.perf_counter() - t0 < 1.0  # LIMIT_QUEUE_TIMEOUT_SEC（5秒）まで待たない
+
+        def scope_behind_queue(query, previous=None):
+            with admission.limit("chat"):
+                return "IN", 1.0, "stub"
+
+        monkeypatch.setattr(rag, "in_scope_llm", scope_behind_queue)
+        with app.test_request_context("/api/ask"):
+            res = rag.answer("IT導入補助金の上限額は？", deadline_ms=200)
+        assert res["meta"]["hide_reason"] == "deadline"
+        assert res["meta"]["deadline"]["stage"] == "queue:chat"
+    finally:
+        release.set()
+        holder.join()
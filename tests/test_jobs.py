@@ -0,0 +1,144 @@
+# tests/test_jobs.py
+"""再インデックスのバックグラウンドジョブ（ingest_local_dir は差し替える）"""
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from app.services import doc_utils, jobs
+
+
+@pytest.fixture(autouse=True)
+def fresh_jobs(monkeypatch):
+    monkeypatch.setattr(jobs, "_jobs", {})
+    monkeypatch.setattr(jobs, "_running", None)
+
+
+@pytest.fixture
+def ingest(monkeypatch):
+    """ingest_local_dir の代わり。gate が開くまで step を繰り返す（呼ばれた job 名を calls に残す）"""
+    gate = threading.Event()
+    calls = []
+
+    def fake_ingest(progress=None, name=None, stats=None, rebuild_shards=None):
+        calls.append(name)
+        i = 0
+        while not gate.is_set():
+            progress("embed", i, 100)
+            i += 1
+            time.sleep(0.02)
+        stats["chunks"] = 3
+        return 1
+
+    monkeypatch.setattr(doc_utils, "ingest_local_dir", fake_ingest)
+    return gate, calls
+
+
+def _wait(cond, timeout=5.0):
+    until = time.time() + timeout
+    while time.time() < until:
+        if cond():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def _status(job_id):
+    return (jobs.get_job(job_id) or {}).get("status")
+
+
+def test_conflict_then_pending_rerun(app, ingest):
+    gate, calls = ingest
+    with app.app_context():
+        jobs_dir = jobs._jobs_dir()
+        first = jobs.request_ingest()
+        assert first["queued"] == "started"
+        assert _wait(lambda: _status(first["job_id"]) == "running")
+
+        with pytest.raises(jobs.JobConflict) as e:
+            jobs.start_ingest_job()
+        assert e.value.running_id == first["job_id"]
+        second = jobs.request_ingest()
+        assert second == {"job_id": first["job_id"], "queued": "pending"}
+        assert os.path.exists(os.path.join(jobs_dir, "ingest.pending"))
+
+        gate.set()
+        assert _wait(lambda: len(calls) == 2 and jobs._running is None)
+        assert _status(first["job_id"]) == "succeeded"
+        assert _status(calls[1]) == "succeeded"
+        assert jobs.get_job(calls[1])["result"] == {"indexed_docs": 1, "chunks": 3}
+        assert not os.path.exists(os.path.join(jobs_dir, "ingest.pending"))
+
+
+def test_cancel_file_from_other_worker(app, ingest, monkeypatch):
+    gate, calls = ingest
+    with app.app_context():
+        job = jobs.start_ingest_job()
+        assert _wait(lambda: job.progress["phase"] == "embed")
+
+        # 別ワーカーはメモリ上のジョブを持たないので、ファイルから状態を読み .cancel で止める
+        monkeypatch.setattr(jobs, "_jobs", {})
+        state = jobs.get_job(job.id)
+        assert state["status"] == "running" and state["progress"]["phase"] == "embed"
+        assert jobs.cancel_job(job.id)["status"] == "running"
+        assert os.path.exists(os.path.join(jobs._jobs_dir(), f"{job.id}.cancel"))
+
+        assert _wait(lambda: _status(job.id) == "cancelled")
+        assert jobs.get_job(job.id)["finished_at"] is not None
+        assert jobs.get_job("no-such-job") is None
+        # 止まればロックは解放され、次の取り込みを始められる
+        gate.set()
+        assert _wait(lambda: jobs._running is None)
+        nxt = jobs.start_ingest_job()
+        assert _wait(lambda: _status(nxt.id) == "succeeded")
+
+
+def test_flock_conflict_across_workers(app, ingest):
+    gate, calls = ingest
+    with app.app_context():
+        jobs_dir = jobs._jobs_dir()
+        # 別のワーカー（別プロセス）が取り込み中
+        holder = subprocess.Popen(
+            [sys.executable, "-c",
+             "import fcntl, os, sys\n"
+             "fd = os.open(sys.argv[1] + '/ingest.lock', os.O_RDWR | os.O_CREAT)\n"
+             "fcntl.flock(fd, fcntl.LOCK_EX)\n"
+             "open(sys.argv[1] + '/ingest.running', 'w').write('other-worker')\n"
+             "print('locked', flush=True)\n"
+             "sys.stdin.read()\n",
+             jobs_dir],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        try:
+            assert holder.stdout.readline().strip() == "locked"
+            with pytest.raises(jobs.JobConflict) as e:
+                jobs.start_ingest_job()
+            assert e.value.running_id == "other-worker"
+            assert jobs.request_ingest() == {"job_id": "other-worker", "queued": "pending"}
+            assert calls == []
+        finally:
+            holder.communicate("")
+        job = jobs.start_ingest_job()
+        gate.set()
+        assert _wait(lambda: _status(job.id) == "succeeded")
+
+
+def test_prune_jobs(app):
+    with app.app_context():
+        jobs_dir = jobs._jobs_dir()
+        now = time.time()
+        for i in range(30):
+            job = jobs.Job(jobs_dir)
+            job.status = "running" if i == 0 else "succeeded"
+            jobs._jobs[job.id] = job
+            job.save()
+            os.utime(os.path.join(jobs_dir, f"{job.id}.json"), (now - 100 + i, now - 100 + i))
+        ids = list(jobs._jobs)
+
+        jobs._prune_jobs(jobs_dir, keep=5)
+        # 実行中は残し、終了済みは新しい 5 件だけ
+        assert list(jobs._jobs) == [ids[0]] + ids[-5:]
+        files = sorted(n for n in os.listdir(jobs_dir) if n.endswith(".json"))
+        assert files == sorted(f"{i}.json" for i in ids[-10:])
@@ -0,0 +1,83 @@
+# tests/test_llm_utils.py
+"""LLM クライアント層（非同期クライアントのループごとの使い分け）"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.services import llm_utils
+
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+
+
+def test_async_client_per_event_loop():
+    async def get_twice():
+        return llm_utils.get_async_client(), llm_utils.get_async_client()
+
+    a1, a2 = asyncio.run(get_twice())
+    b1, _ = asyncio.run(get_twice())
+    assert a1 is a2
+    assert a1 is not b1
+    # 閉じたループの分は次に作るときに捨てる（残るのは最後のループの分だけ）
+    assert len(llm_utils._async_clients) <= 1
+
+
+def test_async_client_requires_running_loop():
+    with pytest.raises(RuntimeError):
+        llm_utils.get_async_client()
+
+
+# ===== ヘッジと同時実行枠 =====
+@pytest.fixture
+def hedge_env(monkeypatch):
+    from app.services import admission
+    monkeypatch.setattr(admission, "_limiters", {})
+    monkeypatch.setenv("LIMIT_CHAT", "2")
+    monkeypatch.setenv("LLM_MAX_RETRIES", "0")
+    monkeypatch.setattr(llm_utils, "_hedge_delay_ms", lambda kind: 50)
+    return admission
+
+
+def _slow_call(running, peak, lock, sec=0.3):
+    def fn(**_opts):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(sec)
+        with lock:
+            running[0] -= 1
+        return "ok"
+    return fn
+
+
+def test_hedge_uses_a_free_slot(hedge_env):
+    running, peak, lock = [0], [0], threading.Lock()
+    resp, policy = llm_utils._call_with_policy("chat:test", _slow_call(running, peak, lock))
+    assert resp == "ok" and policy["hedged"] is True
+    assert peak[0] == 2
+    lim = hedge_env.get_limiter("chat")
+    assert lim.stats()["extra"] == 1
+    time.sleep(0.4)  # 負けた方が終われば枠は全部返る
+    assert lim.active == 0
+
+
+def test_hedge_never_exceeds_limit(hedge_env):
+    running, peak, lock = [0], [0], threading.Lock()
+    fn = _slow_call(running, peak, lock)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(llm_utils._call_with_policy("chat:test", fn)))
+               for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 2
+    assert not any(policy["hedged"] for _, policy in results)
+    assert peak[0] == 2
+    lim = hedge_env.get_limiter("chat")
+    assert lim.stats()["extra_denied"] == 2
+    assert lim.active == 0
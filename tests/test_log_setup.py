@@ -0,0 +1,35 @@
+# tests/test_log_setup.py
+"""キュー経由のログ出力（キューに入れた後の trace の書き換えが出力に混ざらないこと・詳細の間引き）"""
+import json
+import logging
+import queue
+
+from app.log_setup import JsonFormatter, SamplingQueueHandler
+
+
+def _record(trace):
+    rec = logging.LogRecord("app", logging.INFO, __file__, 0, "rag.trace", None, None)
+    rec.trace = trace
+    return rec
+
+
+def test_prepare_snapshots_trace():
+    q = queue.Queue()
+    handler = SamplingQueueHandler(q, decision_sample=1.0, detail_sample=1.0)
+    trace = {"trace_id": "t1", "timing": {"total_ms": 10}, "steps": {"doc_hits": [{"score": 0.9}]}}
+    handler.emit(_record(trace))
+    # リクエスト側が出力前に書き換え続けても、キューの中身は投入時点のまま
+    trace["timing"]["total_ms"] = 99
+    trace["steps"]["doc_hits"].append({"score": 0.1})
+    trace["steps"]["late"] = True
+    out = json.loads(JsonFormatter().format(q.get_nowait()))
+    assert out["timing"] == {"total_ms": 10}
+    assert out["steps"] == {"doc_hits": [{"score": 0.9}]}
+
+
+def test_detail_sampled_out_keeps_counts():
+    q = queue.Queue()
+    handler = SamplingQueueHandler(q, decision_sample=1.0, detail_sample=0.0)
+    handler.emit(_record({"trace_id": "t2", "steps": {"doc_hits": [1, 2, 3], "rerank": {"ms": 5}, "query": "q"}}))
+    out = json.loads(JsonFormatter().format(q.get_nowait()))
+    assert out["steps"] == {"doc_hits": {"count": 3}, "rerank": "[sampled_out]", "query": "q"}
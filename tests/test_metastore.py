@@ -0,0 +1,77 @@
+# tests/test_metastore.py
+"""旧 meta.jsonl の変換（migrate_jsonl）が同時に呼ばれても一度だけ行われること"""
+import json
+import multiprocessing
+import os
+import threading
+
+from app.services.metastore import LEGACY_JSONL, META_DIRNAME, MetaStore, migrate_jsonl
+
+
+def _write_legacy(index_dir, n=50):
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, LEGACY_JSONL), "w", encoding="utf-8") as f:
+        for i in range(n):
+            f.write(json.dumps({"path": f"docs/{i % 3}.pdf", "page": i % 7 + 1, "chunk_id": f"{i % 7 + 1}-{i}"}) + "\n")
+
+
+def _migrate_in_process(index_dir, q):
+    try:
+        q.put(migrate_jsonl(index_dir))
+    except Exception as e:  # 失敗は親で検出する
+        q.put(repr(e))
+
+
+def test_migrate_once_and_idempotent(tmp_path):
+    index_dir = str(tmp_path)
+    _write_legacy(index_dir)
+    assert migrate_jsonl(index_dir) is True
+    assert migrate_jsonl(index_dir) is False
+    assert os.path.exists(os.path.join(index_dir, LEGACY_JSONL + ".bak"))
+    store = MetaStore(os.path.join(index_dir, META_DIRNAME))
+    assert len(store) == 50
+    assert store.get(10)["page"] == 4
+
+
+def test_existing_backup_counts_as_migrated(tmp_path):
+    index_dir = str(tmp_path)
+    _write_legacy(index_dir)
+    os.replace(os.path.join(index_dir, LEGACY_JSONL), os.path.join(index_dir, LEGACY_JSONL + ".bak"))
+    assert migrate_jsonl(index_dir) is False
+    assert migrate_jsonl(str(tmp_path / "missing")) is False
+
+
+def test_concurrent_threads(tmp_path):
+    index_dir = str(tmp_path)
+    _write_legacy(index_dir, n=2000)
+    results, errors = [], []
+
+    def run():
+        try:
+            results.append(migrate_jsonl(index_dir))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert sorted(results) == [False] * 7 + [True]
+    assert len(MetaStore(os.path.join(index_dir, META_DIRNAME))) == 2000
+
+
+def test_concurrent_processes(tmp_path):
+    index_dir = str(tmp_path)
+    _write_legacy(index_dir, n=2000)
+    ctx = multiprocessing.get_context("spawn")
+    q = ctx.Queue()
+    procs = [ctx.Process(target=_migrate_in_process, args=(index_dir, q)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(30)
+    results = [q.get(timeout=5) for _ in procs]
+    assert sorted(results, key=str) == [False] * 3 + [True]
+    assert len(MetaStore(os.path.join(index_dir, META_DIRNAME))) == 2000
@@ -0,0 +1,12 @@
+# tests/test_pdf_cache.py
+"""PDF解析の排他ロックが文書数に比例して増えないこと"""
+import hashlib
+
+from app.services import pdf_cache
+
+
+def test_key_lock_is_striped():
+    shas = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(1000)]
+    locks = {id(pdf_cache._key_lock(s)) for s in shas}
+    assert len(locks) <= pdf_cache._STRIPES
+    assert pdf_cache._key_lock(shas[0]) is pdf_cache._key_lock(shas[0])
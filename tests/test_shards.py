@@ -0,0 +1,133 @@
+# tests/test_shards.py
+"""シャード分割したインデックスの scatter-gather 検索（ローカル・リモート）が、分割しない場合と同じ上位k件を返すこと"""
+import importlib
+import os
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from app.services import doc_utils, vectorstore
+from app.services.shards import check_shard_config, load_manifest, shard_status
+from conftest import bigram_embed
+
+QUERIES = ["補助金の上限額", "申請の締め切り", "対象となる事業者", "IT導入の経費"]
+TOPICS = ["補助金の上限額は百万円です。", "申請の締め切りは三月末日です。", "対象となる事業者は中小企業です。",
+          "IT導入の経費が対象になります。", "交付決定の後に事業を始めます。", "実績報告書を提出します。"]
+
+
+@pytest.fixture
+def corpus(app, tmp_path, fake_embed):
+    pdf_dir = tmp_path / "pdf"
+    pdf_dir.mkdir()
+    for i in range(12):
+        body = "".join(TOPICS[(i + j) % len(TOPICS)] for j in range(3))
+        (pdf_dir / f"doc{i:02d}.txt").write_text(f"文書{i}。" + body * 20, encoding="utf-8")
+    app.config.update(PDF_DIR=str(pdf_dir), CHUNKER="fixed", DEDUP_ENABLED=False, EMBED_DIM=0)
+    return app
+
+
+def _top(queries, k=8):
+    return [[(h["doc"], h["chunk_id"], round(h["score"], 5)) for h in hits]
+            for hits in vectorstore.faiss_search_multi(queries, k)]
+
+
+def test_sharded_search_matches_single_index(corpus):
+    with corpus.app_context():
+        doc_utils.ingest_local_dir()
+        base = _top(QUERIES)
+        corpus.config["INDEX_SHARDS"] = 4
+        doc_utils.ingest_local_dir()
+        assert vectorstore.is_sharded(vectorstore.active_index_dir())
+        assert len([s for s in shard_status() if s["chunks"]]) > 1
+        sharded = _top(QUERIES)
+        hits = vectorstore.faiss_search(QUERIES[0], 8)
+    assert sharded == base
+    assert len({h["shard"] for h in hits}) > 1  # 上位が複数のシャードから来ている
+
+
+def test_pca_with_shards_is_refused(corpus):
+    corpus.config.update(INDEX_SHARDS=2, EMBED_DIM=16, EMBED_DIM_METHOD="pca")
+    with corpus.app_context():
+        with pytest.raises(ValueError):
+            doc_utils.ingest_local_dir()
+        check_shard_config(1)
+
+
+# ===== リモートシャード（scripts/shard_server.py） =====
+def _serve(wsgi_app):
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+@pytest.fixture
+def remote_shards(corpus, tmp_path, monkeypatch):
+    """3シャードの版を作り、各シャードを create_shard_app(root=…) で別スレッドのサーバに配信する"""
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1,localhost")
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(os.path.dirname(__file__)), "scripts"))
+    shard_server = importlib.import_module("shard_server")
+    with corpus.app_context():
+        doc_utils.ingest_local_dir()
+        base = _top(QUERIES)
+        corpus.config["INDEX_SHARDS"] = 3
+        doc_utils.ingest_local_dir()
+        root = vectorstore.active_index_dir()
+        dirs = [os.path.join(root, e["dir"]) for e in load_manifest(root)["entries"] if e.get("dir")]
+    servers = [_serve(shard_server.create_shard_app(root=d)) for d in dirs]
+    # ローカルのインデックスは無し・リモートだけで検索する
+    corpus.config.update(INDEX_DIR=str(tmp_path / "empty_index"), INDEX_SHARDS=1,
+                         INDEX_REMOTE_SHARDS=",".join(url for _, url in servers), INDEX_REMOTE_TIMEOUT=1.0)
+    yield corpus, base, shard_server, [url for _, url in servers], dirs
+    for server, _ in servers:
+        server.shutdown()
+
+
+def test_remote_shards_match_single_index(remote_shards):
+    app, base, _, urls, _ = remote_shards
+    with app.app_context():
+        assert _top(QUERIES) == base
+        hits = vectorstore.faiss_search(QUERIES[0], 8)
+    assert {h["shard"] for h in hits} <= set(urls)
+    assert len({h["shard"] for h in hits}) > 1
+
+
+def test_shard_server_endpoint(remote_shards):
+    app, _, shard_server, _, dirs = remote_shards
+    client = shard_server.create_shard_app(root=dirs[0]).test_client()
+    qvs = bigram_embed(QUERIES[:2])
+    r = client.post("/search", json={"vectors": qvs, "k": 3, "with_text": True,
+                                     "embed_model": app.config["EMBED_MODEL"]})
+    assert r.status_code == 200
+    hits = r.get_json()["hits"]
+    assert len(hits) == 2 and all(len(row) == 3 and "text" in row[0] for row in hits)
+    r = client.post("/search", json={"vector": qvs[0], "k": 2})
+    assert len(r.get_json()["hits"]) == 2
+    r = client.post("/search", json={"vectors": qvs, "k": 3, "embed_model": "other-embedding-model"})
+    assert r.status_code == 409
+
+
+@pytest.mark.parametrize("failure", ["503", "timeout"])
+def test_failed_remote_shard_is_skipped(remote_shards, caplog, failure):
+    app, _, _, urls, _ = remote_shards
+    bad = Flask("bad_shard")
+
+    @bad.post("/search")
+    def search():
+        if failure == "timeout":
+            time.sleep(2.0)
+        return {"error": "down"}, 503
+
+    server, bad_url = _serve(bad)
+    try:
+        app.config["INDEX_REMOTE_SHARDS"] = ",".join(urls + [bad_url])
+        with app.app_context():
+            hits = vectorstore.faiss_search(QUERIES[0], 5)
+    finally:
+        server.shutdown()
+    assert len(hits) == 5
+    assert bad_url not in {h["shard"] for h in hits}
+    errors = [r for r in caplog.records if r.getMessage() == "index.shard_error"]
+    assert [r.trace["shard"] for r in errors] == [bad_url]
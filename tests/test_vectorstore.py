@@ -0,0 +1,53 @@
+# tests/test_vectorstore.py
+"""カタログのキャッシュ（コレクションごと・版が変われば読み直し）"""
+import json
+
+import numpy as np
+import pytest
+
+from app.services import vectorstore
+
+
+def _build(base, names, tag):
+    staging = vectorstore.new_staging_dir(tag, base=base)
+    vecs = np.random.default_rng(len(names)).standard_normal((len(names), 8)).astype("float32")
+    vectorstore.faiss_save(vecs.tolist(), [{"path": n, "chunk_id": 0} for n in names], root=staging,
+                           texts=list(names))
+    vectorstore.catalog_save([{"name": n, "chunks": 1, "sha256": n} for n in names], root=staging)
+    vectorstore.promote_index(staging, base=base)
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """カタログを実際にファイルから読んだ回数"""
+    count = {"n": 0}
+    orig = json.load
+
+    def counting_load(f, *a, **kw):
+        if getattr(f, "name", "").endswith("catalog.json"):
+            count["n"] += 1
+        return orig(f, *a, **kw)
+
+    monkeypatch.setattr(vectorstore.json, "load", counting_load)
+    return count
+
+
+def test_collections_do_not_evict_each_other(app, reads):
+    cfg = app.config
+    with app.app_context():
+        _build(cfg["INDEX_DIR"], ["a.pdf", "b.pdf"], "main")
+        _build(cfg["WEB_INDEX_DIR"], ["https://example.go.jp/x"], "web")
+        main, web = vectorstore.active_index_dir(), vectorstore.active_index_dir(cfg["WEB_INDEX_DIR"])
+        for _ in range(3):
+            assert [f["name"] for f in vectorstore.load_catalog(main)] == ["a.pdf", "b.pdf"]
+            assert [f["name"] for f in vectorstore.load_catalog(web)] == ["https://example.go.jp/x"]
+        assert reads["n"] == 2
+
+        # 新しい版に切り替わったら読み直し、同じコレクションの古い版だけ捨てる
+        _build(cfg["INDEX_DIR"], ["a.pdf", "b.pdf", "c.pdf"], "main2")
+        new_main = vectorstore.active_index_dir()
+        assert new_main != main
+        assert len(vectorstore.load_catalog(new_main)) == 3
+        assert reads["n"] == 3
+        ours = {r for r in vectorstore._catalog_cache if r.startswith((cfg["INDEX_DIR"], cfg["WEB_INDEX_DIR"]))}
+        assert ours == {new_main, web}
@@ -0,0 +1,5 @@
+# wsgi.py
+# gunicorn 用のエントリポイント（gunicorn -c gunicorn.conf.py）
+from app import create_app
+
+app = create_app()